@@ -8,6 +8,7 @@ The application exposes the following endpoints:
 - GET /: Serves the index.html file as the frontend.
 - GET /<path:path>: Serves all files in the static directory.
 - GET /search: Handles search requests and returns ranked documents in JSON format.
+- GET /cache_stats: Returns the counters of the query cache for monitoring.
 
 Usage:
 - Start the Flask application by running this script.
@@ -49,7 +50,7 @@ def search():
             result = {
                 'title': doc.title,
                 'body': doc.body,
-                'url': doc.job['url'],
+                'url': doc.url,
                 'id': doc.id,
                 'relevant': doc.relevant
             }
@@ -59,6 +60,12 @@ def search():
     return jsonify({'error': 'Invalid query'})
 
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """Return the hit and miss counters of the query cache."""
+    return jsonify(ranker.cache.stats())
+
+
 def main():
     """Start the Flask application."""
     app.run(debug=True, host="0.0.0.0", port=4000)
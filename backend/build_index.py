@@ -1,175 +1,286 @@
 """
-backend/build_inverted_index.py
+backend/build_index.py
 
 This script builds an inverted index from the crawled documents.
-The inverted index maps tokens to document IDs and token positions.
+The inverted index maps tokens to the documents containing them,
+their term frequencies and token positions.
 
-This script.js fetches the crawled documents from the models, processes
-the tokenized text, and constructs the inverted index. The resulting
-inverted index is then saved as a pickle file for later use.
+The relevant documents are partitioned by ID into shards of INDEX_SHARD_SIZE
+documents. INDEX_BUILD_PROCESSES processes index the shards in parallel, each
+fetching the tokenized documents of its ID range from the models and spilling
+its partial index to disk in the memory-mapped format described in
+backend/inverted_index.py, with its terms sorted. The partial indexes are then
+merged term by term into a new generation of INDEX_DIRECTORY, see
+backend/generations.py. Since the shards are ordered by ID,
+the postings of a term are merged by appending the postings of each shard.
+Memory is bounded by the size of a shard, not by the size of the corpus.
+
+The index becomes the base segment of the index, without delta segments,
+see backend/segments.py. Documents crawled later are added by backend/update_index.py.
+
+The new generation is staged, backend/build_metrics.py adds the TF-IDF matrices
+and publishes it. With --publish, it is published right away, without TF-IDF
+matrices, which suffices for RANKING_RANKER=bm25f.
 
 Usage:
-    python3 backend/build_inverted_index.py
+    python3 -m backend.build_index [--publish]
 """
+import argparse
+import heapq
+import itertools
 import os
+import shutil
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+from backend.generations import new_generation, publish_generation, stage_generation
+from backend.inverted_index import INDEX_FIELDS, FieldIndex, FieldIndexWriter, IndexWriter, InvertedIndex
+from backend.segments import SEGMENTS_DIRECTORY, new_segments_manifest, write_segments_manifest
 from backend.streamers import DocumentStreamer
 from crawler import utils
-from crawler.sql_models.base import connect_to_database
+from crawler.sql_models.base import DATABASE, connect_to_database
+from crawler.sql_models.document import Document
 
 load_dotenv()
 LOG = utils.get_logger(__file__)
-INDEX_FILE = os.getenv("INDEX_FILE")
+INDEX_DIRECTORY = os.getenv("INDEX_DIRECTORY")
+INDEX_SHARD_SIZE = int(os.getenv("INDEX_SHARD_SIZE", "10000"))
+INDEX_BUILD_PROCESSES = int(os.getenv("INDEX_BUILD_PROCESSES", str(os.cpu_count() or 1)))
+# Columns of the documents read to index them.
+INDEX_COLUMNS = [f"{field}_tokens" for field in INDEX_FIELDS]
 
 
-class Indexer:
+def partition_document_ids(shard_size: int = INDEX_SHARD_SIZE) -> list[tuple[int, int]]:
     """
-    This class builds an inverted index from the crawled documents.
+    Partitions the relevant documents into ID ranges of shard_size documents each.
+
+    Returns:
+        list[tuple[int, int]]: Start (inclusive) and end (exclusive) ID of each shard, in ascending order.
     """
+    query = (Document.select(Document.id)
+             .where(Document.relevant == True)  # pylint: disable=singleton-comparison
+             .order_by(Document.id)
+             .tuples())
+    doc_ids = np.fromiter((doc_id for (doc_id,) in query.iterator()), dtype=np.int64)
+    if len(doc_ids) == 0:
+        return []
+    starts = doc_ids[::shard_size]
+    ends = np.append(starts[1:], doc_ids[-1] + 1)
+    return list(zip(starts.tolist(), ends.tolist()))
 
-    def __init__(self):
-        self.index = {
-            "title": defaultdict(list),
-            "meta_description": defaultdict(list),
-            "meta_keywords": defaultdict(list),
-            "meta_author": defaultdict(list),
-            "h1": defaultdict(list),
-            "h2": defaultdict(list),
-            "h3": defaultdict(list),
-            "h4": defaultdict(list),
-            "h5": defaultdict(list),
-            "h6": defaultdict(list),
-            "body": defaultdict(list),
-        }
-        self.doc_ids = []
 
-    def build_index(self):
-        """
-        Builds the inverted index from the crawled documents.
-        """
-        for document in tqdm(DocumentStreamer()):  # Iterate over the documents
-            self.doc_ids.append(document.id)
-            LOG.info(f"Indexing {document.id}")
+def index_documents(documents) -> tuple[list[int], dict[str, dict[str, dict[int, list[int]]]]]:
+    """
+    Builds the postings of the documents in memory.
 
-            for token in document.title_tokens:
-                self.index["title"][token].append(document.id)
-            LOG.info("Indexed title")
+    Returns:
+        The document IDs, one per row, and the postings: field -> token -> document row -> token positions.
+    """
+    doc_ids = []
+    postings = {field: defaultdict(dict) for field in INDEX_FIELDS}
+    for document in documents:
+        row = len(doc_ids)
+        doc_ids.append(document.id)
+        for field in INDEX_FIELDS:
+            for position, token in enumerate(getattr(document, f"{field}_tokens")):
+                postings[field][token].setdefault(row, []).append(position)
+    return doc_ids, postings
 
-            for token in document.meta_description_tokens:
-                self.index["meta_description"][token].append(document.id)
-            LOG.info("Indexed meta_description")
 
-            for token in document.meta_keywords_tokens:
-                self.index["meta_keywords"][token].append(document.id)
-            LOG.info("Indexed meta_keywords")
+def write_index(directory: str, doc_ids: list[int], postings: dict[str, dict[str, dict[int, list[int]]]]):
+    """
+    Writes postings held in memory as an index directory.
+    """
+    writer = IndexWriter(directory)
+    writer.write_doc_ids(doc_ids)
+    for field in INDEX_FIELDS:
+        writer.write_field(field, postings[field])
+    writer.commit(len(doc_ids))
+
 
-            for token in document.meta_author_tokens:
-                self.index["meta_author"][token].append(document.id)
-            LOG.info("Indexed meta_author")
+def build_shard(directory: str, start_id: int, end_id: int) -> tuple[int, float]:
+    """
+    Indexes the relevant documents with IDs in [start_id, end_id) into a partial index directory.
 
-            for token in document.h1_tokens:
-                self.index["h1"][token].append(document.id)
-            LOG.info("Indexed h1")
+    Returns:
+        tuple[int, float]: Number of indexed documents and seconds taken.
+    """
+    start_time = time.perf_counter()
+    doc_ids, postings = index_documents(DocumentStreamer(start_id=start_id, end_id=end_id, columns=INDEX_COLUMNS))
+    write_index(directory, doc_ids, postings)
+    return len(doc_ids), time.perf_counter() - start_time
 
-            for token in document.h2_tokens:
-                self.index["h2"][token].append(document.id)
-            LOG.info("Indexed h2")
 
-            for token in document.h3_tokens:
-                self.index["h3"][token].append(document.id)
-            LOG.info("Indexed h3")
+def merge_field(writer: FieldIndexWriter, shards: list[FieldIndex], row_offsets: list[int]) -> int:
+    """
+    Merges the postings of a field of several shards, k-way over their sorted term dictionaries.
 
-            for token in document.h4_tokens:
-                self.index["h4"][token].append(document.id)
-            LOG.info("Indexed h4")
+    Args:
+        writer (FieldIndexWriter): Writer of the field of the merged index.
+        shards (list[FieldIndex]): The field of each shard, in the order of their rows in the merged index.
+        row_offsets (list[int]): Row of the first document of each shard in the merged index.
 
-            for token in document.h5_tokens:
-                self.index["h5"][token].append(document.id)
-            LOG.info("Indexed h5")
+    Returns:
+        int: Number of merged terms.
+    """
+    def terms(shard_number: int, shard: FieldIndex):
+        term_bytes = shard.terms.tobytes()
+        term_offsets = shard.term_offsets.tolist()
+        for term_id in range(len(shard)):
+            yield term_bytes[term_offsets[term_id]:term_offsets[term_id + 1]], shard_number, term_id
 
-            for token in document.h6_tokens:
-                self.index["h6"][token].append(document.id)
-            LOG.info("Indexed h6")
+    num_terms = 0
+    # UTF-8 bytes sort like the strings they encode, so the merged terms are sorted as well.
+    merged_terms = heapq.merge(*[terms(shard_number, shard) for shard_number, shard in enumerate(shards)])
+    for term, occurrences in itertools.groupby(merged_terms, key=lambda occurrence: occurrence[0]):
+        rows, frequencies, positions = [], [], []
+        for _, shard_number, term_id in occurrences:
+            shard = shards[shard_number]
+            rows.append(shard.postings_at(term_id).astype(np.int64) + row_offsets[shard_number])
+            frequencies.append(shard.frequencies_at(term_id))
+            positions.append(shard.positions[shard.positions_offsets[term_id]:shard.positions_offsets[term_id + 1]])
+        writer.add_postings(term.decode("utf-8"), np.concatenate(rows), np.concatenate(frequencies),
+                            np.concatenate(positions))
+        num_terms += 1
+    writer.close()
+    return num_terms
 
-            for token in document.body:
-                self.index["body"][token].append(document.id)
-            LOG.info("Indexed body")
 
-        LOG.info("Finished indexing")
-        utils.io.write_pickle_file((self.index, self.doc_ids), INDEX_FILE)
-        LOG.info(f"Wrote index file to {INDEX_FILE}")
+def merge_shards(shard_directories: list[str], directory: str):
+    """
+    Merges partial indexes, ordered by document ID, into one index directory.
+    """
+    shards = [InvertedIndex(shard_directory) for shard_directory in shard_directories]
+    num_documents = sum(shard.num_documents for shard in shards)
+    writer = IndexWriter(directory)
+    writer.write_doc_ids(np.concatenate([shard.doc_ids for shard in shards]) if shards else [])
+    row_offsets = np.cumsum([0] + [shard.num_documents for shard in shards]).tolist()
+    for field in INDEX_FIELDS:
+        start_time = time.perf_counter()
+        num_terms = merge_field(writer.field_writer(field), [shard.fields[field] for shard in shards], row_offsets)
+        LOG.info(f"Merged {num_terms} terms of field {field} from {len(shards)} shards "
+                 f"in {time.perf_counter() - start_time:.1f}s")
+    writer.commit(num_documents)
 
 
-def read_index_file() -> (defaultdict[str, dict[str, list[int]]], list[int]):
+class Indexer:
+    """
+    This class builds an inverted index from the crawled documents.
     """
-    Reads the short inverted index from the pickle file.
+
+    def __init__(self, directory: str = INDEX_DIRECTORY, shard_size: int = INDEX_SHARD_SIZE,
+                 processes: int = INDEX_BUILD_PROCESSES):
+        """
+        Args:
+            directory (str): Directory of the index.
+            shard_size (int): Number of documents indexed at once by a process.
+            processes (int): Number of processes indexing shards in parallel. 1 indexes in this process.
+        """
+        self.directory = directory
+        self.shards_directory = os.path.join(directory, "shards")
+        self.shard_size = shard_size
+        self.processes = processes
+
+    def build_shards(self, id_ranges: list[tuple[int, int]]) -> list[str]:
+        """
+        Indexes the shards, in parallel if there are several processes.
+
+        Returns:
+            list[str]: The directories of the partial indexes, in the order of the ID ranges.
+        """
+        shard_directories = [os.path.join(self.shards_directory, f"shard-{shard_number:05d}")
+                             for shard_number in range(len(id_ranges))]
+        arguments = [(shard_directory, start_id, end_id)
+                     for shard_directory, (start_id, end_id) in zip(shard_directories, id_ranges)]
+        start_time = time.perf_counter()
+        num_documents = 0
+        progress = tqdm(total=len(arguments), desc="Indexing shards", unit="shard")
+
+        def log_progress(shard_directory: str, shard_documents: int, seconds: float):
+            nonlocal num_documents
+            num_documents += shard_documents
+            progress.update()
+            elapsed = time.perf_counter() - start_time
+            LOG.info(f"Indexed {shard_directory}: {shard_documents} documents in {seconds:.1f}s. "
+                     f"{progress.n}/{len(arguments)} shards, {num_documents} documents, "
+                     f"{num_documents / max(elapsed, 1e-9):.0f} documents/s")
+
+        if self.processes <= 1:
+            for argument in arguments:
+                log_progress(argument[0], *build_shard(*argument))
+        else:
+            # Every process opens its own connection, the connection of this process can not be shared.
+            DATABASE.close()
+            with ProcessPoolExecutor(self.processes, initializer=connect_to_database) as pool:
+                futures = {pool.submit(build_shard, *argument): argument[0] for argument in arguments}
+                for future in as_completed(futures):
+                    log_progress(futures[future], *future.result())
+        progress.close()
+        return shard_directories
+
+    def build_index(self):
+        """
+        Builds the inverted index from the crawled documents.
+        """
+        shutil.rmtree(self.shards_directory, ignore_errors=True)
+        id_ranges = partition_document_ids(self.shard_size)
+        LOG.info(f"Indexing {len(id_ranges)} shards of up to {self.shard_size} documents "
+                 f"with {self.processes} processes")
+        shard_directories = self.build_shards(id_ranges)
+        merge_shards(shard_directories, self.directory)
+        shutil.rmtree(self.shards_directory, ignore_errors=True)
+        # The new base segment contains the documents of all delta segments.
+        shutil.rmtree(os.path.join(self.directory, SEGMENTS_DIRECTORY), ignore_errors=True)
+        write_segments_manifest(self.directory, new_segments_manifest(id_ranges[-1][1] - 1 if id_ranges else 0))
+        LOG.info(f"Wrote index to {self.directory}")
+
+
+def read_index(directory: str = INDEX_DIRECTORY) -> InvertedIndex:
+    """
+    Opens the inverted index memory-mapped, by default the current generation.
 
     Returns:
-        A tuple of the inverted index and the list of document IDs.
-    (
-        [doc_id, doc_id, ...],
+        The inverted index. index.doc_ids maps document rows to document IDs,
+        index.fields maps each field name to its term dictionary and postings:
         {
             "title": {
-                "token": [doc_id, doc_id, ...],
-                ...
-            },
-            "meta_description": {
-                "token": [doc_id, doc_id, ...],
-                ...
-            },
-            "meta_keywords": {
-                "token": [doc_id, doc_id, ...],
-                ...
-            },
-            "meta_author": {
-                "token": [doc_id, doc_id, ...],
-                ...
-            },
-            "h1": {
-                "token": [doc_id, doc_id, ...],
-                ...
-            },
-            "h2": {
-                "token": [doc_id, doc_id, ...],
-                ...
-            },
-            "h3": {
-                "token": [doc_id, doc_id, ...],
-                ...
-            },
-            "h4": {
-                "token": [doc_id, doc_id, ...],
-                ...
-            },
-            "h5": {
-                "token": [doc_id, doc_id, ...],
-                ...
-            },
-            "h6": {
-                "token": [doc_id, doc_id, ...],
+                "token": [doc_row, doc_row, ...],
                 ...
             },
+            ...
             "body": {
-                "token": [doc_id, doc_id, ...],
+                "token": [doc_row, doc_row, ...],
                 ...
             },
         }
-    )
+        Term frequencies and token positions of the postings are available through
+        FieldIndex.frequencies_at and FieldIndex.positions_at.
     """
-    return utils.io.read_pickle_file(INDEX_FILE)
+    return InvertedIndex(directory)
 
 
 def main():
     """
-    Main function to build the inverted index and save it as a pickle file.
+    Main function to build the inverted index of a new generation and write it to disk.
     """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--publish', action='store_true',
+                        help='Publish the new generation without waiting for the TF-IDF matrices')
+    args = parser.parse_args()
     connect_to_database()
-    Indexer().build_index()
-    read_index_file()
+    generation = new_generation(INDEX_DIRECTORY)
+    Indexer(generation).build_index()
+    read_index(generation)
+    if args.publish:
+        publish_generation(generation, INDEX_DIRECTORY)
+    else:
+        stage_generation(generation, INDEX_DIRECTORY)
+        LOG.info("Run backend.build_metrics to add the TF-IDF matrices and publish the index")
 
 
 if __name__ == '__main__':
@@ -9,6 +9,8 @@ Usage:
 """
 from dotenv import load_dotenv
 
+from backend.build_index import INDEX_DIRECTORY
+from backend.generations import publish_generation, staged_generation
 from backend.vector_spaces.tfidf import train_tf_idf_vectorizer, tfidf_vectorize_indexed_documents
 from crawler import utils
 from crawler.sql_models.base import connect_to_database
@@ -20,11 +22,16 @@ LOG = utils.get_logger(__file__)
 
 def main():
     """
-    Builds the ranker model.
+    Builds the ranker model of the generation staged by backend.build_index and publishes the generation.
     """
+    generation = staged_generation(INDEX_DIRECTORY)
+    if generation is None:
+        LOG.error(f"No generation of {INDEX_DIRECTORY} is staged, run backend.build_index first")
+        return
     connect_to_database()
-    train_tf_idf_vectorizer()
-    tfidf_vectorize_indexed_documents()
+    train_tf_idf_vectorizer(generation)
+    tfidf_vectorize_indexed_documents(generation)
+    publish_generation(generation, INDEX_DIRECTORY)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,258 @@
+"""
+backend/build_pagerank.py
+
+This script computes the PageRank of the servers and of the documents from the
+crawled link graph.
+
+A server links to another server if a document crawled from the first server
+contains a link to the second one, i.e. there is a job of the second server whose
+parent document was crawled by a job of the first server. The links are streamed
+from the jobs table in chunks of PAGERANK_CHUNK_SIZE jobs into a sparse adjacency
+matrix, so memory grows with the number of distinct server links, not with the
+number of jobs.
+
+The PageRank is personalized with PAGERANK_PERSONALIZATION and normalized so that
+the highest ranked server has a PageRank of 1. It is written to servers.page_rank,
+where the manager reads it to prioritize new jobs, and to PAGERANK_FILE. The
+adjacency matrix is written to DIRECTED_LINK_GRAPH_FILE.
+
+Likewise, a document links to the documents crawled by its jobs. The PageRank of
+the documents is not personalized. It is normalized to a maximum of 1 and written
+to DOCUMENT_PAGERANK_FILE as a NumPy array indexed by document ID, which the
+backend memory-maps and fuses into the ranking.
+
+Usage:
+    python3 -m backend.build_pagerank
+"""
+import json
+import os
+
+import numpy as np
+import peewee
+from dotenv import load_dotenv
+from scipy.sparse import csr_matrix
+
+from crawler import utils
+from crawler.sql_models.base import connect_to_database
+from crawler.sql_models.document import Document
+from crawler.sql_models.job import Job
+from crawler.sql_models.server import Server
+from crawler.utils.graph import pagerank, personalization_vector
+
+load_dotenv()
+LOG = utils.get_logger(__file__)
+DIRECTED_LINK_GRAPH_FILE = os.getenv("DIRECTED_LINK_GRAPH_FILE")
+PAGERANK_FILE = os.getenv("PAGERANK_FILE")
+DOCUMENT_PAGERANK_FILE = os.getenv("DOCUMENT_PAGERANK_FILE")
+PAGERANK_PERSONALIZATION = json.loads(os.getenv("PAGERANK_PERSONALIZATION", "{}"))
+PAGERANK_MAX_ITER = int(os.getenv("PAGERANK_MAX_ITER", "1000"))
+PAGERANK_ALPHA = float(os.getenv("PAGERANK_ALPHA", "0.85"))
+PAGERANK_CHUNK_SIZE = int(os.getenv("PAGERANK_CHUNK_SIZE", "100000"))
+SQL_CHUNK_SIZE = 1000
+
+
+def load_servers() -> (np.ndarray, list[str]):
+    """
+    Returns the IDs of all servers in ascending order and their names.
+    """
+    rows = list(Server.select(Server.id, Server.name).order_by(Server.id).tuples())
+    server_ids = np.array([server_id for server_id, _ in rows], dtype=np.int64)
+    return server_ids, [name for _, name in rows]
+
+
+def stream_server_links(chunk_size: int = PAGERANK_CHUNK_SIZE):
+    """
+    Streams the links between servers, paginating over the jobs by ID.
+
+    Yields:
+        (np.ndarray, np.ndarray): Server IDs of the linking and of the linked documents of a chunk of jobs.
+    """
+    parent_job = Job.alias()
+    last_job_id = 0
+    while True:
+        rows = list(Job.select(Job.id, parent_job.server_id, Job.server_id)
+                    .join(Document, on=Job.parent_id == Document.id)
+                    .join(parent_job, on=Document.job_id == parent_job.id)
+                    .where((Job.id > last_job_id) & Job.server_id.is_null(False) & parent_job.server_id.is_null(False))
+                    .order_by(Job.id)
+                    .limit(chunk_size)
+                    .tuples())
+        if len(rows) == 0:
+            return
+        last_job_id = rows[-1][0]
+        links = np.array([(source, target) for _, source, target in rows], dtype=np.int64)
+        yield links[:, 0], links[:, 1]
+
+
+def build_server_graph(server_ids: np.ndarray, chunk_size: int = PAGERANK_CHUNK_SIZE) -> csr_matrix:
+    """
+    Builds the adjacency matrix of the servers, ignoring links of a server to itself.
+    A link counts once, however many documents contain it.
+
+    Args:
+        server_ids (np.ndarray): IDs of the servers in ascending order, one row and column each.
+        chunk_size (int): Number of jobs loaded at once.
+
+    Returns:
+        csr_matrix: Matrix with a 1 at [i, j] if server i links to server j.
+    """
+    num_servers = len(server_ids)
+    adjacency = csr_matrix((num_servers, num_servers), dtype=np.float64)
+    num_links = 0
+    for sources, targets in stream_server_links(chunk_size):
+        source_rows = np.searchsorted(server_ids, sources)
+        target_rows = np.searchsorted(server_ids, targets)
+        # Servers created after loading the servers are not part of the graph.
+        known = (source_rows < num_servers) & (target_rows < num_servers)
+        known[known] = (server_ids[source_rows[known]] == sources[known]) & \
+                       (server_ids[target_rows[known]] == targets[known])
+        keep = known & (sources != targets)
+        chunk = csr_matrix((np.ones(keep.sum()), (source_rows[keep], target_rows[keep])),
+                           shape=(num_servers, num_servers))
+        adjacency = adjacency + chunk
+        adjacency.data[:] = 1
+        num_links += len(sources)
+        LOG.info(f"Loaded {num_links} links, {adjacency.nnz} distinct server links")
+    return adjacency
+
+
+def stream_document_links(chunk_size: int = PAGERANK_CHUNK_SIZE):
+    """
+    Streams the links between documents, paginating over the documents by ID.
+
+    Yields:
+        (np.ndarray, np.ndarray): IDs of the linking and of the linked documents of a chunk of documents.
+    """
+    last_document_id = 0
+    while True:
+        rows = list(Document.select(Document.id, Job.parent_id)
+                    .join(Job, on=Document.job_id == Job.id)
+                    .where((Document.id > last_document_id) & Job.parent_id.is_null(False))
+                    .order_by(Document.id)
+                    .limit(chunk_size)
+                    .tuples())
+        if len(rows) == 0:
+            return
+        last_document_id = rows[-1][0]
+        links = np.array([(source, target) for target, source in rows], dtype=np.int64)
+        yield links[:, 0], links[:, 1]
+
+
+def build_document_graph(chunk_size: int = PAGERANK_CHUNK_SIZE) -> csr_matrix:
+    """
+    Builds the adjacency matrix of the documents, indexed by document ID.
+
+    Args:
+        chunk_size (int): Number of documents loaded at once.
+
+    Returns:
+        csr_matrix: Matrix with a 1 at [i, j] if document i links to document j.
+    """
+    num_documents = (Document.select(peewee.fn.MAX(Document.id)).scalar() or 0) + 1  # pylint: disable=no-value-for-parameter
+    sources, targets = [], []
+    for chunk_sources, chunk_targets in stream_document_links(chunk_size):
+        # Seeds and links of deleted documents point to no document.
+        keep = (chunk_sources > 0) & (chunk_sources < num_documents) & (chunk_sources != chunk_targets)
+        sources.append(chunk_sources[keep])
+        targets.append(chunk_targets[keep])
+        LOG.info(f"Loaded {sum(len(chunk) for chunk in sources)} document links")
+    sources = np.concatenate(sources) if sources else np.empty(0, dtype=np.int64)
+    targets = np.concatenate(targets) if targets else np.empty(0, dtype=np.int64)
+    adjacency = csr_matrix((np.ones(len(sources)), (sources, targets)), shape=(num_documents, num_documents))
+    adjacency.data[:] = 1
+    return adjacency
+
+
+def compute_document_page_ranks(adjacency: csr_matrix) -> np.ndarray:
+    """
+    Computes the PageRank of the documents, normalized to a maximum of 1.
+    IDs without document get a PageRank of 0.
+    """
+    num_documents = adjacency.shape[0]
+    is_document = np.zeros(num_documents, dtype=bool)
+    for (document_id,) in Document.select(Document.id).tuples().iterator():
+        is_document[document_id] = True
+    personalization = is_document / max(1, is_document.sum())
+    page_ranks = pagerank(adjacency, personalization, alpha=PAGERANK_ALPHA, max_iter=PAGERANK_MAX_ITER)
+    page_ranks[~is_document] = 0
+    if len(page_ranks) > 0 and page_ranks.max() > 0:
+        page_ranks = page_ranks / page_ranks.max()
+    return page_ranks.astype(np.float32)
+
+
+def write_document_page_ranks(page_ranks: np.ndarray, path: str = DOCUMENT_PAGERANK_FILE):
+    """
+    Writes the PageRank of the documents, replacing the previous file atomically
+    so that a running backend keeps reading a complete file.
+    """
+    utils.io.create_parent_directory_if_not_exist(path)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as file:
+        np.save(file, page_ranks)
+    os.replace(temporary_path, path)
+    LOG.info(f"Wrote the PageRank of {len(page_ranks)} document IDs to {path}")
+
+
+def read_document_page_ranks(path: str = DOCUMENT_PAGERANK_FILE) -> np.ndarray | None:
+    """
+    Opens the PageRank of the documents memory-mapped, or returns None if it was not built yet.
+    """
+    if path is None or not os.path.exists(path):
+        LOG.warning(f"No document PageRank found at {path}")
+        return None
+    return np.load(path, mmap_mode="r")
+
+
+def document_page_ranks_version(path: str = DOCUMENT_PAGERANK_FILE) -> int | None:
+    """
+    Returns the modification time of the PageRank of the documents, None if it was not built yet.
+    The file is replaced atomically, so the version changes with every build.
+    """
+    try:
+        return os.stat(path).st_mtime_ns if path is not None else None
+    except FileNotFoundError:
+        return None
+
+
+def save_server_page_ranks(server_ids: np.ndarray, page_ranks: np.ndarray):
+    """
+    Writes the PageRank of the servers to the servers table, one statement per chunk of servers.
+    """
+    with Server._meta.database.atomic():  # pylint: disable=no-member,protected-access
+        for start in range(0, len(server_ids), SQL_CHUNK_SIZE):
+            chunk = slice(start, start + SQL_CHUNK_SIZE)
+            chunk_ids = server_ids[chunk].tolist()
+            page_rank = peewee.Case(Server.id, list(zip(chunk_ids, page_ranks[chunk].tolist())))
+            Server.update(page_rank=page_rank).where(Server.id.in_(chunk_ids)).execute()
+    LOG.info(f"Updated the PageRank of {len(server_ids)} servers")
+
+
+def compute_server_page_ranks(adjacency: csr_matrix, server_names: list[str]) -> np.ndarray:
+    """
+    Computes the personalized PageRank of the servers, normalized to a maximum of 1.
+    """
+    personalization = personalization_vector(server_names, PAGERANK_PERSONALIZATION)
+    page_ranks = pagerank(adjacency, personalization, alpha=PAGERANK_ALPHA, max_iter=PAGERANK_MAX_ITER)
+    if len(page_ranks) > 0 and page_ranks.max() > 0:
+        page_ranks = page_ranks / page_ranks.max()
+    return page_ranks
+
+
+def main():
+    """
+    Computes the PageRank of the servers and of the documents and writes it to the database and to disk.
+    """
+    connect_to_database()
+    server_ids, server_names = load_servers()
+    LOG.info(f"Loaded {len(server_ids)} servers")
+    adjacency = build_server_graph(server_ids)
+    utils.io.write_pickle_file({"server_ids": server_ids, "adjacency": adjacency}, DIRECTED_LINK_GRAPH_FILE)
+    page_ranks = compute_server_page_ranks(adjacency, server_names)
+    save_server_page_ranks(server_ids, page_ranks)
+    utils.io.write_json_file(dict(zip(server_names, page_ranks.tolist())), PAGERANK_FILE)
+    LOG.info(f"Wrote PageRank to {PAGERANK_FILE}")
+    write_document_page_ranks(compute_document_page_ranks(build_document_graph()))
+
+
+if __name__ == '__main__':
+    main()
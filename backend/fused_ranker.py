@@ -1,60 +1,291 @@
-from collections import defaultdict
+import functools
+import os
+import threading
+import time
 
+import numpy as np
+import peewee
 from dotenv import load_dotenv
 
-from backend.build_index import read_index_file
+from backend.build_index import INDEX_DIRECTORY
+from backend.build_pagerank import document_page_ranks_version, read_document_page_ranks
+from backend.generations import current_generation
+from backend.inverted_index import InvertedIndex, index_version
+from backend.query_cache import QueryCache
+from backend.query_parser import ParsedQuery, Phrase, parse_query
+from backend.rankers.bm25f_ranker import BM25FRanker
+from backend.rankers.max_score import rank_rows
 from backend.rankers.tfidf_ranker import TFIDFRanker
+from backend.segments import SegmentedIndex, read_segmented_index, read_segments_manifest, segment_directories, \
+    segments_version
+from backend.vector_spaces.tfidf import TFIDFMatrices, read_tfidf_vectorizers
 from crawler import utils
 from crawler.sql_models.document import Document
+from crawler.sql_models.job import Job
 
 load_dotenv()
 
 LOG = utils.get_logger(__file__)
+RANKING_TOP_K = os.getenv("RANKING_TOP_K", "false").lower() == "true"
+SEARCH_RESULT_BODY_LENGTH = int(os.getenv("SEARCH_RESULT_BODY_LENGTH", "500"))
+RANKING_PAGERANK_WEIGHT = float(os.getenv("RANKING_PAGERANK_WEIGHT", "1"))
+RANKING_RANKER = os.getenv("RANKING_RANKER", "tfidf")
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "10"))
 
 
-class FusedRanker:
+def generation_version(directory: str, page_ranks: bool) -> tuple:
     """
-    This class builds a ranker model using the TF-IDF vectorizer
-    and relevant document tokens.
+    Returns the version of everything a generation is loaded from: the current generation
+    of the index, its delta segments and, if used, the PageRank of the documents.
     """
+    generation = current_generation(directory)
+    return (generation, index_version(generation), segments_version(generation),
+            document_page_ranks_version() if page_ranks else None)
 
-    def __init__(self):
-        pickled_index = read_index_file()
-        self.indices = pickled_index[0]
-        self.all_doc_ids = pickled_index[1]
 
-    def get_matches_for_query_tokens(self, query_tokens: list[str]) -> dict[str, list[int]]:
+class Generation:  # pylint: disable=too-few-public-methods
+    """
+    The index, the TF-IDF vectorizers and matrices and the PageRank the documents are ranked with.
+    A generation is completely loaded before it is used and never changes afterwards.
+    """
+
+    def __init__(self, directory: str, tfidf: bool, page_ranks: bool):
+        """
+        Args:
+            directory (str): Directory of the index, resolved to its current generation once.
+            tfidf (bool): If true, the TF-IDF vectorizers and matrices are loaded.
+            page_ranks (bool): If true, the PageRank of the documents is loaded.
+        """
+        self.version = generation_version(directory, page_ranks)
+        self.directory = self.version[0]
+        manifest = read_segments_manifest(self.directory) if self.version[2] is not None else None
+        self.index = read_segmented_index(self.directory, manifest)
+        self.doc_ids = self.index.doc_ids
+        self.vectorizers, self.tfidf_matrices = None, None
+        if tfidf:
+            row_offsets = self.index.row_offsets if isinstance(self.index, SegmentedIndex) else [0]
+            self.vectorizers = read_tfidf_vectorizers(self.directory)
+            self.tfidf_matrices = TFIDFMatrices(segment_directories(self.directory, manifest), row_offsets)
+        self.page_ranks = read_document_page_ranks() if page_ranks else None
+
+
+class FusedRanker:  # pylint: disable=too-many-instance-attributes
+    """
+    This class ranks the documents with TF-IDF or BM25F, fused with their PageRank.
+    """
+
+    def __init__(self, top_k: bool = RANKING_TOP_K, page_rank_weight: float = RANKING_PAGERANK_WEIGHT,  # pylint: disable=too-many-arguments
+                 ranker: str = RANKING_RANKER, directory: str = INDEX_DIRECTORY,
+                 reload_interval: float = INDEX_RELOAD_INTERVAL, start: bool = True):
+        """
+        Args:
+            top_k (bool): If true, only the documents needed for the requested page are fully scored,
+                using MaxScore early termination. Otherwise, every matching document is scored.
+            page_rank_weight (float): Weight of the PageRank of a document, added to its text score.
+            ranker (str): "tfidf" to score with TFIDFRanker, "bm25f" to score with BM25FRanker.
+            directory (str): Directory of the index, see backend/generations.py.
+            reload_interval (float): Seconds between two checks for a new generation of the index.
+            start (bool): If true, new generations are loaded by a background thread.
         """
-        Returns the document IDs that match the query tokens.
-        The document IDs are grouped by the index name.
+        if ranker not in ("tfidf", "bm25f"):
+            raise ValueError(f"Unknown ranker {ranker}, expected tfidf or bm25f")
+        self.ranker = ranker
+        self.top_k = top_k
+        self.page_rank_weight = page_rank_weight
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self.reload_lock = threading.Lock()
+        self.generation = self.load_generation()
+        self.cache = QueryCache(version=lambda: self.generation.version)
+        if start:
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def load_generation(self) -> Generation:
+        """
+        Loads the current generation of the index.
+        """
+        return Generation(self.directory, tfidf=self.ranker == "tfidf", page_ranks=self.page_rank_weight > 0)
+
+    def reload(self) -> bool:
         """
-        matches = defaultdict(list)
-        for index_name, index in self.indices.items():
-            for query_token in query_tokens:
-                if query_token in index:
-                    matches[index_name].extend(index[query_token])
+        Loads the current generation of the index if it changed and swaps it in.
+
+        Queries take self.generation once, so queries running during the swap finish
+        on the old generation. If the new generation cannot be loaded, the old one is kept.
+
+        Returns:
+            bool: True if a new generation was swapped in.
+        """
+        with self.reload_lock:
+            version = generation_version(self.directory, self.page_rank_weight > 0)
+            if version == self.generation.version:
+                return False
+            start_time = time.perf_counter()
+            try:
+                generation = self.load_generation()
+            except Exception as exception:
+                LOG.error(f"Error while loading the index {version[0]}, "
+                          f"keeping {self.generation.directory}: {exception}")
+                return False
+            self.generation = generation
+        LOG.info(f"Loaded the index {generation.directory} with {generation.index.num_documents} documents "
+                 f"in {time.perf_counter() - start_time:.1f}s")
+        return True
+
+    def run(self):
+        """
+        Reloads the index in the background every reload_interval seconds.
+        """
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                self.reload()
+            except Exception as exception:
+                LOG.error(f"Error in the reload thread: {exception}")
+
+    def static_scores(self, rows: np.ndarray, generation: Generation = None) -> np.ndarray:
+        """
+        Returns the weighted PageRank of the documents in the rows.
+        Documents crawled after the PageRank was computed get 0.
+        """
+        generation = self.generation if generation is None else generation
+        doc_ids = np.asarray(generation.doc_ids[rows], dtype=np.int64)
+        scores = np.zeros(len(doc_ids))
+        known = doc_ids < len(generation.page_ranks)
+        scores[known] = self.page_rank_weight * generation.page_ranks[doc_ids[known]]
+        return scores
+
+    def get_matches_for_query_tokens(self, query_tokens: list[str], allowed_rows: np.ndarray = None,
+                                     index: InvertedIndex | SegmentedIndex = None) -> dict[str, np.ndarray]:
+        """
+        Returns the sorted, unique document rows that match the query tokens.
+        The document rows are grouped by the index name.
+        If allowed_rows is given, only documents in these rows are returned.
+        """
+        matches = {}
+        for index_name, field_index in (self.generation.index if index is None else index).items():
+            postings = [field_index.get(query_token) for query_token in query_tokens]
+            postings = [rows for rows in postings if rows is not None]
+            if len(postings) == 0:
+                continue
+            rows = np.unique(np.concatenate(postings)).astype(np.int64)
+            if allowed_rows is not None:
+                rows = rows[np.isin(rows, allowed_rows, assume_unique=True)]
+            matches[index_name] = rows
         return matches
 
-    def scores(self, query: str) -> tuple[list[str], dict[int, float]]:
+    def get_rows_matching_phrases(self, phrases: list[Phrase],
+                                  index: InvertedIndex | SegmentedIndex = None) -> np.ndarray:
+        """
+        Returns the document rows containing every phrase in at least one field.
+        The phrases are evaluated on the token positions stored in the index.
+        """
+        rows = None
+        for phrase in phrases:
+            phrase_rows = np.empty(0, dtype=np.uint32)
+            for _, field_index in (self.generation.index if index is None else index).items():
+                phrase_rows = np.union1d(phrase_rows, field_index.phrase_matches(phrase.tokens, phrase.slop))
+            rows = phrase_rows if rows is None else np.intersect1d(rows, phrase_rows, assume_unique=True)
+        return rows
+
+    def scores(self, query: str, k: int = None) -> tuple[list[str], dict[int, float]]:
         """
         Returns the tokens of the query and the scores of the documents based on the TF-IDF.
+        If the query contains quoted phrases, only documents containing all phrases are scored.
+        If k is given, only the scores of the k best documents are returned.
         """
         # Preprocess the query
-        query_tokens = utils.text.advanced_tokenize_with_pos(query)
-        # Get the document IDs that match the query tokens
-        matched_ids = self.get_matches_for_query_tokens(query_tokens)
-        # Scores of the documents based on the TF-IDF
-        return query_tokens, TFIDFRanker(query_tokens, matched_ids).scores()
+        parsed_query = parse_query(query)
+        return parsed_query.tokens, self.scores_of_parsed_query(parsed_query, k)
+
+    def scores_of_parsed_query(self, parsed_query: ParsedQuery, k: int = None) -> dict[int, float]:
+        """
+        Returns the scores of the documents for a parsed query, keyed by document ID.
+        """
+        generation = self.generation
+        rows, row_scores = self.row_scores_of_parsed_query(parsed_query, k, generation)
+        return dict(zip(np.asarray(generation.doc_ids[rows], dtype=np.int64).tolist(), row_scores.tolist()))
+
+    def row_scores_of_parsed_query(self, parsed_query: ParsedQuery, k: int = None,
+                                   generation: Generation = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the rows of the matching documents for a parsed query and their scores.
+        If k is given, only the k best rows are returned.
+        """
+        query_tokens = parsed_query.tokens
+        generation = self.generation if generation is None else generation
+        index = generation.index
+        # Restrict the candidates to the documents containing the phrases
+        allowed_rows = self.get_rows_matching_phrases(parsed_query.phrases, index) if parsed_query.phrases else None
+        static_scores, static_upper_bound = None, 0.0
+        if generation.page_ranks is not None:
+            static_scores = functools.partial(self.static_scores, generation=generation)
+            static_upper_bound = self.page_rank_weight
+        if self.ranker == "bm25f":
+            ranker = BM25FRanker(index, query_tokens)
+            if k is not None:
+                return ranker.top_k(k, allowed_rows, static_scores, static_upper_bound)
+            rows, row_scores = ranker.scores(allowed_rows)
+        elif k is not None:
+            ranker = TFIDFRanker(generation.vectorizers, generation.tfidf_matrices, query_tokens)
+            return ranker.top_k(k, allowed_rows, static_scores, static_upper_bound)
+        else:
+            # Get the document rows that match the query tokens
+            matched_rows = self.get_matches_for_query_tokens(query_tokens, allowed_rows, index)
+            # Scores of the documents based on the TF-IDF
+            rows, row_scores = TFIDFRanker(generation.vectorizers, generation.tfidf_matrices, query_tokens,
+                                           matched_rows).scores()
+        # Add the PageRank of the documents. top_k already added it.
+        if static_scores is not None and len(rows) > 0:
+            row_scores = row_scores + static_scores(rows)
+        return rows, row_scores
+
+    def ranking(self, query: str, k: int = None) -> tuple[list[str], np.ndarray]:
+        """
+        Returns the tokens of the query and the ranked document IDs.
+        Rankings are cached by the tokenized query.
+        If k is given, the ranking contains at least the k best documents.
+        """
+        parsed_query = parse_query(query)
+        key = parsed_query.key()
+        ranking = self.cache.get(key, k)
+        if ranking is None:
+            generation = self.generation
+            rows, row_scores = self.row_scores_of_parsed_query(parsed_query, k, generation)
+            ranked_rows, _ = rank_rows(rows, row_scores, k)
+            ranking = np.asarray(generation.doc_ids[ranked_rows], dtype=np.int64)
+            # A ranking of a generation swapped out meanwhile is not cached for the new one.
+            if self.generation is generation:
+                self.cache.put(key, ranking, k)
+        return parsed_query.tokens, ranking
+
+    @staticmethod
+    def fetch_documents_in_rank_order(ranked_ids: list[int]) -> list[Document]:
+        """
+        Fetches the documents of a result page and keeps the order of the ranking.
+
+        Only the columns shown in the results are selected: title, a snippet of the body
+        and the URL of the job that crawled the document, available as document.url.
+        """
+        documents = (Document
+                     .select(Document.id,
+                             Document.title,
+                             peewee.fn.SUBSTRING(Document.body, 1, SEARCH_RESULT_BODY_LENGTH).alias("body"),
+                             Document.relevant,
+                             Job.url)
+                     .join(Job, on=(Document.job_id == Job.id))
+                     .where(Document.id.in_(ranked_ids))
+                     .objects())
+        documents_by_id = {document.id: document for document in documents}
+        return [documents_by_id[doc_id] for doc_id in ranked_ids if doc_id in documents_by_id]
 
     def process_query(self, query: str, page=0, page_size=10) -> (list[str], list[Document]):
         """
-        Returns the tokens of the query and the documents that match the query.
+        Returns the tokens of the query and the documents of the requested page.
         The documents are ranked based on the TF-IDF.
         """
-        query_tokens, documents_id_mapped_to_scores = self.scores(query)
-        # Convert the document_ids array to a list
-        ranking = list(documents_id_mapped_to_scores.keys())
-        ranking.sort(reverse=True, key=lambda x: documents_id_mapped_to_scores[x])
-        # Retrieve the documents based on the ranked document IDs
-        documents = Document.select().where(Document.id.in_(ranking)).paginate(page + 1, page_size)
-        return query_tokens, list(documents)
+        k = (page + 1) * page_size if self.top_k else None
+        query_tokens, ranking = self.ranking(query, k)
+        # Retrieve only the documents of the requested page
+        page_ids = ranking[page * page_size:(page + 1) * page_size].tolist()
+        return query_tokens, self.fetch_documents_in_rank_order(page_ids)
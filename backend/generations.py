@@ -0,0 +1,124 @@
+"""
+backend/generations.py
+
+This module manages the generations of the index.
+
+A generation is a directory holding everything the backend ranks with: the inverted
+index, its delta segments, the TF-IDF vectorizers and the TF-IDF matrices. A rebuild
+writes a new generation next to the current one instead of overwriting it:
+
+    <INDEX_DIRECTORY>                       Symbolic link to the current generation.
+    <INDEX_DIRECTORY>.staging               Symbolic link to the generation being built, if any.
+    <INDEX_DIRECTORY>.generations/<name>/   The generations, named by their creation time.
+
+backend/build_index.py builds the index of a new generation and stages it,
+backend/build_metrics.py adds the TF-IDF vectorizers and matrices to the staged
+generation and publishes it. Publishing replaces the link atomically, so readers
+resolve either the old or the new generation, never a mix. The backend loads the
+new generation in the background and swaps it in, see backend/fused_ranker.py.
+The INDEX_KEEP_GENERATIONS newest generations are kept, older ones are deleted
+on publish.
+
+A directory at INDEX_DIRECTORY, from before generations were introduced, is
+moved into the generations directory on the first publish.
+"""
+import datetime
+import os
+import shutil
+
+from dotenv import load_dotenv
+
+from crawler import utils
+
+load_dotenv()
+LOG = utils.get_logger(__file__)
+INDEX_KEEP_GENERATIONS = int(os.getenv("INDEX_KEEP_GENERATIONS", "2"))
+
+
+def generations_directory(directory: str) -> str:
+    """
+    Returns the directory containing the generations of the index at directory.
+    """
+    return f"{os.path.normpath(directory)}.generations"
+
+
+def staging_link(directory: str) -> str:
+    """
+    Returns the path of the link to the staged generation of the index at directory.
+    """
+    return f"{os.path.normpath(directory)}.staging"
+
+
+def current_generation(directory: str) -> str:
+    """
+    Returns the directory of the current generation, resolving the link once.
+    Readers should open all files of a generation through this directory.
+    """
+    return os.path.realpath(directory)
+
+
+def staged_generation(directory: str) -> str | None:
+    """
+    Returns the directory of the staged generation, None if no generation is staged.
+    """
+    link = staging_link(directory)
+    return os.path.realpath(link) if os.path.islink(link) else None
+
+
+def new_generation(directory: str) -> str:
+    """
+    Creates the directory of a new generation and returns it.
+    """
+    name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    generation = os.path.join(generations_directory(directory), name)
+    utils.io.create_directory_if_not_exists(generation)
+    return generation
+
+
+def replace_link(link: str, target: str):
+    """
+    Points link to target atomically. The link is relative, so it survives moving the parent directory.
+    """
+    temporary_link = f"{link}.tmp"
+    if os.path.lexists(temporary_link):
+        os.remove(temporary_link)
+    os.symlink(os.path.relpath(target, os.path.dirname(os.path.abspath(link))), temporary_link)
+    os.replace(temporary_link, link)
+
+
+def stage_generation(generation: str, directory: str):
+    """
+    Marks a generation as staged, to be completed and published by the next build step.
+    """
+    replace_link(staging_link(directory), generation)
+    LOG.info(f"Staged generation {generation}")
+
+
+def delete_old_generations(directory: str, keep: int = INDEX_KEEP_GENERATIONS):
+    """
+    Deletes all but the keep newest generations. The current and the staged generation are never deleted.
+    """
+    parent = generations_directory(directory)
+    protected = {current_generation(directory), staged_generation(directory)}
+    names = sorted(os.listdir(parent), reverse=True)
+    for name in names[max(1, keep):]:
+        generation = os.path.join(parent, name)
+        if os.path.realpath(generation) not in protected:
+            shutil.rmtree(generation, ignore_errors=True)
+            LOG.info(f"Deleted generation {generation}")
+
+
+def publish_generation(generation: str, directory: str):
+    """
+    Makes a generation the current generation of the index at directory.
+    """
+    if os.path.isdir(directory) and not os.path.islink(directory):
+        legacy_generation = os.path.join(generations_directory(directory), "00000000-000000-000000")
+        utils.io.create_directory_if_not_exists(generations_directory(directory))
+        os.rename(directory, legacy_generation)
+        LOG.info(f"Moved the index {directory} to {legacy_generation}")
+    replace_link(directory, generation)
+    if staged_generation(directory) == os.path.realpath(generation):
+        os.remove(staging_link(directory))
+    LOG.info(f"Published generation {generation}")
+    delete_old_generations(directory)
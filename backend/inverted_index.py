@@ -0,0 +1,414 @@
+"""
+backend/inverted_index.py
+
+This module contains the on-disk format of the inverted index.
+
+The index is a directory. Every field (title, body, ...) owns a sorted term
+dictionary and one postings block:
+
+    manifest.json                   Fields, number of documents and average field lengths. Written last.
+    doc_ids.bin                     int64, row -> document ID.
+    <field>.terms.bin               uint8, UTF-8 bytes of all terms, sorted and concatenated.
+    <field>.term_offsets.npy        uint64, start of term i in <field>.terms.bin (#terms + 1 entries).
+    <field>.postings_offsets.npy    uint64, start of the postings of term i (#terms + 1 entries).
+    <field>.postings.bin            uint32, sorted unique document rows of all postings, concatenated.
+    <field>.frequencies.bin         uint32, term frequency of every posting.
+    <field>.positions_offsets.npy   uint64, start of the positions of term i (#terms + 1 entries).
+    <field>.positions.bin           uint32, token positions of every posting, concatenated.
+                                    Posting j of a term owns frequencies[j] positions.
+    <field>.lengths.bin             uint32, row -> number of tokens of the field in the document.
+
+Postings store document rows (positions in doc_ids.bin) instead of document IDs,
+so they fit into uint32 and can be used directly as row indices of per-field matrices.
+Token positions count the tokens of a field after tokenization, so a phrase is
+a run of consecutive positions.
+
+All arrays are opened memory-mapped, so several backend processes reading
+the same index share the page cache instead of each unpickling its own copy.
+"""
+import os
+
+import numpy as np
+
+from crawler import utils
+
+LOG = utils.get_logger(__file__)
+
+INDEX_FIELDS = ["title", "meta_description", "meta_keywords", "meta_author", "h1", "h2", "h3", "h4", "h5", "h6",
+                "body"]
+INDEX_FORMAT_VERSION = 3
+
+MANIFEST_FILE = "manifest.json"
+DOC_IDS_FILE = "doc_ids.bin"
+DOC_ID_DTYPE = np.int64
+ROW_DTYPE = np.uint32
+OFFSET_DTYPE = np.uint64
+
+
+def open_array(path: str, dtype) -> np.ndarray:
+    """
+    Opens a raw binary file as a read-only memory-mapped array.
+
+    Args:
+        path (str): Path to the binary file.
+        dtype: Numpy dtype of the stored values.
+
+    Returns:
+        np.ndarray: Memory-mapped array. Empty files give an empty array,
+        since they can not be memory-mapped.
+    """
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+def positions_match(positions: list[np.ndarray], slop: int) -> bool:
+    """
+    Checks if the positions of the tokens of a phrase form the phrase.
+
+    Args:
+        positions (list[np.ndarray]): Sorted positions of each phrase token in one document field.
+        slop (int): 0 for an exact phrase, otherwise the number of extra positions
+            allowed in the window containing all tokens.
+
+    Returns:
+        bool: True if the phrase occurs.
+    """
+    if slop == 0:
+        starts = np.asarray(positions[0], dtype=np.int64)
+        for offset, token_positions in enumerate(positions[1:], start=1):
+            starts = np.intersect1d(starts, np.asarray(token_positions, dtype=np.int64) - offset)
+        return len(starts) > 0
+    # Sliding window over all occurrences ordered by position.
+    occurrences = sorted((int(position), token) for token, token_positions in enumerate(positions)
+                         for position in token_positions)
+    window_size = len(positions) + slop
+    counts = [0] * len(positions)
+    covered, left = 0, 0
+    for position, token in occurrences:
+        counts[token] += 1
+        covered += counts[token] == 1
+        while occurrences[left][0] <= position - window_size:
+            left_token = occurrences[left][1]
+            counts[left_token] -= 1
+            covered -= counts[left_token] == 0
+            left += 1
+        if covered == len(positions):
+            return True
+    return False
+
+
+def index_version(directory: str) -> int:
+    """
+    Returns the modification time of the manifest of an index, None if there is no complete index.
+    The manifest is written last, so the version changes with every rebuild.
+    """
+    try:
+        return os.stat(os.path.join(directory, MANIFEST_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class FieldIndexWriter:
+    """
+    Streams the term dictionary and postings of one field to disk.
+    Terms must be added in sorted order.
+    The length of the field in each document is the sum of the term frequencies of the document.
+    """
+
+    def __init__(self, directory: str, field: str, num_documents: int = 0):
+        self.directory = directory
+        self.field = field
+        self.lengths = np.zeros(num_documents, dtype=ROW_DTYPE)
+        self.total_length = 0
+        self.terms_file = open(os.path.join(directory, f"{field}.terms.bin"), "wb")
+        self.postings_file = open(os.path.join(directory, f"{field}.postings.bin"), "wb")
+        self.frequencies_file = open(os.path.join(directory, f"{field}.frequencies.bin"), "wb")
+        self.positions_file = open(os.path.join(directory, f"{field}.positions.bin"), "wb")
+        self.term_offsets = [0]
+        self.postings_offsets = [0]
+        self.positions_offsets = [0]
+        self.last_term = None
+
+    def add(self, term: str, rows: np.ndarray, positions: list[np.ndarray]):
+        """
+        Appends a term and its postings.
+
+        Args:
+            term (str): The term. Must be larger than the previously added term.
+            rows (np.ndarray): Sorted unique document rows containing the term.
+            positions (list[np.ndarray]): Sorted token positions of the term, one array per row.
+        """
+        frequencies = np.fromiter((len(row_positions) for row_positions in positions), dtype=ROW_DTYPE,
+                                  count=len(positions))
+        all_positions = np.concatenate([np.asarray(row_positions, dtype=ROW_DTYPE) for row_positions in positions]) \
+            if len(positions) > 0 else np.empty(0, dtype=ROW_DTYPE)
+        self.add_postings(term, rows, frequencies, all_positions)
+
+    def add_postings(self, term: str, rows: np.ndarray, frequencies: np.ndarray, positions: np.ndarray):
+        """
+        Appends a term and its postings given as flat arrays, like they are stored.
+
+        Args:
+            term (str): The term. Must be larger than the previously added term.
+            rows (np.ndarray): Sorted unique document rows containing the term.
+            frequencies (np.ndarray): Term frequency of each row.
+            positions (np.ndarray): Token positions of all rows, concatenated. Row j owns frequencies[j] positions.
+        """
+        if self.last_term is not None and term <= self.last_term:
+            raise ValueError(f"Terms of field {self.field} must be added in sorted order: {self.last_term} >= {term}")
+        self.last_term = term
+        encoded_term = term.encode("utf-8")
+        self.terms_file.write(encoded_term)
+        self.term_offsets.append(self.term_offsets[-1] + len(encoded_term))
+        rows = np.asarray(rows, dtype=ROW_DTYPE)
+        self.postings_file.write(rows.tobytes())
+        self.postings_offsets.append(self.postings_offsets[-1] + len(rows))
+        frequencies = np.asarray(frequencies, dtype=ROW_DTYPE)
+        self.frequencies_file.write(frequencies.tobytes())
+        if len(rows) > 0 and rows[-1] >= len(self.lengths):
+            self.lengths = np.concatenate((self.lengths,
+                                           np.zeros(int(rows[-1]) + 1 - len(self.lengths), dtype=ROW_DTYPE)))
+        self.lengths[rows] += frequencies
+        self.positions_file.write(np.asarray(positions, dtype=ROW_DTYPE).tobytes())
+        self.positions_offsets.append(self.positions_offsets[-1] + len(positions))
+
+    def close(self):
+        """
+        Flushes the postings and writes the offset tables and the field lengths.
+        """
+        self.terms_file.close()
+        self.postings_file.close()
+        self.frequencies_file.close()
+        self.positions_file.close()
+        np.save(os.path.join(self.directory, f"{self.field}.term_offsets.npy"),
+                np.asarray(self.term_offsets, dtype=OFFSET_DTYPE))
+        np.save(os.path.join(self.directory, f"{self.field}.postings_offsets.npy"),
+                np.asarray(self.postings_offsets, dtype=OFFSET_DTYPE))
+        np.save(os.path.join(self.directory, f"{self.field}.positions_offsets.npy"),
+                np.asarray(self.positions_offsets, dtype=OFFSET_DTYPE))
+        with open(os.path.join(self.directory, f"{self.field}.lengths.bin"), "wb") as file:
+            file.write(self.lengths.tobytes())
+        self.total_length = int(self.lengths.sum(dtype=np.uint64))
+
+
+class IndexWriter:
+    """
+    Writes an inverted index directory.
+    """
+
+    def __init__(self, directory: str, fields: list[str] = None):
+        self.directory = directory
+        self.fields = INDEX_FIELDS if fields is None else fields
+        self.num_documents = 0
+        self.field_writers: list[FieldIndexWriter] = []
+        utils.io.create_directory_if_not_exists(directory)
+        utils.io.delete_file(os.path.join(directory, MANIFEST_FILE))
+
+    def write_doc_ids(self, doc_ids: list[int]):
+        """
+        Writes the mapping from document rows to document IDs.
+        """
+        with open(os.path.join(self.directory, DOC_IDS_FILE), "wb") as file:
+            file.write(np.asarray(doc_ids, dtype=DOC_ID_DTYPE).tobytes())
+        self.num_documents = len(doc_ids)
+
+    def field_writer(self, field: str) -> FieldIndexWriter:
+        """
+        Returns a writer for the postings of a field.
+        """
+        writer = FieldIndexWriter(self.directory, field, self.num_documents)
+        self.field_writers.append(writer)
+        return writer
+
+    def write_field(self, field: str, postings: dict[str, dict[int, list[int]]]):
+        """
+        Writes the postings of a field held in memory.
+
+        Args:
+            field (str): Name of the field.
+            postings (dict): Maps each term to its document rows, each row to the token positions of the term.
+        """
+        writer = self.field_writer(field)
+        for term in sorted(postings):
+            rows = sorted(postings[term])
+            writer.add(term, rows, [postings[term][row] for row in rows])
+        writer.close()
+
+    def commit(self, num_documents: int):
+        """
+        Writes the manifest. An index without manifest is incomplete.
+        """
+        total_lengths = {writer.field: writer.total_length for writer in self.field_writers}
+        utils.io.write_json_file({
+            "version": INDEX_FORMAT_VERSION,
+            "fields": self.fields,
+            "num_documents": num_documents,
+            "average_lengths": {field: total_lengths.get(field, 0) / max(1, num_documents) for field in self.fields},
+        }, os.path.join(self.directory, MANIFEST_FILE))
+
+
+class FieldIndex:
+    """
+    Read-only view of the term dictionary and postings of one field.
+    """
+
+    def __init__(self, directory: str, field: str, average_length: float = 0.0):
+        self.field = field
+        self.average_length = average_length
+        self.terms = open_array(os.path.join(directory, f"{field}.terms.bin"), np.uint8)
+        self.term_offsets = np.load(os.path.join(directory, f"{field}.term_offsets.npy"), mmap_mode="r")
+        self.postings_offsets = np.load(os.path.join(directory, f"{field}.postings_offsets.npy"), mmap_mode="r")
+        self.postings = open_array(os.path.join(directory, f"{field}.postings.bin"), ROW_DTYPE)
+        self.frequencies = open_array(os.path.join(directory, f"{field}.frequencies.bin"), ROW_DTYPE)
+        self.positions_offsets = np.load(os.path.join(directory, f"{field}.positions_offsets.npy"), mmap_mode="r")
+        self.positions = open_array(os.path.join(directory, f"{field}.positions.bin"), ROW_DTYPE)
+        self.lengths = open_array(os.path.join(directory, f"{field}.lengths.bin"), ROW_DTYPE)
+
+    def __len__(self) -> int:
+        return len(self.term_offsets) - 1
+
+    def term_bytes(self, term_id: int) -> bytes:
+        """
+        Returns the UTF-8 bytes of the term with the given ID.
+        """
+        return self.terms[self.term_offsets[term_id]:self.term_offsets[term_id + 1]].tobytes()
+
+    def term(self, term_id: int) -> str:
+        """
+        Returns the term with the given ID.
+        """
+        return self.term_bytes(term_id).decode("utf-8")
+
+    def find(self, token: str) -> int:
+        """
+        Binary searches the sorted term dictionary.
+
+        Returns:
+            int: The term ID of the token, -1 if the token is not indexed.
+        """
+        encoded_token = token.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.term_bytes(middle) < encoded_token:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.term_bytes(low) == encoded_token:
+            return low
+        return -1
+
+    def postings_at(self, term_id: int) -> np.ndarray:
+        """
+        Returns the document rows of the term with the given ID.
+        """
+        return self.postings[self.postings_offsets[term_id]:self.postings_offsets[term_id + 1]]
+
+    def frequencies_at(self, term_id: int) -> np.ndarray:
+        """
+        Returns the term frequencies of the postings of the term with the given ID.
+        """
+        return self.frequencies[self.postings_offsets[term_id]:self.postings_offsets[term_id + 1]]
+
+    def positions_at(self, term_id: int, rows: np.ndarray) -> list[np.ndarray]:
+        """
+        Returns the token positions of the term with the given ID in the given document rows.
+        All rows must contain the term.
+        """
+        frequencies = self.frequencies_at(term_id)
+        starts = np.concatenate((np.zeros(1, dtype=OFFSET_DTYPE), np.cumsum(frequencies, dtype=OFFSET_DTYPE)))
+        starts += self.positions_offsets[term_id]
+        posting_indices = np.searchsorted(self.postings_at(term_id), rows)
+        return [self.positions[starts[i]:starts[i + 1]] for i in posting_indices]
+
+    def phrase_matches(self, tokens: list[str], slop: int = 0) -> np.ndarray:
+        """
+        Returns the document rows containing the tokens as a phrase.
+
+        Args:
+            tokens (list[str]): Tokens of the phrase.
+            slop (int): 0 for an exact phrase. Otherwise, the tokens must occur in any order
+                inside a window of len(tokens) + slop consecutive positions.
+
+        Returns:
+            np.ndarray: Sorted document rows.
+        """
+        term_ids = [self.find(token) for token in tokens]
+        if len(term_ids) == 0 or min(term_ids) < 0:
+            return np.empty(0, dtype=ROW_DTYPE)
+        rows = self.postings_at(term_ids[0])
+        for term_id in term_ids[1:]:
+            rows = np.intersect1d(rows, self.postings_at(term_id), assume_unique=True)
+        if len(term_ids) == 1 or len(rows) == 0:
+            return np.asarray(rows, dtype=ROW_DTYPE)
+        positions = [self.positions_at(term_id, rows) for term_id in term_ids]
+        matches = [row for i, row in enumerate(rows)
+                   if positions_match([term_positions[i] for term_positions in positions], slop)]
+        return np.asarray(matches, dtype=ROW_DTYPE)
+
+    def get(self, token: str, default=None):
+        """
+        Returns the document rows of a token or the default value if the token is not indexed.
+        """
+        term_id = self.find(token)
+        if term_id < 0:
+            return default
+        return self.postings_at(term_id)
+
+    def postings_with_frequencies(self, token: str) -> tuple[np.ndarray, np.ndarray] | None:
+        """
+        Returns the document rows of a token and its term frequencies, or None if the token is not indexed.
+        """
+        term_id = self.find(token)
+        if term_id < 0:
+            return None
+        return self.postings_at(term_id), self.frequencies_at(term_id)
+
+    def lengths_of(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the number of tokens of the field in the documents of the rows.
+        """
+        return self.lengths[rows]
+
+    def __contains__(self, token: str) -> bool:
+        return self.find(token) >= 0
+
+    def __getitem__(self, token: str) -> np.ndarray:
+        postings = self.get(token)
+        if postings is None:
+            raise KeyError(token)
+        return postings
+
+    def __iter__(self):
+        for term_id in range(len(self)):
+            yield self.term(term_id)
+
+
+class InvertedIndex:
+    """
+    Read-only, memory-mapped inverted index over all fields.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.manifest = utils.io.read_json_file(os.path.join(directory, MANIFEST_FILE))
+        if self.manifest["version"] != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Index {directory} has format version {self.manifest['version']}, "
+                             f"expected {INDEX_FORMAT_VERSION}. Rebuild the index.")
+        self.doc_ids = open_array(os.path.join(directory, DOC_IDS_FILE), DOC_ID_DTYPE)
+        average_lengths = self.manifest["average_lengths"]
+        self.fields = {field: FieldIndex(directory, field, average_lengths[field]) for field in self.manifest["fields"]}
+
+    @property
+    def num_documents(self) -> int:
+        """
+        Returns the number of indexed documents.
+        """
+        return len(self.doc_ids)
+
+    def items(self):
+        """
+        Iterates over (field name, field index) pairs.
+        """
+        return self.fields.items()
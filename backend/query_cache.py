@@ -0,0 +1,150 @@
+"""
+backend/query_cache.py
+
+This module caches the rankings of queries.
+
+A ranking is the array of ranked document IDs of a query. The cache is keyed on the
+tokenized query, so queries differing only in case, stop words or inflection share
+an entry, and page 2, 3, ... of a query are served from the ranking of page 1.
+
+Entries are evicted least recently used first, once the cache holds more than
+QUERY_CACHE_MAX_ENTRIES rankings or more than QUERY_CACHE_MAX_BYTES bytes of document
+IDs, and expire after QUERY_CACHE_TTL seconds. The whole cache is dropped when
+the version of the index changes.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "10000"))
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "600"))
+
+
+class CachedRanking:
+    """
+    A cached ranking.
+    If the ranking was cut after k documents, it can only serve requests for at most k documents.
+    """
+
+    def __init__(self, ranking: np.ndarray, k: int, expires_at: float):
+        self.ranking = ranking
+        self.complete = k is None or len(ranking) < k
+        self.k = k
+        self.expires_at = expires_at
+
+    def covers(self, k: int) -> bool:
+        """
+        Returns true if the ranking contains the first k documents.
+        """
+        return self.complete or (k is not None and k <= self.k)
+
+
+class QueryCache:
+    """
+    Thread-safe LRU cache of rankings with time-to-live and a memory bound.
+    """
+
+    def __init__(self,
+                 version: Callable[[], Hashable] = lambda: None,
+                 max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+                 max_bytes: int = QUERY_CACHE_MAX_BYTES,
+                 ttl: float = QUERY_CACHE_TTL):
+        """
+        Args:
+            version (Callable): Returns the current version of the index. Entries of older versions are dropped.
+            max_entries (int): Maximum number of cached rankings.
+            max_bytes (int): Maximum number of bytes of all cached rankings.
+            ttl (float): Seconds after which a ranking expires.
+        """
+        self.version = version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, CachedRanking] = OrderedDict()
+        self.current_version = version()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def _remove(self, key: Hashable):
+        self.bytes -= self.entries.pop(key).ranking.nbytes
+
+    def _check_version(self):
+        version = self.version()
+        if version != self.current_version:
+            self.entries.clear()
+            self.bytes = 0
+            self.current_version = version
+            self.invalidations += 1
+
+    def get(self, key: Hashable, k: int = None) -> np.ndarray:
+        """
+        Returns the cached ranking of a query, or None.
+
+        Args:
+            key (Hashable): Key of the tokenized query.
+            k (int): Number of needed documents. None if the complete ranking is needed.
+        """
+        with self.lock:
+            self._check_version()
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None or not entry.covers(k):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.ranking
+
+    def put(self, key: Hashable, ranking: np.ndarray, k: int = None):
+        """
+        Caches the ranking of a query.
+
+        Args:
+            key (Hashable): Key of the tokenized query.
+            ranking (np.ndarray): Ranked document IDs.
+            k (int): Number of documents the ranking was cut after. None if the ranking is complete.
+        """
+        if ranking.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            self._check_version()
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = CachedRanking(ranking, k, time.monotonic() + self.ttl)
+            self.bytes += ranking.nbytes
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the cache for monitoring.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,79 @@
+"""
+backend/query_parser.py
+
+This module parses search queries.
+
+Quoted parts of a query are phrases. A phrase may be followed by ~n to turn it
+into a proximity query, e.g. "castle museum"~3 matches documents where both
+tokens occur inside a window of 2 + 3 consecutive token positions.
+"""
+import re
+
+from crawler import utils
+
+PHRASE_PATTERN = re.compile(r'"([^"]*)"(?:~(\d+))?')
+
+
+class Phrase:
+    """
+    Represents a phrase or proximity constraint of a query.
+    """
+
+    def __init__(self, tokens: list[str], slop: int = 0):
+        self.tokens = tokens
+        self.slop = slop
+
+    def __eq__(self, other):
+        return self.tokens == other.tokens and self.slop == other.slop
+
+    def __hash__(self):
+        return hash((tuple(self.tokens), self.slop))
+
+    def __str__(self):
+        return f"Phrase[tokens={self.tokens}, slop={self.slop}]"
+
+    def __repr__(self):
+        return str(self)
+
+
+class ParsedQuery:
+    """
+    Represents a parsed query.
+    The tokens contain all query tokens, including those of the phrases.
+    """
+
+    def __init__(self, tokens: list[str], phrases: list[Phrase]):
+        self.tokens = tokens
+        self.phrases = phrases
+
+    def key(self) -> tuple:
+        """
+        Returns a hashable key identifying the tokenized query.
+        """
+        return tuple(self.tokens), tuple((tuple(phrase.tokens), phrase.slop) for phrase in self.phrases)
+
+    def __str__(self):
+        return f"ParsedQuery[tokens={self.tokens}, phrases={self.phrases}]"
+
+    def __repr__(self):
+        return str(self)
+
+
+def parse_query(query: str) -> ParsedQuery:
+    """
+    Tokenizes a query and extracts its phrases.
+
+    Args:
+        query (str): The raw query.
+
+    Returns:
+        ParsedQuery: The tokens and phrases of the query. Phrases with less than one token
+        after tokenization, e.g. only stop words, are dropped.
+    """
+    phrases = []
+    for match in PHRASE_PATTERN.finditer(query):
+        tokens = utils.text.tokenize_query(match.group(1))
+        if len(tokens) > 0:
+            phrases.append(Phrase(tokens, int(match.group(2) or 0)))
+    text = PHRASE_PATTERN.sub(lambda match: f" {match.group(1)} ", query).replace('"', " ")
+    return ParsedQuery(utils.text.tokenize_query(text), phrases)
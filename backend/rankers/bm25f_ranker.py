@@ -0,0 +1,107 @@
+"""
+This module ranks documents with BM25F computed directly from the inverted index.
+
+The term frequencies of all fields are combined into one pseudo frequency per
+document before the saturation of BM25 is applied:
+
+    tf(t, d) = sum over fields f of w_f * tf_f(t, d) / (1 - b + b * length_f(d) / average_length_f)
+    score(d) = sum over query terms t of idf(t) * tf(t, d) / (k1 + tf(t, d))
+    idf(t) = log(1 + (N - df(t) + 0.5) / (df(t) + 0.5))
+
+where df(t) counts the documents containing t in any field. The field weights w_f
+mirror the weights of the TF-IDF vector spaces: the title weighs the most, the body the least.
+Unlike TFIDFRanker, no vectorizer and no document vectors are needed.
+"""
+import os
+from typing import Callable
+
+import numpy as np
+from dotenv import load_dotenv
+
+from backend.inverted_index import INDEX_FIELDS, InvertedIndex
+from backend.segments import SegmentedIndex
+from backend.rankers.max_score import TermPostings, max_score_top_k
+
+load_dotenv()
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+FIELD_WEIGHTS = dict(zip(INDEX_FIELDS, np.arange(1, len(INDEX_FIELDS) + 1)[::-1].tolist()))
+
+
+class BM25FRanker:
+    """
+    This class is responsible for ranking documents based on their BM25F scores.
+    """
+
+    def __init__(self, index: InvertedIndex | SegmentedIndex, query_tokens: list[str], saturation: float = BM25_K1,
+                 length_normalization: float = BM25_B):
+        """
+        Args:
+            index (InvertedIndex | SegmentedIndex): The inverted index, with the lengths of the fields.
+            query_tokens (list[str]): Tokens of the query.
+            saturation (float): k1, the saturation of the term frequencies.
+            length_normalization (float): b, the strength of the normalization by field length, between 0 and 1.
+        """
+        self.index = index
+        self.query_tokens = list(dict.fromkeys(query_tokens))
+        self.saturation = saturation
+        self.length_normalization = length_normalization
+
+    def term_postings(self, token: str) -> TermPostings | None:  # pylint: disable=too-many-locals
+        """
+        Returns the documents containing the token in any field and its BM25F contributions to them,
+        or None if no document contains the token.
+        """
+        rows, frequencies = [], []
+        for field, field_index in self.index.fields.items():
+            postings = field_index.postings_with_frequencies(token)
+            if postings is None:
+                continue
+            field_rows = np.asarray(postings[0], dtype=np.int64)
+            field_frequencies = np.asarray(postings[1], dtype=np.float64)
+            lengths = np.asarray(field_index.lengths_of(field_rows), dtype=np.float64)
+            normalization = 1 - self.length_normalization + \
+                self.length_normalization * lengths / max(field_index.average_length, 1e-9)
+            rows.append(field_rows)
+            frequencies.append(FIELD_WEIGHTS.get(field, 1) * field_frequencies / normalization)
+        if len(rows) == 0:
+            return None
+        unique_rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        pseudo_frequencies = np.bincount(inverse, weights=np.concatenate(frequencies))
+        document_frequency = len(unique_rows)
+        idf = np.log(1 + (self.index.num_documents - document_frequency + 0.5) / (document_frequency + 0.5))
+        contributions = idf * pseudo_frequencies / (self.saturation + pseudo_frequencies)
+        return TermPostings(float(contributions.max()), unique_rows, contributions)
+
+    def all_term_postings(self) -> list[TermPostings]:
+        """
+        Returns the postings of every query token contained in any document.
+        """
+        terms = [self.term_postings(token) for token in self.query_tokens]
+        return [term for term in terms if term is not None]
+
+    def scores(self, allowed_rows: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the matching document rows, sorted, and their scores.
+        If allowed_rows is given, only documents in these rows are scored.
+        """
+        terms = self.all_term_postings()
+        if len(terms) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        rows, inverse = np.unique(np.concatenate([term.rows for term in terms]), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate([term.contributions for term in terms]))
+        if allowed_rows is not None:
+            mask = np.isin(rows, allowed_rows)
+            rows, scores = rows[mask], scores[mask]
+        return rows, scores
+
+    def top_k(self, k: int, allowed_rows: np.ndarray = None,
+              static_scores: Callable[[np.ndarray], np.ndarray] = None,
+              static_upper_bound: float = 0.0) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the k best document rows and their scores, best first.
+        Uses MaxScore early termination instead of scoring every matching document.
+        The static scores, if given, are added to the scores of the matching documents.
+        """
+        return max_score_top_k(self.all_term_postings(), k, allowed_rows, static_scores, static_upper_bound)
@@ -0,0 +1,151 @@
+"""
+This module implements top-k retrieval with MaxScore early termination.
+
+Every query term comes with postings (document rows and their score contributions)
+and an upper bound of its contribution to any document. Terms are processed
+term-at-a-time in decreasing order of their upper bounds. As soon as the sum of the
+upper bounds of the remaining terms is below the current k-th best score, no
+unseen document can enter the top k anymore. From then on, only the documents
+already seen are scored, and documents which can not reach the k-th best score
+even with all remaining terms are dropped.
+
+Scores are only accumulated for the candidate documents, kept sorted by row, so a
+query costs nothing per document of the index. Once no unseen document can enter
+the top k, the postings of the remaining terms are not scanned anymore: the
+candidates are looked up in them by binary search.
+
+A query-independent static score, e.g. PageRank, may be added to every matching
+document. Its upper bound counts towards the upper bound of unseen documents.
+
+The result is exact: the same top k as scoring every matching document.
+"""
+from typing import Callable
+
+import numpy as np
+
+
+class TermPostings:
+    """
+    Postings of one query term.
+    """
+
+    def __init__(self, upper_bound: float, rows: np.ndarray, contributions: np.ndarray):
+        """
+        Args:
+            upper_bound (float): Upper bound of the contributions of the term.
+            rows (np.ndarray): Sorted unique document rows containing the term.
+            contributions (np.ndarray): Score contribution of the term to each row.
+        """
+        self.upper_bound = upper_bound
+        self.rows = rows
+        self.contributions = contributions
+
+
+def kth_largest(scores: np.ndarray, k: int) -> float:
+    """
+    Returns the k-th largest score, or -inf if there are less than k scores.
+    """
+    if len(scores) < k:
+        return -np.inf
+    return float(np.partition(scores, len(scores) - k)[len(scores) - k])
+
+
+def rank_rows(rows: np.ndarray, scores: np.ndarray, k: int = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the k best rows and their scores, best first, or all rows if k is None.
+    Ties are broken by the lower row. Only the k best are sorted: they are
+    selected with np.argpartition first.
+    """
+    if k is not None and k < len(scores):
+        kth_best = scores[np.argpartition(-scores, k - 1)[k - 1]] if k > 0 else np.inf
+        # Keep every row tied with the k-th best, so that ties are broken by row.
+        selected = np.flatnonzero(scores >= kth_best)
+        rows, scores = rows[selected], scores[selected]
+    order = np.lexsort((rows, -scores))[:k]
+    return rows[order], scores[order]
+
+
+def find_rows(sorted_rows: np.ndarray, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Looks up rows in sorted unique rows by binary search.
+
+    Returns:
+        (np.ndarray, np.ndarray): The position of each row in sorted_rows, and whether it was found there.
+    """
+    positions = np.searchsorted(sorted_rows, rows)
+    found = positions < len(sorted_rows)
+    found[found] = sorted_rows[positions[found]] == rows[found]
+    return positions, found
+
+
+def merge_postings(candidates: np.ndarray, scores: np.ndarray,
+                   rows: np.ndarray, contributions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Adds postings to the sorted candidates and their scores.
+
+    Returns:
+        (np.ndarray, np.ndarray): The sorted union of the candidates and rows, and their scores.
+    """
+    merged = np.concatenate((candidates, rows))
+    merged_scores = np.concatenate((scores, contributions)).astype(np.float64, copy=False)
+    if len(merged) == 0:
+        return merged, merged_scores
+    # Both are sorted, which a stable sort merges in about linear time.
+    order = np.argsort(merged, kind="stable")
+    merged, merged_scores = merged[order], merged_scores[order]
+    starts = np.flatnonzero(np.concatenate(([True], merged[1:] != merged[:-1])))
+    return merged[starts], np.add.reduceat(merged_scores, starts)
+
+
+def max_score_top_k(terms: list[TermPostings], k: int, allowed_rows: np.ndarray = None,  # pylint: disable=too-many-locals
+                    static_scores: Callable[[np.ndarray], np.ndarray] = None,
+                    static_upper_bound: float = 0.0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the k best documents.
+
+    Args:
+        terms (list[TermPostings]): Postings of the query terms.
+        k (int): Number of documents to return.
+        allowed_rows (np.ndarray): If given, only these document rows are considered.
+        static_scores (Callable[[np.ndarray], np.ndarray]): If given, returns the non-negative
+            static scores of document rows, which are added to the scores of the matching documents.
+        static_upper_bound (float): Upper bound of the static scores.
+
+    Returns:
+        (np.ndarray, np.ndarray): Document rows and their scores, best first.
+    """
+    terms = sorted(terms, key=lambda term: term.upper_bound, reverse=True)
+    # remaining[i] bounds what the terms i, i + 1, ... can add to a document.
+    remaining = np.concatenate((np.cumsum([term.upper_bound for term in terms][::-1])[::-1], [0.0]))
+    if static_scores is not None:
+        remaining += static_upper_bound
+    if allowed_rows is not None:
+        allowed_rows = np.unique(allowed_rows)
+    candidates = np.empty(0, dtype=np.int64)
+    accumulators = np.empty(0, dtype=np.float64)
+    admitting = True
+    for i, term in enumerate(terms):
+        if admitting:
+            rows, contributions = term.rows, term.contributions
+            if allowed_rows is not None:
+                _, mask = find_rows(allowed_rows, rows)
+                rows, contributions = rows[mask], contributions[mask]
+            candidates, accumulators = merge_postings(candidates, accumulators, rows, contributions)
+        elif len(candidates) <= len(term.rows):
+            # Look up the candidates in the postings instead of scanning them.
+            positions, found = find_rows(term.rows, candidates)
+            accumulators[found] += term.contributions[positions[found]]
+        else:
+            positions, found = find_rows(candidates, term.rows)
+            accumulators[positions[found]] += term.contributions[found]
+        threshold = kth_largest(accumulators, k)
+        if admitting and remaining[i + 1] < threshold:
+            admitting = False
+        if not admitting:
+            # Drop the candidates which can not reach the k-th best score anymore.
+            keep = accumulators + remaining[i + 1] >= threshold
+            candidates, accumulators = candidates[keep], accumulators[keep]
+    scores = accumulators
+    if static_scores is not None:
+        scores = scores + static_scores(candidates)
+    return rank_rows(candidates, scores, k)
@@ -1,25 +1,36 @@
-from collections import defaultdict
+from typing import Callable
 
 import numpy as np
+from scipy.sparse import csr_matrix
 from sklearn.feature_extraction.text import TfidfVectorizer
 
-from backend.vector_spaces.tfidf import read_tfidf_vectorizers, Tfidf, TFIDF_CANONICAL_ORDERING
+from backend.rankers.max_score import TermPostings, max_score_top_k
+from backend.vector_spaces.tfidf import TFIDF_CANONICAL_ORDERING, TFIDFMatrices
 from crawler import utils
 
 LOG = utils.get_logger(__file__)
 
-VECTORIZERS: dict[str, TfidfVectorizer] = read_tfidf_vectorizers()
-VECTOR_SPACE_WEIGHTS = dict(zip(TFIDF_CANONICAL_ORDERING, np.arange(1, len(VECTORIZERS) + 1)[::-1]))
+VECTOR_SPACE_WEIGHTS = dict(zip(TFIDF_CANONICAL_ORDERING, np.arange(1, len(TFIDF_CANONICAL_ORDERING) + 1)[::-1]))
 
 
 class TFIDFRanker:
     """
     This class is responsible for ranking documents based on their TF-IDF scores.
     """
-    def __init__(self, query_tokens: list[str], matches_in_vector_spaces: dict[str, list[int]]):
+    def __init__(self, vectorizers: dict[str, TfidfVectorizer], matrices: TFIDFMatrices, query_tokens: list[str],
+                 matches_in_vector_spaces: dict[str, np.ndarray] = None):
+        """
+        Args:
+            vectorizers (dict[str, TfidfVectorizer]): TF-IDF vectorizers of the index, see read_tfidf_vectorizers.
+            matrices (TFIDFMatrices): TF-IDF matrices of the segments of the index.
+            query_tokens (list[str]): Tokens of the query.
+            matches_in_vector_spaces (dict[str, np.ndarray]): Matched document rows of the inverted index,
+                grouped by vector space. Not needed for top_k.
+        """
+        self.vectorizers = vectorizers
+        self.matrices = matrices
         self.query_tokens = query_tokens
-        self.matches_in_vector_spaces = matches_in_vector_spaces
-        self.final_scores = defaultdict(float)
+        self.matches_in_vector_spaces = {} if matches_in_vector_spaces is None else matches_in_vector_spaces
 
     @staticmethod
     def query_document_similarities_in_all_vector_spaces(query_vectors: list[np.array],
@@ -30,45 +41,71 @@ class TFIDFRanker:
         return np.array([np.dot(query_vector, document_vector) for query_vector, document_vector in
                          zip(query_vectors, document_vectors)])
 
-    @staticmethod
-    def map_query_to_vector_spaces(query_tokens: list[str]) -> dict[str, np.array]:
+    def map_query_to_vector_spaces(self, query_tokens: list[str]) -> dict[str, np.array]:
         """
         Returns the query tokens mapped to the vector spaces.
         """
         ret = {}
-        for name, vectorizer in VECTORIZERS.items():
+        for name, vectorizer in self.vectorizers.items():
             try:
                 ret[name] = vectorizer.transform([" ".join(query_tokens)])[0]
             except Exception as exception:
                 LOG.error(f"Error while transforming query into vector space '{name}': {exception}")
         return ret
 
-    def update_scores_of_matches_with_new_vector_space(self,
-                                                       query_vector: np.array,
-                                                       matches: list[int],
-                                                       vector_space_name: str):
+    def vector_space_scores(self, query_vector: csr_matrix, rows: np.ndarray, vector_space_name: str) -> np.ndarray:
         """
-        Updates the scores of the matches with the new vector space.
+        Returns the weighted cosine similarities of the query and the documents in the rows in one vector space.
+        All rows are scored with a single sparse matrix-vector product.
         """
-        tfidfs = Tfidf.select().where(Tfidf.id.in_(matches))
         weight = VECTOR_SPACE_WEIGHTS[vector_space_name]
-        for tfidf in tfidfs:
-            doc_vectors = tfidf.not_null_vectors()
-            if vector_space_name in doc_vectors:
-                doc_vector = doc_vectors[vector_space_name]
-                LOG.info(f"Cosine similarity of {query_vector.shape=}, {type(query_vector)=}, {doc_vector.shape=}, {type(doc_vector)=}")
-                cosine_sim = query_vector.multiply(doc_vector).sum()
-                LOG.info(f"{cosine_sim.shape=}, {type(cosine_sim)=}")
-                self.final_scores[tfidf.id] += weight * cosine_sim
+        return weight * (self.matrices.rows(vector_space_name, rows) @ query_vector.T).toarray().ravel()
 
-    def scores(self) -> dict[int, float]:
+    def scores(self) -> tuple[np.ndarray, np.ndarray]:
         """
-        Returns the final scores of the documents.
+        Returns the matched document rows, sorted, and their final scores:
+        the weighted sum of the scores in the vector spaces in which they matched.
         """
         query_vectors = self.map_query_to_vector_spaces(self.query_tokens)
-        for vector_space_name, matches_in_vector_space in self.matches_in_vector_spaces.items():
-            if vector_space_name in query_vectors:
-                self.update_scores_of_matches_with_new_vector_space(query_vectors[vector_space_name],
-                                                                    matches_in_vector_space,
-                                                                    vector_space_name)
-        return self.final_scores
+        matches = {name: np.unique(np.asarray(rows, dtype=np.int64))
+                   for name, rows in self.matches_in_vector_spaces.items()
+                   if name in query_vectors and name in self.matrices and len(rows) > 0}
+        if len(matches) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        candidates = np.unique(np.concatenate(list(matches.values())))
+        final_scores = np.zeros(len(candidates), dtype=np.float64)
+        for vector_space_name, rows in matches.items():
+            final_scores[np.searchsorted(candidates, rows)] += \
+                self.vector_space_scores(query_vectors[vector_space_name], rows, vector_space_name)
+        return candidates, final_scores
+
+    def term_postings(self) -> list[TermPostings]:
+        """
+        Returns the weighted postings of every term of the query vectors in every vector space.
+        The contribution of a term to a document is the field weight times the
+        query weight times the document weight of the term.
+        """
+        terms = []
+        for vector_space_name, query_vector in self.map_query_to_vector_spaces(self.query_tokens).items():
+            if vector_space_name not in self.matrices:
+                continue
+            weight = VECTOR_SPACE_WEIGHTS[vector_space_name]
+            for column, query_weight in zip(query_vector.indices.tolist(), query_vector.data.tolist()):
+                rows, weights = self.matrices.postings(vector_space_name, column)
+                if len(rows) == 0:
+                    continue
+                impact = weight * query_weight
+                terms.append(TermPostings(upper_bound=impact * self.matrices.max_weight(vector_space_name, column),
+                                          rows=rows,
+                                          contributions=impact * np.asarray(weights, dtype=np.float64)))
+        return terms
+
+    def top_k(self, k: int, allowed_rows: np.ndarray = None,
+              static_scores: Callable[[np.ndarray], np.ndarray] = None,
+              static_upper_bound: float = 0.0) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the k best document rows and their scores, best first.
+        Uses MaxScore early termination instead of scoring every matching document.
+        The static scores, if given, are added to the scores of the matching documents.
+        """
+        return max_score_top_k(self.term_postings(), k, allowed_rows, static_scores, static_upper_bound)
@@ -0,0 +1,183 @@
+"""
+backend/segments.py
+
+This module contains the log-structured segments of the inverted index.
+
+The index built by backend/build_index.py is the base segment. Documents crawled
+afterwards are indexed by backend/update_index.py into small delta segments, which
+are index directories in the format described in backend/inverted_index.py, inside the
+current generation of the index, see backend/generations.py:
+
+    <INDEX_DIRECTORY>/segments.json             Names of the delta segments, oldest first, and the
+                                                high-water mark: the highest indexed document ID.
+    <INDEX_DIRECTORY>/segments/<name>/          A delta segment, with the TF-IDF matrices of its documents.
+
+The rows of the segments are stacked in this order: the rows of a delta segment follow
+the rows of all older segments. Rows are only ever appended, also when delta segments
+are merged, so a row keeps its document while the backend switches to newer segments.
+"""
+import os
+
+import numpy as np
+
+from backend.inverted_index import ROW_DTYPE, FieldIndex, InvertedIndex
+from crawler import utils
+
+LOG = utils.get_logger(__file__)
+
+SEGMENTS_FILE = "segments.json"
+SEGMENTS_DIRECTORY = "segments"
+
+
+def read_segments_manifest(directory: str) -> dict:
+    """
+    Reads the list of delta segments of an index.
+    An index without segments.json has no delta segments and its high-water mark is
+    the highest document ID of the base segment.
+    """
+    path = os.path.join(directory, SEGMENTS_FILE)
+    if os.path.exists(path):
+        return utils.io.read_json_file(path)
+    doc_ids = InvertedIndex(directory).doc_ids
+    return new_segments_manifest(int(doc_ids[-1]) if len(doc_ids) > 0 else 0)
+
+
+def new_segments_manifest(high_water_mark: int) -> dict:
+    """
+    Returns the list of delta segments of an index without delta segments.
+    """
+    return {"deltas": [], "high_water_mark": high_water_mark, "next_segment": 0}
+
+
+def write_segments_manifest(directory: str, manifest: dict):
+    """
+    Replaces the list of delta segments atomically, so readers never see a partial file.
+    """
+    path = os.path.join(directory, SEGMENTS_FILE)
+    temporary_path = f"{path}.tmp"
+    utils.io.write_json_file(manifest, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def segments_version(directory: str) -> int:
+    """
+    Returns the modification time of segments.json, None if the index has no delta segments yet.
+    """
+    try:
+        return os.stat(os.path.join(directory, SEGMENTS_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def segment_directories(directory: str, manifest: dict = None) -> list[str]:
+    """
+    Returns the directories of the base segment and of the delta segments, in the order of their rows.
+    """
+    if manifest is None:
+        if segments_version(directory) is None:
+            return [directory]
+        manifest = read_segments_manifest(directory)
+    return [directory] + [os.path.join(directory, SEGMENTS_DIRECTORY, name) for name in manifest["deltas"]]
+
+
+class SegmentedFieldIndex:
+    """
+    Read-only view of one field over all segments, with the rows of the segments stacked.
+    Offers the token-based methods of FieldIndex.
+    """
+
+    def __init__(self, fields: list[FieldIndex], row_offsets: list[int], num_documents: list[int]):
+        self.field = fields[0].field
+        self.fields = fields
+        self.row_offsets = row_offsets
+        self.average_length = float(np.average([field.average_length for field in fields], weights=num_documents)) \
+            if sum(num_documents) > 0 else 0.0
+
+    def stack(self, rows_of_segments: list[np.ndarray]) -> np.ndarray:
+        """
+        Concatenates the rows of each segment, shifted by the first row of the segment.
+        """
+        return np.concatenate([np.asarray(rows, dtype=np.int64) + offset
+                               for rows, offset in zip(rows_of_segments, self.row_offsets)]).astype(ROW_DTYPE)
+
+    def get(self, token: str, default=None):
+        """
+        Returns the document rows of a token or the default value if the token is not indexed.
+        """
+        postings = [field.get(token, np.empty(0, dtype=ROW_DTYPE)) for field in self.fields]
+        if all(len(rows) == 0 for rows in postings):
+            return default
+        return self.stack(postings)
+
+    def postings_with_frequencies(self, token: str) -> tuple[np.ndarray, np.ndarray] | None:
+        """
+        Returns the document rows of a token and its term frequencies, or None if the token is not indexed.
+        """
+        postings = [field.postings_with_frequencies(token) for field in self.fields]
+        if all(posting is None for posting in postings):
+            return None
+        empty = (np.empty(0, dtype=ROW_DTYPE), np.empty(0, dtype=ROW_DTYPE))
+        postings = [empty if posting is None else posting for posting in postings]
+        return self.stack([rows for rows, _ in postings]), np.concatenate([frequencies for _, frequencies in postings])
+
+    def lengths_of(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the number of tokens of the field in the documents of the rows.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        segments = np.searchsorted(self.row_offsets, rows, side="right") - 1
+        lengths = np.empty(len(rows), dtype=ROW_DTYPE)
+        for segment, (field, offset) in enumerate(zip(self.fields, self.row_offsets)):
+            in_segment = segments == segment
+            lengths[in_segment] = field.lengths_of(rows[in_segment] - offset)
+        return lengths
+
+    def phrase_matches(self, tokens: list[str], slop: int = 0) -> np.ndarray:
+        """
+        Returns the sorted document rows containing the tokens as a phrase.
+        """
+        return self.stack([field.phrase_matches(tokens, slop) for field in self.fields])
+
+    def __contains__(self, token: str) -> bool:
+        return any(token in field for field in self.fields)
+
+
+class SegmentedIndex:
+    """
+    Read-only view of the base segment and the delta segments of an index, with their rows stacked.
+    Offers the same attributes as InvertedIndex.
+    """
+
+    def __init__(self, segments: list[InvertedIndex]):
+        self.segments = segments
+        num_documents = [segment.num_documents for segment in segments]
+        self.row_offsets = np.cumsum([0] + num_documents[:-1]).tolist()
+        self.doc_ids = np.concatenate([segment.doc_ids for segment in segments])
+        self.fields = {field: SegmentedFieldIndex([segment.fields[field] for segment in segments],
+                                                  self.row_offsets, num_documents)
+                       for field in segments[0].fields}
+
+    @property
+    def num_documents(self) -> int:
+        """
+        Returns the number of indexed documents of all segments.
+        """
+        return len(self.doc_ids)
+
+    def items(self):
+        """
+        Iterates over (field name, field index) pairs.
+        """
+        return self.fields.items()
+
+
+def read_segmented_index(directory: str, manifest: dict = None) -> InvertedIndex | SegmentedIndex:
+    """
+    Opens the base segment and the delta segments of an index memory-mapped.
+    Without delta segments, the base segment is returned as is.
+    """
+    directories = segment_directories(directory, manifest)
+    if len(directories) == 1:
+        return InvertedIndex(directory)
+    LOG.info(f"Opening the index {directory} with {len(directories) - 1} delta segments")
+    return SegmentedIndex([InvertedIndex(segment_directory) for segment_directory in directories])
@@ -1,38 +1,148 @@
 """
 Streamers for streaming sentences from relevant documents.
+
+Documents are read in chunks of DOCUMENT_STREAM_CHUNK_SIZE documents with keyset
+pagination, WHERE id > <last ID of the previous chunk> ORDER BY id LIMIT <chunk size>,
+so every chunk is one indexed range query, however deep into the table it starts.
+Only the requested columns are selected, the HTML and the token columns of other
+fields are not transferred. One pass can feed several consumers, see DocumentStreamer.feed.
+
+If the token store is configured, see crawler/utils/token_store.py, the token columns
+are not selected either: the tokens are read from the store. Only documents missing
+in the store, saved before it existed, are read from the JSON token columns.
 """
 import functools
+import operator
+import os
+from typing import Callable, Iterator
+
+import peewee
+from dotenv import load_dotenv
 from numpy.typing import ArrayLike
+
 from crawler.sql_models.document import Document
+from crawler.utils.token_store import TOKEN_FIELDS, TokenStore, shared_token_store
+
+load_dotenv()
+DOCUMENT_STREAM_CHUNK_SIZE = int(os.getenv("DOCUMENT_STREAM_CHUNK_SIZE", "1000"))
+TOKEN_COLUMNS = [f"{field}_tokens" for field in TOKEN_FIELDS]
 
 
-class DocumentStreamer:
+class DocumentStreamer:  # pylint: disable=too-many-instance-attributes
     """
     A class to stream sentences from models to avoid eager loading.
     """
 
-    def stream(self):
+    def database_chunks(self, columns: list[str] = None) -> Iterator[list[Document]]:
         """
-        Stream tokens from relevant documents.
+        Stream chunks of documents with the columns read from the database, all columns if None.
         :return: a generator
         """
+        fields = [Document.id] + [getattr(Document, column) for column in columns if column != "id"] \
+            if columns is not None else [Document]
         if self.ids is None:
-            for doc in Document.select().where(Document.relevant == True).iterator():
-                yield self.transform(doc)
+            condition = Document.relevant == True  # pylint: disable=singleton-comparison
+            if self.start_id is not None:
+                condition &= Document.id >= self.start_id
+            if self.end_id is not None:
+                condition &= Document.id < self.end_id
+            last_id = None
+            while True:
+                query = Document.select(*fields).where(condition if last_id is None else condition & (Document.id > last_id))
+                chunk = list(query.order_by(Document.id).limit(self.chunk_size))
+                if len(chunk) == 0:
+                    return
+                yield chunk
+                last_id = chunk[-1].id
         else:
-            for doc_id in self.ids:
-                doc = Document.get_by_id(doc_id)
+            ids = [int(doc_id) for doc_id in self.ids]
+            for start in range(0, len(ids), self.chunk_size):
+                chunk_ids = ids[start:start + self.chunk_size]
+                query = Document.select(*fields).where(Document.id.in_(chunk_ids))
+                documents = {doc.id: doc for doc in query.iterator()}
+                missing = [doc_id for doc_id in chunk_ids if doc_id not in documents]
+                if missing:
+                    raise peewee.DoesNotExist(f"Documents {missing} do not exist")
+                yield [documents[doc_id] for doc_id in chunk_ids]
+
+    def chunks(self) -> Iterator[list[Document]]:
+        """
+        Stream chunks of documents, ordered by ID, or in the order of ids if given.
+        :return: a generator
+        """
+        token_columns = TOKEN_COLUMNS if self.columns is None \
+            else [column for column in self.columns if column in TOKEN_COLUMNS]
+        if self.token_store is None or len(token_columns) == 0:
+            yield from self.database_chunks(self.columns)
+            return
+        columns = None if self.columns is None else [column for column in self.columns if column not in token_columns]
+        for chunk in self.database_chunks(columns):
+            self.read_tokens_from_store(chunk, token_columns, read_from_database=self.columns is None)
+            yield chunk
+
+    def read_tokens_from_store(self, chunk: list[Document], token_columns: list[str], read_from_database: bool):
+        """
+        Sets the token columns of the documents of a chunk from the token store.
+        The columns of documents missing in the store are read from the database, unless they already were.
+        """
+        rows = self.token_store.rows_of([document.id for document in chunk])
+        missing = [document.id for document, row in zip(chunk, rows) if row < 0]
+        # Documents saved after the store was opened have higher IDs than all documents in it.
+        if missing and (len(self.token_store) == 0 or max(missing) > self.token_store.sorted_ids[-1]) \
+                and self.token_store.refresh():
+            rows = self.token_store.rows_of([document.id for document in chunk])
+            missing = [document.id for document, row in zip(chunk, rows) if row < 0]
+        for document, row in zip(chunk, rows):
+            if row >= 0:
+                for column in token_columns:
+                    setattr(document, column, self.token_store.tokens_of(row, column.removesuffix("_tokens")))
+        if missing and not read_from_database:
+            fields = [getattr(Document, column) for column in token_columns]
+            query = Document.select(Document.id, *fields).where(Document.id.in_(missing))
+            documents = {document.id: document for document in query.iterator()}
+            for document, row in zip(chunk, rows):
+                if row < 0:
+                    for column in token_columns:
+                        setattr(document, column, getattr(documents[document.id], column))
+
+    def stream(self):
+        """
+        Stream tokens from relevant documents.
+        :return: a generator
+        """
+        for chunk in self.chunks():
+            for doc in chunk:
                 yield self.transform(doc)
 
-    def __init__(self, ids: ArrayLike = None, transform=lambda doc: doc):
+    def feed(self, consumers: list[Callable[[list[Document]], None]]):
+        """
+        Stream the documents once and pass every chunk of documents to every consumer, in order.
+        Lets several consumers, e.g. one per field, share a single pass over the documents.
+        """
+        for chunk in self.chunks():
+            for consumer in consumers:
+                consumer(chunk)
+
+    def __init__(self, ids: ArrayLike = None, transform=lambda doc: doc, start_id: int = None, end_id: int = None,  # pylint: disable=too-many-arguments
+                 columns: list[str] = None, chunk_size: int = DOCUMENT_STREAM_CHUNK_SIZE, token_store: TokenStore = None):
         """
         Stream sentences from relevant documents.
 
         Args:
             ids (list[int] | np.array): List of document IDs.
+            start_id (int): If given and ids is None, only documents with an ID of at least start_id are streamed.
+            end_id (int): If given and ids is None, only documents with an ID below end_id are streamed.
+            columns (list[str]): Names of the columns to select, the ID is always selected. All columns by default.
+            chunk_size (int): Number of documents read with one query.
+            token_store (TokenStore): Store to read the tokens from. By default, the configured token store, if any.
         """
         self.ids = ids
+        self.start_id = start_id
+        self.end_id = end_id
         self.transform = transform
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.token_store = shared_token_store() if token_store is None else token_store
         self.generator = self.stream()
 
     def __iter__(self):
@@ -61,27 +171,27 @@ class DocumentStreamer:
         return result
 
 
-def partial(func):
+def partial(column: str):
     """
-    Help function to create more streams.
+    Help function to create more streams, selecting only the token column.
     """
+    tokens = operator.attrgetter(column)
     # pylint: disable=invalid-name
-    DocumentTokensStreamer = functools.partial(DocumentStreamer, transform=func)
+    DocumentTokensStreamer = functools.partial(DocumentStreamer, transform=tokens, columns=[column])
     # pylint: disable=invalid-name
-    DocumentStringStreamer = functools.partial(DocumentStreamer,
-                                               transform=lambda doc: " ".join(func(doc)))
+    DocumentStringStreamer = functools.partial(DocumentStreamer, columns=[column],
+                                               transform=lambda doc: " ".join(tokens(doc)))
     return DocumentTokensStreamer, DocumentStringStreamer
 
 
-DocumentTitleTokensStreamer, DocumentTitleStringStreamer = partial(lambda doc: doc.title_tokens)
-DocumentMetaDescriptionTokensStreamer, DocumentMetaDescriptionStringStreamer = partial(
-    lambda doc: doc.meta_description_tokens)
-DocumentMetaKeywordsTokensStreamer, DocumentMetaKeywordsStringStreamer = partial(lambda doc: doc.meta_keywords_tokens)
-DocumentMetaAuthorTokensStreamer, DocumentMetaAuthorStringStreamer = partial(lambda doc: doc.meta_author_tokens)
-DocumentH1TokensStreamer, DocumentH1StringStreamer = partial(lambda doc: doc.h1_tokens)
-DocumentH2TokensStreamer, DocumentH2StringStreamer = partial(lambda doc: doc.h2_tokens)
-DocumentH3TokensStreamer, DocumentH3StringStreamer = partial(lambda doc: doc.h3_tokens)
-DocumentH4TokensStreamer, DocumentH4StringStreamer = partial(lambda doc: doc.h4_tokens)
-DocumentH5TokensStreamer, DocumentH5StringStreamer = partial(lambda doc: doc.h5_tokens)
-DocumentH6TokensStreamer, DocumentH6StringStreamer = partial(lambda doc: doc.h6_tokens)
-DocumentBodyTokensStreamer, DocumentBodyStringStreamer = partial(lambda doc: doc.body_tokens)
+DocumentTitleTokensStreamer, DocumentTitleStringStreamer = partial("title_tokens")
+DocumentMetaDescriptionTokensStreamer, DocumentMetaDescriptionStringStreamer = partial("meta_description_tokens")
+DocumentMetaKeywordsTokensStreamer, DocumentMetaKeywordsStringStreamer = partial("meta_keywords_tokens")
+DocumentMetaAuthorTokensStreamer, DocumentMetaAuthorStringStreamer = partial("meta_author_tokens")
+DocumentH1TokensStreamer, DocumentH1StringStreamer = partial("h1_tokens")
+DocumentH2TokensStreamer, DocumentH2StringStreamer = partial("h2_tokens")
+DocumentH3TokensStreamer, DocumentH3StringStreamer = partial("h3_tokens")
+DocumentH4TokensStreamer, DocumentH4StringStreamer = partial("h4_tokens")
+DocumentH5TokensStreamer, DocumentH5StringStreamer = partial("h5_tokens")
+DocumentH6TokensStreamer, DocumentH6StringStreamer = partial("h6_tokens")
+DocumentBodyTokensStreamer, DocumentBodyStringStreamer = partial("body_tokens")
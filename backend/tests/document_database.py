@@ -0,0 +1,44 @@
+"""Test case with documents in an in-memory SQLite database"""
+import random
+import tempfile
+import unittest
+from contextlib import ExitStack
+from typing import Callable, Iterable
+
+import peewee
+
+from crawler.sql_models.document import Document
+
+VOCABULARY = ["tubingen_PROPN", "castle_NOUN", "neckar_PROPN", "museum_NOUN", "university_NOUN"]
+
+
+class DocumentDatabaseTestCase(unittest.TestCase):
+    """Binds the documents to an in-memory SQLite database and provides a temporary directory"""
+
+    def setUp(self):
+        self.database = peewee.SqliteDatabase(":memory:")
+        self.stack = ExitStack()
+        self.stack.enter_context(self.database.bind_ctx([Document]))
+        self.database.create_tables([Document])
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.generator = random.Random(0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        self.stack.close()
+        self.database.close()
+
+    def create_documents(self, document_ids: Iterable[int], fields: dict[str, tuple[int, int]],
+                         relevant: Callable[[int], bool] = lambda document_id: True):
+        """
+        Creates documents with random tokens of VOCABULARY.
+
+        Args:
+            document_ids (Iterable[int]): The IDs of the documents.
+            fields (dict[str, tuple[int, int]]): The minimum and maximum number of tokens of every field.
+            relevant (Callable[[int], bool]): Whether the document with an ID is relevant.
+        """
+        for document_id in document_ids:
+            tokens = {f"{field}_tokens": self.generator.choices(VOCABULARY, k=self.generator.randint(*counts))
+                      for field, counts in fields.items()}
+            Document.create(id=document_id, job_id=document_id, relevant=relevant(document_id), **tokens)
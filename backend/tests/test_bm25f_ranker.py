@@ -0,0 +1,55 @@
+"""Test BM25F ranker"""
+import math
+import tempfile
+import unittest
+
+from backend.inverted_index import IndexWriter, InvertedIndex
+from backend.rankers.bm25f_ranker import FIELD_WEIGHTS, BM25FRanker
+
+
+class TestBM25FRanker(unittest.TestCase):
+    """Test BM25FRanker on a small index"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        writer = IndexWriter(self.directory.name, fields=["title", "body"])
+        writer.write_doc_ids([10, 20, 30, 40])
+        writer.write_field("title", {"castle_NOUN": {0: [0]}, "museum_NOUN": {3: [0]}})
+        writer.write_field("body", {
+            "castle_NOUN": {1: [0, 2], 2: [5]},
+            "tubingen_PROPN": {0: [0], 1: [1], 2: [0], 3: [1]},
+            "filler_NOUN": {1: [3], 2: [1, 2, 3, 4, 6, 7]},
+        })
+        writer.commit(4)
+        self.index = InvertedIndex(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_scores(self):
+        """
+        Test if the scores follow the BM25F formula.
+        """
+        saturation, normalization = 1.2, 0.75
+        rows, scores = BM25FRanker(self.index, ["castle_NOUN", "castle_NOUN"], saturation, normalization).scores()
+        self.assertEqual(rows.tolist(), [0, 1, 2])
+        idf = math.log(1 + (4 - 3 + 0.5) / (3 + 0.5))
+        average_body_length = 14 / 4
+        title = FIELD_WEIGHTS["title"] * 1 / (1 - normalization + normalization * 1 / 0.5)
+        self.assertAlmostEqual(scores[0], idf * title / (saturation + title))
+        body = FIELD_WEIGHTS["body"] * 2 / (1 - normalization + normalization * 4 / average_body_length)
+        self.assertAlmostEqual(scores[1], idf * body / (saturation + body))
+        # The title weighs more than the body, short documents more than long ones.
+        self.assertGreater(scores[0], scores[1])
+        self.assertGreater(scores[1], scores[2])
+
+    def test_top_k_and_allowed_rows(self):
+        """
+        Test if top-k returns the best of all scores and allowed rows restrict the documents.
+        """
+        ranker = BM25FRanker(self.index, ["castle_NOUN", "tubingen_PROPN", "unknown_NOUN"])
+        scores = dict(zip(*[array.tolist() for array in ranker.scores()]))
+        best = sorted(scores, key=lambda row: (-scores[row], row))[:2]
+        self.assertEqual(ranker.top_k(2)[0].tolist(), best)
+        self.assertEqual(ranker.scores(allowed_rows=[1, 3])[0].tolist(), [1, 3])
+        self.assertEqual(len(BM25FRanker(self.index, ["unknown_NOUN"]).scores()[0]), 0)
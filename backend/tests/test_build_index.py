@@ -0,0 +1,51 @@
+"""Test building the inverted index in shards"""
+import os
+import unittest
+
+import numpy as np
+
+from backend.build_index import Indexer, index_documents, partition_document_ids, write_index
+from backend.inverted_index import InvertedIndex
+from backend.segments import SEGMENTS_FILE, read_segments_manifest
+from backend.tests.document_database import DocumentDatabaseTestCase
+from crawler.sql_models.document import Document
+
+
+class TestBuildIndex(DocumentDatabaseTestCase):
+    """Test the sharded index build on an in-memory SQLite database"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_documents(range(1, 12), {"title": (0, 3), "body": (1, 12)},
+                              relevant=lambda document_id: document_id != 4)
+
+    def test_partition_document_ids(self):
+        """
+        Test if the relevant documents are partitioned into ID ranges of shard_size documents.
+        """
+        self.assertEqual(partition_document_ids(4), [(1, 6), (6, 10), (10, 12)])
+        self.assertEqual(partition_document_ids(100), [(1, 12)])
+
+    def test_sharded_build_equals_single_build(self):
+        """
+        Test if merging the shards gives the same index files as indexing all documents at once.
+        """
+        expected_directory = os.path.join(self.directory.name, "expected")
+        write_index(expected_directory, *index_documents(Document.select().where(Document.relevant == True)))  # pylint: disable=singleton-comparison
+        sharded_directory = os.path.join(self.directory.name, "sharded")
+        Indexer(sharded_directory, shard_size=3, processes=1).build_index()
+
+        self.assertFalse(os.path.exists(os.path.join(sharded_directory, "shards")))
+        self.assertEqual(read_segments_manifest(sharded_directory)["deltas"], [])
+        self.assertEqual(read_segments_manifest(sharded_directory)["high_water_mark"], 11)
+        self.assertEqual(sorted(os.listdir(sharded_directory)), sorted(os.listdir(expected_directory) + [SEGMENTS_FILE]))
+        for file_name in os.listdir(expected_directory):
+            with open(os.path.join(expected_directory, file_name), "rb") as expected, \
+                    open(os.path.join(sharded_directory, file_name), "rb") as sharded:
+                self.assertEqual(sharded.read(), expected.read(), file_name)
+        index = InvertedIndex(sharded_directory)
+        np.testing.assert_array_equal(index.doc_ids, [1, 2, 3, 5, 6, 7, 8, 9, 10, 11])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""Test building the PageRank of servers and documents"""
+import os
+import tempfile
+import unittest
+from contextlib import ExitStack
+
+import numpy as np
+import peewee
+
+from backend.build_pagerank import build_document_graph, build_server_graph, compute_document_page_ranks, \
+    load_servers, read_document_page_ranks, save_server_page_ranks, write_document_page_ranks
+from crawler.sql_models.document import Document
+from crawler.sql_models.job import Job
+from crawler.sql_models.server import Server
+
+
+class TestBuildPageRank(unittest.TestCase):
+    """Test the server graph on an in-memory SQLite database"""
+
+    def setUp(self):
+        self.database = peewee.SqliteDatabase(":memory:")
+        self.stack = ExitStack()
+        self.stack.enter_context(self.database.bind_ctx([Server, Job, Document]))
+        self.database.create_tables([Server, Job, Document])
+        for name in ["a.de", "b.de", "c.de"]:
+            Server.create(name=name)
+        # a.de/1 links to b.de/1, a.de/2 and c.de/1; b.de/1 links to a.de/3.
+        self.create_job("https://a.de/1", 1, parent_id=0, document_id=1)
+        self.create_job("https://b.de/1", 2, parent_id=1, document_id=2)
+        self.create_job("https://a.de/2", 1, parent_id=1)
+        self.create_job("https://c.de/1", 3, parent_id=1)
+        self.create_job("https://a.de/3", 1, parent_id=2)
+
+    def tearDown(self):
+        self.stack.close()
+        self.database.close()
+
+    @staticmethod
+    def create_job(url: str, server_id: int, parent_id: int, document_id: int = None):
+        """Creates a job and, if given, the document crawled by it."""
+        job = Job.create(url=url, server_id=server_id, parent_id=parent_id)
+        if document_id is not None:
+            Document.create(id=document_id, job_id=job.id)
+
+    def test_build_server_graph(self):
+        """
+        Test if links between servers are found across chunks, without links of a server to itself.
+        """
+        server_ids, server_names = load_servers()
+        self.assertEqual(server_names, ["a.de", "b.de", "c.de"])
+        adjacency = build_server_graph(server_ids, chunk_size=2)
+        np.testing.assert_array_equal(adjacency.toarray(), [[0, 1, 1], [1, 0, 0], [0, 0, 0]])
+
+    def test_document_page_ranks(self):
+        """
+        Test if documents link to the documents of their jobs and their PageRank is stored by ID.
+        """
+        adjacency = build_document_graph(chunk_size=1)
+        np.testing.assert_array_equal(adjacency.toarray(), [[0, 0, 0], [0, 0, 1], [0, 0, 0]])
+        page_ranks = compute_document_page_ranks(adjacency)
+        self.assertEqual(page_ranks[0], 0)
+        self.assertEqual(page_ranks[2], 1)
+        self.assertLess(page_ranks[1], page_ranks[2])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "document_pagerank.npy")
+            write_document_page_ranks(page_ranks, path)
+            np.testing.assert_array_equal(read_document_page_ranks(path), page_ranks)
+        self.assertIsNone(read_document_page_ranks(path))
+
+    def test_save_server_page_ranks(self):
+        """
+        Test if the PageRank of each server is written to its row.
+        """
+        server_ids, _ = load_servers()
+        save_server_page_ranks(server_ids, np.array([1.0, 0.5, 0.25]))
+        query = Server.select(Server.page_rank).order_by(Server.id)
+        self.assertEqual([server.page_rank for server in query.objects()], [1.0, 0.5, 0.25])
@@ -0,0 +1,92 @@
+"""Test the generations of the index and reloading them in the backend"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from backend.build_index import write_index
+from backend.fused_ranker import FusedRanker
+from backend.generations import current_generation, delete_old_generations, generations_directory, \
+    new_generation, publish_generation, stage_generation, staged_generation
+from backend.inverted_index import INDEX_FIELDS
+from backend.query_parser import ParsedQuery
+
+
+def write_generation(directory: str, documents: dict[int, list[str]]) -> str:
+    """Writes an index of the documents, keyed by ID, with their body tokens into a new generation."""
+    generation = new_generation(directory)
+    postings = {field: {} for field in INDEX_FIELDS}
+    for row, tokens in enumerate(documents.values()):
+        for position, token in enumerate(tokens):
+            postings["body"].setdefault(token, {}).setdefault(row, []).append(position)
+    write_index(generation, list(documents), postings)
+    return generation
+
+
+class TestGenerations(unittest.TestCase):
+    """Test staging, publishing and reloading generations of the index"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.index_directory = os.path.join(self.directory.name, "index")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_publish_generation(self):
+        """
+        Test if publishing points the index to a generation and deletes old generations.
+        """
+        os.makedirs(self.index_directory)
+        first = new_generation(self.index_directory)
+        stage_generation(first, self.index_directory)
+        self.assertEqual(staged_generation(self.index_directory), os.path.realpath(first))
+        publish_generation(first, self.index_directory)
+        self.assertTrue(os.path.islink(self.index_directory))
+        self.assertEqual(current_generation(self.index_directory), os.path.realpath(first))
+        self.assertIsNone(staged_generation(self.index_directory))
+        # The directory from before generations is kept as the oldest generation.
+        self.assertEqual(len(os.listdir(generations_directory(self.index_directory))), 2)
+
+        second = new_generation(self.index_directory)
+        third = new_generation(self.index_directory)
+        stage_generation(third, self.index_directory)
+        publish_generation(second, self.index_directory)
+        self.assertEqual(current_generation(self.index_directory), os.path.realpath(second))
+        self.assertEqual(staged_generation(self.index_directory), os.path.realpath(third))
+        self.assertEqual(sorted(os.listdir(generations_directory(self.index_directory))),
+                         sorted(os.path.basename(generation) for generation in (second, third)))
+        delete_old_generations(self.index_directory, keep=1)
+        self.assertTrue(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+
+    def test_reload(self):
+        """
+        Test if the ranker swaps in a published generation and keeps the old one if the new one is broken.
+        """
+        publish_generation(write_generation(self.index_directory, {1: ["castle_NOUN"], 2: ["museum_NOUN"]}),
+                           self.index_directory)
+        ranker = FusedRanker(page_rank_weight=0, ranker="bm25f", directory=self.index_directory, start=False)
+        old_generation = ranker.generation
+        query = ParsedQuery(["castle_NOUN"], [])
+        self.assertEqual(list(ranker.scores_of_parsed_query(query)), [1])
+        self.assertFalse(ranker.reload())
+
+        publish_generation(write_generation(self.index_directory, {1: ["museum_NOUN"], 3: ["castle_NOUN"]}),
+                           self.index_directory)
+        self.assertEqual(list(ranker.scores_of_parsed_query(query)), [1])
+        self.assertTrue(ranker.reload())
+        self.assertIsNot(ranker.generation, old_generation)
+        self.assertEqual(list(ranker.scores_of_parsed_query(query)), [3])
+        # Queries which took the old generation before the swap finish on it.
+        rows, _ = ranker.row_scores_of_parsed_query(query, generation=old_generation)
+        np.testing.assert_array_equal(old_generation.doc_ids[rows], [1])
+
+        publish_generation(new_generation(self.index_directory), self.index_directory)
+        self.assertFalse(ranker.reload())
+        self.assertEqual(list(ranker.scores_of_parsed_query(query)), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
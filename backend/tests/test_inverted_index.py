@@ -0,0 +1,81 @@
+"""Test inverted index"""
+import tempfile
+import unittest
+
+import numpy as np
+
+from backend.inverted_index import IndexWriter, InvertedIndex, positions_match
+
+
+class TestInvertedIndex(unittest.TestCase):
+    """Test the on-disk inverted index format"""
+
+    def test_write_and_read(self):
+        """
+        Test if postings written to disk are read back memory-mapped.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            writer = IndexWriter(directory, fields=["title", "body"])
+            writer.write_doc_ids([10, 20, 30])
+            writer.write_field("title", {"tubingen_PROPN": {0: [0, 3], 2: [1]}, "castle_NOUN": {1: [0], 2: [0]}})
+            writer.write_field("body", {})
+            writer.commit(3)
+
+            index = InvertedIndex(directory)
+            self.assertEqual(index.num_documents, 3)
+            self.assertEqual(list(index.fields["title"]), ["castle_NOUN", "tubingen_PROPN"])
+            self.assertTrue("tubingen_PROPN" in index.fields["title"])
+            self.assertFalse("neckar_PROPN" in index.fields["title"])
+            self.assertFalse("tubingen_PROPN" in index.fields["body"])
+            np.testing.assert_array_equal(index.fields["title"]["tubingen_PROPN"], [0, 2])
+            np.testing.assert_array_equal(index.doc_ids[index.fields["title"]["castle_NOUN"]], [20, 30])
+            self.assertIsNone(index.fields["body"].get("castle_NOUN"))
+            term_id = index.fields["title"].find("tubingen_PROPN")
+            np.testing.assert_array_equal(index.fields["title"].frequencies_at(term_id), [2, 1])
+            positions = index.fields["title"].positions_at(term_id, np.array([2]))
+            np.testing.assert_array_equal(positions[0], [1])
+            np.testing.assert_array_equal(index.fields["title"].lengths, [2, 1, 2])
+            self.assertAlmostEqual(index.fields["title"].average_length, 5 / 3)
+            np.testing.assert_array_equal(index.fields["body"].lengths, [0, 0, 0])
+
+    def test_phrase_matches(self):
+        """
+        Test if phrases are evaluated on the token positions.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            writer = IndexWriter(directory, fields=["body"])
+            writer.write_doc_ids([1, 2, 3])
+            writer.write_field("body", {
+                "castle_NOUN": {0: [1], 1: [0], 2: [5]},
+                "hohentubingen_PROPN": {0: [0], 1: [1], 2: [2]},
+            })
+            writer.commit(3)
+            body = InvertedIndex(directory).fields["body"]
+            np.testing.assert_array_equal(body.phrase_matches(["hohentubingen_PROPN", "castle_NOUN"]), [0])
+            np.testing.assert_array_equal(body.phrase_matches(["hohentubingen_PROPN", "castle_NOUN"], slop=1), [0, 1])
+            np.testing.assert_array_equal(body.phrase_matches(["hohentubingen_PROPN", "castle_NOUN"], slop=2), [0, 1, 2])
+            np.testing.assert_array_equal(body.phrase_matches(["hohentubingen_PROPN", "neckar_PROPN"]), [])
+
+    def test_positions_match(self):
+        """
+        Test exact phrase and proximity windows.
+        """
+        self.assertTrue(positions_match([np.array([2, 7]), np.array([8])], slop=0))
+        self.assertFalse(positions_match([np.array([2]), np.array([4])], slop=0))
+        self.assertTrue(positions_match([np.array([2]), np.array([4])], slop=1))
+        self.assertFalse(positions_match([np.array([2]), np.array([5])], slop=1))
+
+    def test_terms_must_be_sorted(self):
+        """
+        Test if the writer rejects unsorted terms.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            writer = IndexWriter(directory, fields=["title"]).field_writer("title")
+            writer.add("b", [0], [[0]])
+            with self.assertRaises(ValueError):
+                writer.add("a", [1], [[0]])
+            writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""Test MaxScore top-k retrieval"""
+import unittest
+
+import numpy as np
+
+from backend.rankers.max_score import TermPostings, max_score_top_k, rank_rows
+
+
+def random_terms(generator: np.random.Generator, num_rows: int, num_terms: int) -> list[TermPostings]:
+    """
+    Creates postings of random terms.
+    """
+    terms = []
+    for _ in range(num_terms):
+        rows = np.sort(generator.choice(num_rows, size=generator.integers(1, num_rows), replace=False))
+        contributions = generator.random(len(rows)) * generator.integers(1, 10)
+        terms.append(TermPostings(float(contributions.max()), rows, contributions))
+    return terms
+
+
+def exhaustive_top_k(terms: list[TermPostings], k: int, num_rows: int, static_scores: np.ndarray = None):
+    """
+    Scores every document.
+    """
+    scores = np.zeros(num_rows)
+    matched = np.zeros(num_rows, dtype=bool)
+    for term in terms:
+        scores[term.rows] += term.contributions
+        matched[term.rows] = True
+    if static_scores is not None:
+        scores += static_scores
+    rows = np.flatnonzero(matched)
+    order = np.lexsort((rows, -scores[rows]))[:k]
+    return rows[order], scores[rows][order]
+
+
+class TestMaxScore(unittest.TestCase):
+    """Test MaxScore"""
+
+    def test_same_result_as_exhaustive_scoring(self):
+        """
+        Test if early termination returns the exact top k.
+        """
+        generator = np.random.default_rng(0)
+        for _ in range(50):
+            terms = random_terms(generator, num_rows=200, num_terms=int(generator.integers(1, 8)))
+            for k in (1, 5, 20, 500):
+                expected_rows, expected_scores = exhaustive_top_k(terms, k, 200)
+                rows, scores = max_score_top_k(terms, k)
+                np.testing.assert_array_equal(rows, expected_rows)
+                np.testing.assert_allclose(scores, expected_scores)
+
+    def test_static_scores(self):
+        """
+        Test if early termination returns the exact top k when static scores are added.
+        """
+        generator = np.random.default_rng(1)
+        for _ in range(50):
+            terms = random_terms(generator, num_rows=200, num_terms=int(generator.integers(1, 8)))
+            static_scores = generator.random(200) * generator.integers(1, 10)
+            for k in (1, 5, 20):
+                expected_rows, expected_scores = exhaustive_top_k(terms, k, 200, static_scores)
+                rows, scores = max_score_top_k(terms, k, static_scores=static_scores.__getitem__,
+                                               static_upper_bound=float(static_scores.max()))
+                np.testing.assert_array_equal(rows, expected_rows)
+                np.testing.assert_allclose(scores, expected_scores)
+
+    def test_allowed_rows(self):
+        """
+        Test if only allowed rows are returned.
+        """
+        terms = [TermPostings(3.0, np.array([0, 1, 2]), np.array([3.0, 2.0, 1.0]))]
+        rows, scores = max_score_top_k(terms, 2, allowed_rows=np.array([1, 2]))
+        np.testing.assert_array_equal(rows, [1, 2])
+        np.testing.assert_array_equal(scores, [2.0, 1.0])
+
+        generator = np.random.default_rng(2)
+        for _ in range(20):
+            terms = random_terms(generator, num_rows=200, num_terms=int(generator.integers(1, 8)))
+            allowed_rows = generator.choice(200, size=int(generator.integers(1, 200)), replace=False)
+            allowed_terms = [TermPostings(term.upper_bound, term.rows[np.isin(term.rows, allowed_rows)],
+                                          term.contributions[np.isin(term.rows, allowed_rows)]) for term in terms]
+            expected_rows, expected_scores = exhaustive_top_k(allowed_terms, 10, 200)
+            rows, scores = max_score_top_k(terms, 10, allowed_rows=allowed_rows)
+            np.testing.assert_array_equal(rows, expected_rows)
+            np.testing.assert_allclose(scores, expected_scores)
+
+    def test_rank_rows(self):
+        """
+        Test if the k best rows are returned best first, with ties broken by the lower row.
+        """
+        rows = np.array([7, 3, 5, 1, 9])
+        scores = np.array([1.0, 2.0, 2.0, 0.5, 2.0])
+        for k, expected in ((None, [3, 5, 9, 7, 1]), (2, [3, 5]), (4, [3, 5, 9, 7]), (9, [3, 5, 9, 7, 1]), (0, [])):
+            ranked_rows, ranked_scores = rank_rows(rows, scores, k)
+            np.testing.assert_array_equal(ranked_rows, expected)
+            np.testing.assert_array_equal(ranked_scores, [dict(zip(rows, scores))[row] for row in expected])
+
+
+if __name__ == '__main__':
+    unittest.main()
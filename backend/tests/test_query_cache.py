@@ -0,0 +1,84 @@
+"""Test query cache"""
+import time
+import unittest
+
+import numpy as np
+
+from backend.query_cache import QueryCache
+
+
+class TestQueryCache(unittest.TestCase):
+    """Test QueryCache"""
+
+    def test_hit_and_miss(self):
+        """
+        Test if cached rankings are returned and counted.
+        """
+        cache = QueryCache()
+        self.assertIsNone(cache.get(("tubingen_PROPN",)))
+        cache.put(("tubingen_PROPN",), np.array([3, 1, 2]))
+        np.testing.assert_array_equal(cache.get(("tubingen_PROPN",)), [3, 1, 2])
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_lru_eviction(self):
+        """
+        Test if the least recently used ranking is evicted first.
+        """
+        cache = QueryCache(max_entries=2)
+        cache.put("a", np.array([1]))
+        cache.put("b", np.array([2]))
+        cache.get("a")
+        cache.put("c", np.array([3]))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+
+    def test_memory_bound(self):
+        """
+        Test if the cache holds at most max_bytes bytes of rankings.
+        """
+        cache = QueryCache(max_bytes=8 * 10)
+        cache.put("a", np.arange(6, dtype=np.int64))
+        cache.put("b", np.arange(6, dtype=np.int64))
+        self.assertIsNone(cache.get("a"))
+        self.assertLessEqual(cache.stats()["bytes"], 80)
+        cache.put("c", np.arange(11, dtype=np.int64))
+        self.assertIsNone(cache.get("c"))
+
+    def test_ttl(self):
+        """
+        Test if rankings expire.
+        """
+        cache = QueryCache(ttl=0.01)
+        cache.put("a", np.array([1]))
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_invalidation(self):
+        """
+        Test if the cache is dropped when the index version changes.
+        """
+        version = [1]
+        cache = QueryCache(version=lambda: version[0])
+        cache.put("a", np.array([1]))
+        version[0] = 2
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["invalidations"], 1)
+
+    def test_truncated_rankings(self):
+        """
+        Test if a ranking cut after k documents only serves requests for up to k documents.
+        """
+        cache = QueryCache()
+        cache.put("a", np.array([5, 4, 3]), k=3)
+        self.assertIsNotNone(cache.get("a", k=2))
+        self.assertIsNone(cache.get("a", k=10))
+        self.assertIsNone(cache.get("a"))
+        cache.put("b", np.array([5, 4]), k=3)
+        self.assertIsNotNone(cache.get("b", k=10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+"""Test delta segments of the inverted index"""
+import os
+import unittest
+
+import numpy as np
+import scipy.sparse
+
+from backend.build_index import Indexer, index_documents, write_index
+from backend.inverted_index import INDEX_FIELDS, InvertedIndex
+from backend.segments import SEGMENTS_DIRECTORY, read_segmented_index, read_segments_manifest
+from backend.update_index import build_delta_segment, delete_unused_segments, merge_delta_segments
+from backend.vector_spaces.tfidf import TFIDF_MATRICES_MANIFEST_FILE, TFIDFMatrices, read_tfidf_matrices, \
+    stack_tfidf_matrices, write_tfidf_matrix
+from backend.tests.document_database import VOCABULARY, DocumentDatabaseTestCase
+from crawler import utils
+from crawler.sql_models.document import Document
+
+
+class TestSegments(DocumentDatabaseTestCase):
+    """Test indexing new documents into delta segments on an in-memory SQLite database"""
+
+    def setUp(self):
+        super().setUp()
+        self.index_directory = os.path.join(self.directory.name, "index")
+
+    def create_new_documents(self, document_ids: range):
+        """Creates documents with random tokens, every fourth one irrelevant."""
+        self.create_documents(document_ids, {"title": (0, 3), "body": (1, 10)},
+                              relevant=lambda document_id: document_id % 4 != 0)
+
+    def assert_equals_full_index(self):
+        """Asserts that the segments answer like an index built from all documents at once."""
+        full_directory = os.path.join(self.directory.name, "full")
+        write_index(full_directory, *index_documents(Document.select().where(Document.relevant == True)))  # pylint: disable=singleton-comparison
+        expected = InvertedIndex(full_directory)
+        actual = read_segmented_index(self.index_directory)
+        np.testing.assert_array_equal(actual.doc_ids, expected.doc_ids)
+        rows = np.arange(expected.num_documents)
+        for field in INDEX_FIELDS:
+            expected_field, actual_field = expected.fields[field], actual.fields[field]
+            self.assertAlmostEqual(actual_field.average_length, expected_field.average_length)
+            np.testing.assert_array_equal(actual_field.lengths_of(rows), expected_field.lengths_of(rows))
+            for token in VOCABULARY + ["unknown_NOUN"]:
+                self.assertEqual(token in actual_field, token in expected_field)
+                if token not in expected_field:
+                    self.assertIsNone(actual_field.get(token))
+                    continue
+                np.testing.assert_array_equal(actual_field.get(token), expected_field.get(token))
+                for actual_array, expected_array in zip(actual_field.postings_with_frequencies(token),
+                                                        expected_field.postings_with_frequencies(token)):
+                    np.testing.assert_array_equal(actual_array, expected_array)
+                phrase = [token, VOCABULARY[0]]
+                np.testing.assert_array_equal(actual_field.phrase_matches(phrase),
+                                              expected_field.phrase_matches(phrase))
+
+    def test_delta_segments(self):
+        """
+        Test if new documents are indexed into delta segments above the high-water mark and merged.
+        """
+        self.create_new_documents(range(1, 8))
+        Indexer(self.index_directory, processes=1).build_index()
+        self.assertIsNone(build_delta_segment(self.index_directory))
+
+        self.create_new_documents(range(8, 11))
+        build_delta_segment(self.index_directory)
+        self.create_new_documents(range(11, 16))
+        build_delta_segment(self.index_directory)
+        manifest = read_segments_manifest(self.index_directory)
+        self.assertEqual(manifest["deltas"], ["delta-000000", "delta-000001"])
+        self.assertEqual(manifest["high_water_mark"], 15)
+        self.assert_equals_full_index()
+
+        merge_delta_segments(self.index_directory, max_delta_segments=2)
+        self.assertEqual(len(read_segments_manifest(self.index_directory)["deltas"]), 2)
+        merge_delta_segments(self.index_directory, max_delta_segments=1)
+        manifest = read_segments_manifest(self.index_directory)
+        self.assertEqual(manifest["deltas"], ["delta-000002"])
+        self.assert_equals_full_index()
+
+        delete_unused_segments(self.index_directory, manifest)
+        self.assertEqual(os.listdir(os.path.join(self.index_directory, SEGMENTS_DIRECTORY)), ["delta-000002"])
+        Indexer(self.index_directory, processes=1).build_index()
+        self.assertFalse(os.path.exists(os.path.join(self.index_directory, SEGMENTS_DIRECTORY)))
+        self.assertIsInstance(read_segmented_index(self.index_directory), InvertedIndex)
+
+    def test_tfidf_matrices(self):
+        """
+        Test if the TF-IDF matrices of segments are read as one matrix with the rows stacked.
+        """
+        matrices = [scipy.sparse.random(num_rows, 6, density=0.4, format="csr", random_state=seed, dtype=np.float32)
+                    for seed, num_rows in enumerate([5, 3, 4])]
+        directories = [os.path.join(self.directory.name, f"segment-{i}") for i in range(len(matrices))]
+        for directory, matrix in zip(directories, matrices):
+            os.makedirs(directory)
+            write_tfidf_matrix("body", matrix, directory)
+            utils.io.write_json_file({"body": list(matrix.shape)}, os.path.join(directory, TFIDF_MATRICES_MANIFEST_FILE))
+        stacked = scipy.sparse.vstack(matrices, format="csr")
+
+        segmented = TFIDFMatrices(directories, [0, 5, 8])
+        self.assertIn("body", segmented)
+        self.assertNotIn("title", segmented)
+        rows = np.array([0, 4, 5, 9, 11])
+        np.testing.assert_allclose(segmented.rows("body", rows).toarray(), stacked[rows].toarray())
+        for column in range(6):
+            postings_rows, weights = segmented.postings("body", column)
+            np.testing.assert_array_equal(postings_rows, stacked[:, column].nonzero()[0])
+            np.testing.assert_allclose(weights, stacked[postings_rows, column].toarray().ravel())
+            self.assertAlmostEqual(segmented.max_weight("body", column), stacked[:, column].max(), places=6)
+
+        merged_directory = os.path.join(self.directory.name, "merged")
+        os.makedirs(merged_directory)
+        stack_tfidf_matrices(directories, merged_directory)
+        np.testing.assert_allclose(read_tfidf_matrices(merged_directory)["body"].toarray(), stacked.toarray())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Test streaming documents in chunks"""
+import tempfile
+import unittest
+
+import peewee
+
+from backend.streamers import DocumentBodyStringStreamer, DocumentStreamer
+from backend.tests.document_database import DocumentDatabaseTestCase
+from crawler.sql_models.document import Document
+from crawler.utils.token_store import TokenStore, TokenStoreWriter
+
+
+class TestStreamers(DocumentDatabaseTestCase):
+    """Test the document streamers on an in-memory SQLite database"""
+
+    def setUp(self):
+        super().setUp()
+        for document_id in range(1, 10):
+            Document.create(id=document_id, job_id=document_id, relevant=document_id != 4, html="<p>castle</p>",
+                            title_tokens=[f"title{document_id}"], body_tokens=["castle_NOUN", f"body{document_id}"])
+
+    def test_keyset_pagination(self):
+        """
+        Test if the relevant documents are streamed in chunks, in the order of their IDs.
+        """
+        chunks = list(DocumentStreamer(chunk_size=3).chunks())
+        self.assertEqual([[document.id for document in chunk] for chunk in chunks], [[1, 2, 3], [5, 6, 7], [8, 9]])
+        self.assertEqual([document.id for document in DocumentStreamer(start_id=3, end_id=8, chunk_size=2)],
+                         [3, 5, 6, 7])
+        self.assertEqual(list(DocumentStreamer(start_id=10)), [])
+
+    def test_ids(self):
+        """
+        Test if documents given by ID are streamed in the given order, also irrelevant ones.
+        """
+        self.assertEqual(list(DocumentBodyStringStreamer([9, 4, 1], chunk_size=2)),
+                         ["castle_NOUN body9", "castle_NOUN body4", "castle_NOUN body1"])
+        with self.assertRaises(peewee.DoesNotExist):
+            list(DocumentStreamer([1, 42]))
+
+    def test_columns(self):
+        """
+        Test if only the requested columns are selected.
+        """
+        document = next(iter(DocumentStreamer(columns=["title_tokens"])))
+        self.assertEqual(document.id, 1)
+        self.assertEqual(document.title_tokens, ["title1"])
+        self.assertIsNone(document.html)
+
+    def test_feed(self):
+        """
+        Test if every consumer receives every chunk of a single pass.
+        """
+        titles, bodies = [], []
+        DocumentStreamer(columns=["title_tokens", "body_tokens"], chunk_size=4).feed([
+            lambda chunk: titles.extend(document.title_tokens[0] for document in chunk),
+            lambda chunk: bodies.append(len(chunk)),
+        ])
+        self.assertEqual(titles, [f"title{document_id}" for document_id in [1, 2, 3, 5, 6, 7, 8, 9]])
+        self.assertEqual(bodies, [4, 4])
+
+    def test_token_store(self):
+        """
+        Test if the tokens are read from the token store and from the JSON columns of documents missing in it.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            writer = TokenStoreWriter(directory)
+            writer.append([(document_id, {"body": ["stored_NOUN", f"body{document_id}"]}) for document_id in (1, 2)])
+            Document.update(body_tokens=[]).where(Document.id.in_([1, 2])).execute()
+            store = TokenStore(directory)
+            # Saved after the store was opened.
+            writer.append([(9, {"body": ["stored_NOUN", "body9"]})])
+            Document.update(body_tokens=[]).where(Document.id == 9).execute()
+
+            bodies = list(DocumentBodyStringStreamer(token_store=store, chunk_size=4))
+            self.assertEqual(bodies, ["stored_NOUN body1", "stored_NOUN body2", "castle_NOUN body3", "castle_NOUN body5",
+                                      "castle_NOUN body6", "castle_NOUN body7", "castle_NOUN body8", "stored_NOUN body9"])
+            documents = list(DocumentStreamer([9, 3], token_store=store))
+            self.assertEqual([document.body_tokens for document in documents],
+                             [["stored_NOUN", "body9"], ["castle_NOUN", "body3"]])
+            self.assertEqual(documents[0].html, "<p>castle</p>")
+
+
+if __name__ == '__main__':
+    unittest.main()
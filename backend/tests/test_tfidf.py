@@ -0,0 +1,50 @@
+"""Test the single-pass TF-IDF build"""
+import os
+import unittest
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from backend.build_index import index_documents, write_index
+from backend.vector_spaces.tfidf import TFIDF_CANONICAL_ORDERING, TFIDF_NGRAM_RANGE, read_tfidf_matrices, \
+    read_tfidf_vectorizers, tfidf_vectorize_indexed_documents, train_tf_idf_vectorizer
+from backend.tests.document_database import VOCABULARY, DocumentDatabaseTestCase
+from crawler.sql_models.document import Document
+
+
+class TestTFIDF(DocumentDatabaseTestCase):
+    """Test fitting and vectorizing all vector spaces in one pass on an in-memory SQLite database"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_documents(range(1, 30), {"title": (0, 3), "h1": (0, 2), "body": (1, 12)},
+                              relevant=lambda document_id: document_id % 5 != 0)
+        write_index(self.directory.name, *index_documents(Document.select().where(Document.relevant == True)))  # pylint: disable=singleton-comparison
+
+    def test_single_pass_equals_fit(self):
+        """
+        Test if the vectorizers and matrices equal those of fitting every vector space on its own.
+        Vector spaces without terms are left out.
+        """
+        train_tf_idf_vectorizer(self.directory.name, processes=1)
+        tfidf_vectorize_indexed_documents(self.directory.name, processes=1)
+        vectorizers = read_tfidf_vectorizers(self.directory.name)
+        matrices = read_tfidf_matrices(self.directory.name)
+        self.assertEqual(list(vectorizers), TFIDF_CANONICAL_ORDERING)
+        self.assertEqual(sorted(matrices), ["body", "h1", "title"])
+
+        documents = list(Document.select().where(Document.relevant == True).order_by(Document.id))  # pylint: disable=singleton-comparison
+        for name, matrix in matrices.items():
+            strings = [" ".join(getattr(document, f"{name}_tokens")) for document in documents]
+            expected = TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE).fit(strings)
+            self.assertEqual(vectorizers[name].vocabulary_, expected.vocabulary_)
+            np.testing.assert_allclose(vectorizers[name].idf_, expected.idf_)
+            np.testing.assert_allclose(matrix.toarray(), expected.transform(strings).toarray(), rtol=1e-6)
+            query = " ".join(VOCABULARY[:2])
+            np.testing.assert_allclose(vectorizers[name].transform([query]).toarray(),
+                                       expected.transform([query]).toarray())
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "h6.tfidf_data.npy")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+backend/update_index.py
+
+This script adds the documents crawled since the last build of the index to the
+index, without rebuilding it.
+
+Every INDEX_UPDATE_INTERVAL seconds, the relevant documents with an ID above the
+high-water mark are indexed into a new delta segment, see backend/segments.py, and
+vectorized with the TF-IDF vectorizers of the base segment. Delta segments are added
+to the current generation of the index, see backend/generations.py. The backend
+opens new delta segments with its next reload. Once there are more than INDEX_MAX_DELTA_SEGMENTS
+delta segments, they are merged into one, so that queries do not visit many small
+segments. The base segment and the TF-IDF vectorizers are only rebuilt by
+backend/build_index.py and backend/build_metrics.py.
+
+Documents below the high-water mark that become relevant later, or that are
+committed after documents with higher IDs, are indexed by the next full rebuild.
+
+Usage:
+    python3 -m backend.update_index [--once]
+"""
+import argparse
+import os
+import shutil
+import time
+
+from dotenv import load_dotenv
+
+from backend.build_index import INDEX_COLUMNS, INDEX_DIRECTORY, index_documents, merge_shards, write_index
+from backend.generations import current_generation
+from backend.inverted_index import index_version
+from backend.segments import SEGMENTS_DIRECTORY, read_segments_manifest, segment_directories, \
+    write_segments_manifest
+from backend.streamers import DocumentStreamer
+from backend.vector_spaces.tfidf import read_tfidf_vectorizers, stack_tfidf_matrices, \
+    tfidf_vectorize_indexed_documents, tfidf_vectorizers_exist
+from crawler import utils
+from crawler.sql_models.base import connect_to_database
+
+load_dotenv()
+LOG = utils.get_logger(__file__)
+INDEX_UPDATE_INTERVAL = float(os.getenv("INDEX_UPDATE_INTERVAL", "300"))
+INDEX_MAX_DELTA_SEGMENTS = int(os.getenv("INDEX_MAX_DELTA_SEGMENTS", "8"))
+
+
+def delete_unused_segments(directory: str, manifest: dict):
+    """
+    Deletes the directories of delta segments which are not part of the index anymore.
+    Merged delta segments are deleted one update later, so that backends still opening them find them.
+    """
+    segments_directory = os.path.join(directory, SEGMENTS_DIRECTORY)
+    if not os.path.exists(segments_directory):
+        return
+    for name in os.listdir(segments_directory):
+        if name not in manifest["deltas"]:
+            shutil.rmtree(os.path.join(segments_directory, name), ignore_errors=True)
+            LOG.info(f"Deleted unused segment {name}")
+
+
+def new_segment_directory(directory: str, manifest: dict) -> str:
+    """
+    Returns the directory of the next delta segment and counts it in the manifest.
+    """
+    name = f"delta-{manifest['next_segment']:06d}"
+    manifest["next_segment"] += 1
+    return os.path.join(directory, SEGMENTS_DIRECTORY, name)
+
+
+def build_delta_segment(directory: str = INDEX_DIRECTORY) -> str | None:
+    """
+    Indexes the relevant documents above the high-water mark into a new delta segment.
+
+    Returns:
+        str: Directory of the new delta segment, None if there are no new documents.
+    """
+    manifest = read_segments_manifest(directory)
+    start_time = time.perf_counter()
+    doc_ids, postings = index_documents(DocumentStreamer(start_id=manifest["high_water_mark"] + 1,
+                                                         columns=INDEX_COLUMNS))
+    if len(doc_ids) == 0:
+        LOG.info(f"No new documents above document {manifest['high_water_mark']}")
+        return None
+    delta_directory = new_segment_directory(directory, manifest)
+    write_index(delta_directory, doc_ids, postings)
+    if tfidf_vectorizers_exist(directory):
+        tfidf_vectorize_indexed_documents(delta_directory, read_tfidf_vectorizers(directory))
+    manifest["deltas"].append(os.path.basename(delta_directory))
+    manifest["high_water_mark"] = doc_ids[-1]
+    write_segments_manifest(directory, manifest)
+    LOG.info(f"Indexed {len(doc_ids)} new documents into {delta_directory} "
+             f"in {time.perf_counter() - start_time:.1f}s")
+    return delta_directory
+
+
+def merge_delta_segments(directory: str = INDEX_DIRECTORY, max_delta_segments: int = INDEX_MAX_DELTA_SEGMENTS):
+    """
+    Merges the delta segments into one if there are more than max_delta_segments.
+    """
+    manifest = read_segments_manifest(directory)
+    if len(manifest["deltas"]) <= max_delta_segments:
+        return
+    start_time = time.perf_counter()
+    delta_directories = segment_directories(directory, manifest)[1:]
+    merged_directory = new_segment_directory(directory, manifest)
+    merge_shards(delta_directories, merged_directory)
+    stack_tfidf_matrices(delta_directories, merged_directory)
+    manifest["deltas"] = [os.path.basename(merged_directory)]
+    write_segments_manifest(directory, manifest)
+    LOG.info(f"Merged {len(delta_directories)} delta segments into {merged_directory} "
+             f"in {time.perf_counter() - start_time:.1f}s")
+
+
+def update_index(directory: str = INDEX_DIRECTORY):
+    """
+    Adds the new documents to the current generation of the index as a delta segment
+    and merges the delta segments if needed.
+    """
+    directory = current_generation(directory)
+    if index_version(directory) is None:
+        LOG.warning(f"No index found at {directory}, build it with backend.build_index first")
+        return
+    delete_unused_segments(directory, read_segments_manifest(directory))
+    build_delta_segment(directory)
+    merge_delta_segments(directory)
+
+
+def main():
+    """
+    Updates the index every INDEX_UPDATE_INTERVAL seconds.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--once', action='store_true', help='Update the index once and exit')
+    args = parser.parse_args()
+    connect_to_database()
+    while True:
+        update_index()
+        if args.once:
+            break
+        time.sleep(INDEX_UPDATE_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
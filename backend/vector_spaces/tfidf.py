@@ -1,167 +1,169 @@
 """
-This module contains the TF-IDF vectorizer class and the function to train it.
+This module contains the functions to train the TF-IDF vectorizers
+and to vectorize the indexed documents into per-field sparse matrices.
+
+Training and vectorizing read the documents once, chunk by chunk, and feed every
+vector space from the same chunk. With TFIDF_BUILD_PROCESSES processes, the vector
+spaces are split between the processes, each reading only its columns.
 """
 import json
 import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable
 
 import numpy as np
-import peewee
 from dotenv import load_dotenv
+from scipy.sparse import csc_matrix, csr_matrix, vstack
 from sklearn.feature_extraction.text import TfidfVectorizer
-from tqdm import tqdm
 
-from backend.build_index import read_index_file
-from backend.streamers import DocumentTitleStringStreamer, DocumentMetaDescriptionStringStreamer, \
-    DocumentMetaKeywordsStringStreamer, DocumentMetaAuthorStringStreamer, DocumentH1StringStreamer, \
-    DocumentH2StringStreamer, DocumentH3StringStreamer, DocumentH4StringStreamer, DocumentH5StringStreamer, \
-    DocumentH6StringStreamer, DocumentBodyStringStreamer, DocumentStreamer
+from backend.build_index import INDEX_DIRECTORY
+from backend.inverted_index import InvertedIndex
+from backend.streamers import DocumentStreamer
 from crawler import utils
-from crawler.sql_models.base import BaseModel, PickleField
+from crawler.sql_models.base import DATABASE, connect_to_database
+from crawler.sql_models.document import Document
 
 load_dotenv()
-TFIDF_VECTORIZER_FILE = os.getenv("TFIDF_VECTORIZER_FILE")
 TFIDF_NGRAM_RANGE = tuple(json.loads(os.getenv("TFIDF_NGRAM_RANGE")))
+TFIDF_BUILD_PROCESSES = int(os.getenv("TFIDF_BUILD_PROCESSES", "1"))
 LOG = utils.get_logger(__file__)
 
 TFIDF_CANONICAL_ORDERING = ["title", "meta_description", "meta_keywords", "meta_author", "h1", "h2", "h3", "h4", "h5",
                             "h6", "body"]
+TFIDF_MATRICES_MANIFEST_FILE = "tfidf.json"
+TFIDF_VECTORIZERS_FILE = "tfidf_vectorizers.pickle"
+TFIDF_DTYPE = np.float32
 
 
-class Tfidf(BaseModel):
+def new_tfidf_vectorizer() -> TfidfVectorizer:
     """
-    This class represents a TF-IDF vector for a document.
-    The blob field contains vectors for the document.
+    Returns an unfitted TF-IDF vectorizer of a vector space.
     """
-    id = peewee.IntegerField(primary_key=True)
-    title = PickleField()
-    meta_description = PickleField()
-    meta_keywords = PickleField()
-    meta_author = PickleField()
-    h1 = PickleField()
-    h2 = PickleField()
-    h3 = PickleField()
-    h4 = PickleField()
-    h5 = PickleField()
-    h6 = PickleField()
-    body = PickleField()
+    return TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE)
 
-    class Meta:
-        """
-        This class represents the metadata for the TF-IDF model.
-        """
-        table_name = 'tfidfs'
-
-    def not_null_vectors(self) -> dict[str, np.array]:
-        returned_vectors = dict()
-        if self.title is not None:
-            returned_vectors["title"] = self.title
-        if self.meta_description is not None:
-            returned_vectors["meta_description"] = self.meta_description
-        if self.meta_keywords is not None:
-            returned_vectors["meta_keywords"] = self.meta_keywords
-        if self.meta_author is not None:
-            returned_vectors["meta_author"] = self.meta_author
-        if self.h1 is not None:
-            returned_vectors["h1"] = self.h1
-        if self.h2 is not None:
-            returned_vectors["h2"] = self.h2
-        if self.h3 is not None:
-            returned_vectors["h3"] = self.h3
-        if self.h4 is not None:
-            returned_vectors["h4"] = self.h4
-        if self.h5 is not None:
-            returned_vectors["h5"] = self.h5
-        if self.h6 is not None:
-            returned_vectors["h6"] = self.h6
-        if self.body is not None:
-            returned_vectors["body"] = self.body
-        return returned_vectors
-
-
-def train_tf_idf_vectorizer():
+
+def field_strings(documents: list[Document], name: str) -> list[str]:
+    """
+    Returns the tokens of a field of the documents, joined to one string per document.
+    """
+    return [" ".join(getattr(document, f"{name}_tokens")) for document in documents]
+
+
+def fit_tfidf_vectorizer(document_frequencies: Counter, num_documents: int) -> TfidfVectorizer:
+    """
+    Returns a vectorizer fitted from the document frequencies of the terms, as TfidfVectorizer.fit
+    would fit it on the documents: the terms are sorted and the IDF is smoothed.
+    """
+    if len(document_frequencies) == 0:
+        raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+    terms = sorted(document_frequencies)
+    frequencies = np.fromiter((document_frequencies[term] for term in terms), dtype=np.float64, count=len(terms))
+    vectorizer = TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE, vocabulary=terms)
+    vectorizer.idf_ = np.log((1 + num_documents) / (1 + frequencies)) + 1
+    return vectorizer
+
+
+def fit_tfidf_vectorizers(doc_ids: list[int], names: list[str]) -> dict[str, TfidfVectorizer]:
+    """
+    Fits the vectorizers of the vector spaces in one pass over the documents.
+    The document frequencies of the terms of all vector spaces are counted chunk by chunk.
+    A vector space without any term gets an unfitted vectorizer.
+    """
+    analyzers = {name: new_tfidf_vectorizer().build_analyzer() for name in names}
+    document_frequencies = {name: Counter() for name in names}
+
+    def count(name: str):
+        def consume(documents: list[Document]):
+            for string in field_strings(documents, name):
+                document_frequencies[name].update(set(analyzers[name](string)))
+        return consume
+
+    DocumentStreamer(doc_ids, columns=[f"{name}_tokens" for name in names]).feed([count(name) for name in names])
+    vectorizers = {}
+    for name in names:
+        try:
+            vectorizers[name] = fit_tfidf_vectorizer(document_frequencies[name], len(doc_ids))
+            LOG.info(f"Fitted {name} vectorizer with {len(vectorizers[name].vocabulary_)} terms")
+        except ValueError as exception:
+            vectorizers[name] = new_tfidf_vectorizer()
+            LOG.error(f"Error while fitting {name} vectorizer {exception}")
+    return vectorizers
+
+
+def vectorize_documents(doc_ids: list[int], vectorizers: dict[str, TfidfVectorizer]) -> dict[str, csr_matrix]:
+    """
+    Vectorizes the documents in one pass, chunk by chunk, into one matrix per vector space.
+    Vector spaces with an unfitted vectorizer are left out.
+    """
+    chunks = {name: [] for name, vectorizer in vectorizers.items() if hasattr(vectorizer, "vocabulary_")}
+    for name in vectorizers.keys() - chunks.keys():
+        LOG.error(f"Error while transforming {name}: the vectorizer is not fitted")
+
+    def transform(name: str):
+        def consume(documents: list[Document]):
+            chunks[name].append(vectorizers[name].transform(field_strings(documents, name)).astype(TFIDF_DTYPE))
+        return consume
+
+    DocumentStreamer(doc_ids, columns=[f"{name}_tokens" for name in chunks]).feed([transform(name) for name in chunks])
+    return {name: vstack(chunks[name], format="csr") if chunks[name]
+            else csr_matrix((0, len(vectorizers[name].vocabulary_)), dtype=TFIDF_DTYPE)
+            for name in chunks}
+
+
+def map_vector_spaces(function: Callable[[list[int], Any], dict], doc_ids: list[int], groups: list,
+                      processes: int) -> dict:
+    """
+    Calls function(doc_ids, group) for every group of vector spaces, in parallel processes if
+    there are several, and merges the returned dictionaries. Every process reads only the
+    columns of its group, so every column is still read once.
+    """
+    if processes <= 1 or len(groups) <= 1:
+        return {name: result for group in groups for name, result in function(doc_ids, group).items()}
+    # Every process opens its own connection, the connection of this process can not be shared.
+    DATABASE.close()
+    with ProcessPoolExecutor(min(processes, len(groups)), initializer=connect_to_database) as pool:
+        return {name: result for results in pool.map(function, [doc_ids] * len(groups), groups)
+                for name, result in results.items()}
+
+
+def partition_vector_spaces(processes: int) -> list[list[str]]:
+    """
+    Splits the vector spaces into one group per process. Without parallelism, there is one group.
+    """
+    processes = max(1, min(processes, len(TFIDF_CANONICAL_ORDERING)))
+    return [TFIDF_CANONICAL_ORDERING[i::processes] for i in range(processes)]
+
+
+def train_tf_idf_vectorizer(directory: str = INDEX_DIRECTORY, processes: int = TFIDF_BUILD_PROCESSES):
     """
     Train the TF-IDF vectorizer using the relevant document tokens.
 
-    The TF-IDF vectorizer is fitted on the concatenated sentences from the relevant documents.
-    The fitted vectorizer is then saved as a pickle file.
+    The TF-IDF vectorizers of all vector spaces are fitted on the documents of the index in directory
+    in a single pass over the documents, or one pass per process over its columns.
+    The fitted vectorizers are then saved as a pickle file next to the index.
     """
     LOG.info("Start build global tfidf")
-    vectorizers = {
-        "title": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "meta_description": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "meta_keywords": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "meta_author": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "h1": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "h2": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "h3": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "h4": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "h5": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "h6": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-        "body": TfidfVectorizer(ngram_range=TFIDF_NGRAM_RANGE),
-    }
-    _, doc_ids = read_index_file()
-    try:
-        vectorizers["title"].fit(DocumentTitleStringStreamer(doc_ids))
-        LOG.info("Fitted title vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting title vectorizer {exception}")
-    try:
-        vectorizers["meta_description"].fit(DocumentMetaDescriptionStringStreamer(doc_ids))
-        LOG.info("Fitted meta_description vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting meta_description vectorizer {exception}")
-    try:
-        vectorizers["meta_keywords"].fit(DocumentMetaKeywordsStringStreamer(doc_ids))
-        LOG.info("Fitted meta_keywords vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting meta_keywords vectorizer {exception}")
-    try:
-        vectorizers["meta_author"].fit(DocumentMetaAuthorStringStreamer(doc_ids))
-        LOG.info("Fitted meta_author vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting meta_author vectorizer {exception}")
-    try:
-        vectorizers["h1"].fit(DocumentH1StringStreamer(doc_ids))
-        LOG.info("Fitted h1 vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting h1 vectorizer {exception}")
-    try:
-        vectorizers["h2"].fit(DocumentH2StringStreamer(doc_ids))
-        LOG.info("Fitted h2 vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting h2 vectorizer {exception}")
-    try:
-        vectorizers["h3"].fit(DocumentH3StringStreamer(doc_ids))
-        LOG.info("Fitted h3 vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting h3 vectorizer {exception}")
-    try:
-        vectorizers["h4"].fit(DocumentH4StringStreamer(doc_ids))
-        LOG.info("Fitted h4 vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting h4 vectorizer {exception}")
-    try:
-        vectorizers["h5"].fit(DocumentH5StringStreamer(doc_ids))
-        LOG.info("Fitted h5 vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting h5 vectorizer {exception}")
-    try:
-        vectorizers["h6"].fit(DocumentH6StringStreamer(doc_ids))
-        LOG.info("Fitted h6 vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting h6 vectorizer {exception}")
-    try:
-        vectorizers["body"].fit(DocumentBodyStringStreamer(doc_ids))
-        LOG.info("Fitted body vectorizer")
-    except Exception as exception:
-        LOG.error(f"Error while fitting body vectorizer {exception}")
-    utils.io.write_pickle_file(vectorizers, TFIDF_VECTORIZER_FILE)
-    LOG.info(f"Wrote TF-IDF file to {TFIDF_VECTORIZER_FILE}")
-
-
-def read_tfidf_vectorizers() -> dict[str, TfidfVectorizer]:
-    """
-    Read the TF-IDF vectorizers from the pickle file.
+    start_time = time.perf_counter()
+    doc_ids = InvertedIndex(directory).doc_ids.tolist()
+    vectorizers = map_vector_spaces(fit_tfidf_vectorizers, doc_ids, partition_vector_spaces(processes), processes)
+    vectorizers = {name: vectorizers[name] for name in TFIDF_CANONICAL_ORDERING}
+    path = os.path.join(directory, TFIDF_VECTORIZERS_FILE)
+    utils.io.write_pickle_file(vectorizers, path)
+    LOG.info(f"Wrote TF-IDF file to {path} in {time.perf_counter() - start_time:.1f}s")
+
+
+def tfidf_vectorizers_exist(directory: str = INDEX_DIRECTORY) -> bool:
+    """
+    Returns true if the TF-IDF vectorizers of the index in directory were trained.
+    """
+    return os.path.exists(os.path.join(directory, TFIDF_VECTORIZERS_FILE))
+
+
+def read_tfidf_vectorizers(directory: str = INDEX_DIRECTORY) -> dict[str, TfidfVectorizer]:
+    """
+    Read the TF-IDF vectorizers of the index in directory from the pickle file.
     The structure of the returned dictionary is as follows:
     {
         "title": TfidfVectorizer,
@@ -177,67 +179,178 @@ def read_tfidf_vectorizers() -> dict[str, TfidfVectorizer]:
         "body": TfidfVectorizer,
     }
     """
-    return utils.io.read_pickle_file(TFIDF_VECTORIZER_FILE)
+    return utils.io.read_pickle_file(os.path.join(directory, TFIDF_VECTORIZERS_FILE))
 
 
-def tfidf_vectorize_indexed_documents():
+def tfidf_vectorize_indexed_documents(directory: str = INDEX_DIRECTORY,
+                                      vectorizers: dict[str, TfidfVectorizer] = None,
+                                      processes: int = TFIDF_BUILD_PROCESSES):
     """
     Vectorize the indexed documents with the global TF-IDF.
+
+    Every vector space gets one CSR matrix with one row per indexed document,
+    in the same row order as the inverted index. The documents are transformed in
+    chunks, in a single pass, and the matrices are written next to the index, see write_tfidf_matrix.
+
+    Args:
+        directory (str): Directory of the index, or of a delta segment of the index.
+        vectorizers (dict[str, TfidfVectorizer]): The vectorizers. By default, the vectorizers of the index in directory.
+        processes (int): Number of processes vectorizing groups of vector spaces in parallel.
     """
-    LOG.info("Start vectorize database's documents with the global TF-IDF to database")
-    _, doc_ids = read_index_file()
-    vectorizers = read_tfidf_vectorizers()
-    for document in tqdm(DocumentStreamer(doc_ids)):
-        try:
-            tfidf, _ = Tfidf.get_or_create(id=document.id)
-            try:
-                tfidf.title = vectorizers["title"].transform([" ".join(document.title_tokens)])[0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming title {exception}")
-            try:
-                tfidf.meta_description = \
-                    vectorizers["meta_description"].transform([" ".join(document.meta_description_tokens)])[
-                        0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming meta_description {exception}")
-            try:
-                tfidf.meta_keywords = vectorizers["meta_keywords"].transform([" ".join(document.meta_keywords_tokens)])[
-                    0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming meta_keywords {exception}")
-            try:
-                tfidf.meta_author = vectorizers["meta_author"].transform([" ".join(document.meta_author_tokens)])[0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming meta_author {exception}")
-            try:
-                tfidf.h1 = vectorizers["h1"].transform([" ".join(document.h1_tokens)])[0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming h1 {exception}")
-            try:
-                tfidf.h2 = vectorizers["h2"].transform([" ".join(document.h2_tokens)])[0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming h2 {exception}")
-            try:
-                tfidf.h3 = vectorizers["h3"].transform([" ".join(document.h3_tokens)])[0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming h3 {exception}")
-            try:
-                tfidf.h4 = vectorizers["h4"].transform([" ".join(document.h4_tokens)])[0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming h4 {exception}")
-            try:
-                tfidf.h5 = vectorizers["h5"].transform([" ".join(document.h5_tokens)])[0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming h5 {exception}")
-            try:
-                tfidf.h6 = vectorizers["h6"].transform([" ".join(document.h6_tokens)])[0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming h6 {exception}")
-            try:
-                tfidf.body = vectorizers["body"].transform([" ".join(document.body_tokens)])[0]
-            except Exception as exception:
-                LOG.error(f"Error while transforming body {exception}")
-            tfidf.save()
-        except Exception as exception:
-            LOG.error(f"Can not write results of global TF-IDF of one entry to database: {exception}")
-    LOG.info("Finished vectorize database's documents with the global TF-IDF to database")
+    LOG.info(f"Start vectorize indexed documents of {directory} with the global TF-IDF")
+    start_time = time.perf_counter()
+    doc_ids = InvertedIndex(directory).doc_ids.tolist()
+    vectorizers = read_tfidf_vectorizers(directory) if vectorizers is None else vectorizers
+    groups = [{name: vectorizers[name] for name in group if name in vectorizers}
+              for group in partition_vector_spaces(processes)]
+    matrices = map_vector_spaces(vectorize_documents, doc_ids, groups, processes)
+    shapes = {}
+    for name in TFIDF_CANONICAL_ORDERING:
+        if name in matrices:
+            write_tfidf_matrix(name, matrices[name], directory)
+            shapes[name] = list(matrices[name].shape)
+            LOG.info(f"Wrote {name} TF-IDF matrix of shape {matrices[name].shape}")
+    utils.io.write_json_file(shapes, os.path.join(directory, TFIDF_MATRICES_MANIFEST_FILE))
+    LOG.info(f"Finished vectorize indexed documents with the global TF-IDF in {time.perf_counter() - start_time:.1f}s")
+
+
+def write_tfidf_matrix(name: str, matrix: csr_matrix, directory: str = INDEX_DIRECTORY):
+    """
+    Write the matrix of a vector space as numpy arrays, so it can be opened memory-mapped.
+
+    Besides the document-major CSR matrix, the term-major CSC matrix and the maximum
+    weight of every term are written. They serve as weighted postings for top-k retrieval.
+    """
+    matrix = csr_matrix(matrix, dtype=TFIDF_DTYPE)
+    matrix.sort_indices()
+    np.save(os.path.join(directory, f"{name}.tfidf_data.npy"), matrix.data)
+    np.save(os.path.join(directory, f"{name}.tfidf_indices.npy"), matrix.indices)
+    np.save(os.path.join(directory, f"{name}.tfidf_indptr.npy"), matrix.indptr)
+    term_matrix = matrix.tocsc()
+    term_matrix.sort_indices()
+    np.save(os.path.join(directory, f"{name}.tfidf_csc_data.npy"), term_matrix.data)
+    np.save(os.path.join(directory, f"{name}.tfidf_csc_indices.npy"), term_matrix.indices)
+    np.save(os.path.join(directory, f"{name}.tfidf_csc_indptr.npy"), term_matrix.indptr)
+    np.save(os.path.join(directory, f"{name}.tfidf_max.npy"),
+            np.asarray(term_matrix.max(axis=0).todense(), dtype=TFIDF_DTYPE).ravel())
+
+
+def read_tfidf_matrices(directory: str = INDEX_DIRECTORY) -> dict[str, csr_matrix]:
+    """
+    Open the TF-IDF matrices of all vector spaces memory-mapped.
+    Row i of each matrix is the TF-IDF vector of the document in row i of the inverted index.
+    The structure of the returned dictionary is as follows:
+    {
+        "title": csr_matrix,
+        ...
+        "body": csr_matrix,
+    }
+    Vector spaces that could not be vectorized are missing.
+    """
+    shapes = utils.io.read_json_file(os.path.join(directory, TFIDF_MATRICES_MANIFEST_FILE))
+    matrices = {}
+    for name, shape in shapes.items():
+        data = np.load(os.path.join(directory, f"{name}.tfidf_data.npy"), mmap_mode="r")
+        indices = np.load(os.path.join(directory, f"{name}.tfidf_indices.npy"), mmap_mode="r")
+        indptr = np.load(os.path.join(directory, f"{name}.tfidf_indptr.npy"), mmap_mode="r")
+        matrices[name] = csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+    return matrices
+
+
+def read_tfidf_term_matrices(directory: str = INDEX_DIRECTORY) -> dict[str, csc_matrix]:
+    """
+    Open the term-major TF-IDF matrices of all vector spaces memory-mapped.
+    Column j of each matrix holds the weights of term j of the vectorizer in all documents.
+    """
+    shapes = utils.io.read_json_file(os.path.join(directory, TFIDF_MATRICES_MANIFEST_FILE))
+    matrices = {}
+    for name, shape in shapes.items():
+        data = np.load(os.path.join(directory, f"{name}.tfidf_csc_data.npy"), mmap_mode="r")
+        indices = np.load(os.path.join(directory, f"{name}.tfidf_csc_indices.npy"), mmap_mode="r")
+        indptr = np.load(os.path.join(directory, f"{name}.tfidf_csc_indptr.npy"), mmap_mode="r")
+        matrices[name] = csc_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+    return matrices
+
+
+def read_tfidf_max_weights(directory: str = INDEX_DIRECTORY) -> dict[str, np.ndarray]:
+    """
+    Open the maximum weight of every term of all vector spaces memory-mapped.
+    """
+    shapes = utils.io.read_json_file(os.path.join(directory, TFIDF_MATRICES_MANIFEST_FILE))
+    return {name: np.load(os.path.join(directory, f"{name}.tfidf_max.npy"), mmap_mode="r") for name in shapes}
+
+
+def stack_tfidf_matrices(directories: list[str], directory: str):
+    """
+    Writes the TF-IDF matrices of several segments, stacked by rows, as the matrices of one segment.
+    Vector spaces missing in any of the segments are left out.
+    """
+    if not all(os.path.exists(os.path.join(segment, TFIDF_MATRICES_MANIFEST_FILE)) for segment in directories):
+        LOG.warning(f"Not all segments of {directory} are vectorized, the TF-IDF matrices are not stacked")
+        return
+    matrices = [read_tfidf_matrices(segment) for segment in directories]
+    shapes = {}
+    for name in TFIDF_CANONICAL_ORDERING:
+        if all(name in segment_matrices for segment_matrices in matrices):
+            matrix = vstack([segment_matrices[name] for segment_matrices in matrices], format="csr")
+            write_tfidf_matrix(name, matrix, directory)
+            shapes[name] = list(matrix.shape)
+    utils.io.write_json_file(shapes, os.path.join(directory, TFIDF_MATRICES_MANIFEST_FILE))
+
+
+class TFIDFMatrices:
+    """
+    The TF-IDF matrices of the segments of the index, with the rows of the segments stacked.
+    The matrices of the segments are not copied. A vector space missing in a segment
+    has no weights in the documents of the segment.
+    """
+
+    def __init__(self, directories: list[str], row_offsets: list[int]):
+        """
+        Args:
+            directories (list[str]): Directories of the segments, in the order of their rows.
+            row_offsets (list[int]): Row of the first document of each segment.
+        """
+        self.row_offsets = list(row_offsets)
+        self.matrices = [read_tfidf_matrices(directory) for directory in directories]
+        self.term_matrices = [read_tfidf_term_matrices(directory) for directory in directories]
+        self.max_weights = [read_tfidf_max_weights(directory) for directory in directories]
+        self.names = set(self.matrices[0])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
+
+    def rows(self, name: str, rows: np.ndarray) -> csr_matrix:
+        """
+        Returns the TF-IDF vectors of the documents in the sorted rows of a vector space.
+        """
+        if len(self.matrices) == 1:
+            return self.matrices[0][name][rows]
+        rows = np.asarray(rows, dtype=np.int64)
+        ends = np.searchsorted(rows, self.row_offsets[1:] + [np.iinfo(np.int64).max])
+        starts = [0] + ends[:-1].tolist()
+        num_columns = self.matrices[0][name].shape[1]
+        return vstack([matrices[name][rows[start:end] - offset] if name in matrices
+                       else csr_matrix((end - start, num_columns), dtype=TFIDF_DTYPE)
+                       for matrices, offset, start, end in zip(self.matrices, self.row_offsets, starts, ends)],
+                      format="csr")
+
+    def postings(self, name: str, column: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the sorted rows of the documents containing term column of a vector space and its weights.
+        """
+        rows, weights = [], []
+        for term_matrices, offset in zip(self.term_matrices, self.row_offsets):
+            if name not in term_matrices:
+                continue
+            term_matrix = term_matrices[name]
+            start, end = term_matrix.indptr[column], term_matrix.indptr[column + 1]
+            rows.append(np.asarray(term_matrix.indices[start:end], dtype=np.int64) + offset)
+            weights.append(term_matrix.data[start:end])
+        return np.concatenate(rows), np.concatenate(weights)
+
+    def max_weight(self, name: str, column: int) -> float:
+        """
+        Returns the maximum weight of term column of a vector space in any document.
+        """
+        return max(float(max_weights[name][column]) for max_weights in self.max_weights if name in max_weights)
@@ -0,0 +1,372 @@
+"""
+This module keeps the frontier of the crawler in memory.
+
+Pending jobs are held in one heap per server, ordered by priority, and in a heap of
+servers ordered by the priority of their best pending job. Reserving k jobs takes
+O(k log n) and never touches the database. Like the SQL priority queue, at most
+CRAWLER_MANAGER_MAX_JOBS_PER_SERVER jobs of the same server are handed out at once.
+
+The frontier holds at most CRAWLER_MANAGER_FRONTIER_CAPACITY jobs. Jobs created
+while it is full stay in the database only, and the frontier is refilled from the
+jobs table once it is less than half full.
+
+Reservations are leases, which workers renew while they crawl. The frontier
+knows the leases it granted; expired ones put the jobs back into the frontier.
+
+Writes are behind: a background thread persists leases and inserts new jobs
+in batches every CRAWLER_MANAGER_FLUSH_INTERVAL seconds, or as soon as
+CRAWLER_MANAGER_FLUSH_SIZE writes are pending. New jobs can be reserved once they
+are inserted. On restart, the frontier is recovered from the pending jobs of the
+table, and leases granted before the restart expire in the database. Reservations
+not flushed before a crash are handed out again, and new jobs not flushed before
+a crash are lost.
+"""
+import datetime
+import heapq
+import os
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+from crawler import utils
+from crawler.manager.priority_queue import CRAWLER_MANAGER_MAX_JOBS_PER_SERVER, expired_leases, lease_expiry
+from crawler.sql_models.base import dotdict
+from crawler.sql_models.job import Job
+
+load_dotenv()
+
+CRAWLER_MANAGER_FRONTIER_CAPACITY = int(os.getenv("CRAWLER_MANAGER_FRONTIER_CAPACITY", "1000000"))
+CRAWLER_MANAGER_FLUSH_INTERVAL = float(os.getenv("CRAWLER_MANAGER_FLUSH_INTERVAL", "1"))
+CRAWLER_MANAGER_FLUSH_SIZE = int(os.getenv("CRAWLER_MANAGER_FLUSH_SIZE", "1000"))
+SQL_CHUNK_SIZE = 1000
+LOG = utils.get_logger(__file__)
+
+
+@dataclass(frozen=True)
+class FrontierJob:
+    """
+    A pending job of the frontier.
+    """
+    id: int  # pylint: disable=invalid-name
+    url: str
+    server_id: int
+    priority: float
+
+    def to_dotdict(self) -> dotdict:
+        """
+        Returns the job as sent to the workers.
+        """
+        return dotdict(id=self.id, url=self.url, server_id=self.server_id)
+
+
+@dataclass(frozen=True)
+class Lease:
+    """
+    A reservation of a job by a worker.
+    """
+    worker_id: str
+    expires_at: datetime.datetime
+
+
+def chunks(items: list, size: int = SQL_CHUNK_SIZE):
+    """
+    Splits a list into chunks of at most the given size.
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class Frontier:  # pylint: disable=too-many-instance-attributes
+    """
+    Thread-safe in-memory frontier with write-behind persistence.
+    """
+
+    def __init__(self, capacity: int = CRAWLER_MANAGER_FRONTIER_CAPACITY,
+                 flush_interval: float = CRAWLER_MANAGER_FLUSH_INTERVAL,
+                 flush_size: int = CRAWLER_MANAGER_FLUSH_SIZE,
+                 start: bool = True):
+        """
+        Args:
+            capacity (int): Maximum number of pending jobs held in memory.
+            flush_interval (float): Seconds between two flushes.
+            flush_size (int): Number of pending writes which trigger a flush.
+            start (bool): Recover the frontier from the database and start flushing.
+        """
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # Pending jobs: heap of (-priority, id) per server, and heap of (-best priority, server ID).
+        self.jobs: dict[int, FrontierJob] = {}
+        self.server_jobs: dict[int, list[tuple[float, int]]] = {}
+        self.servers: list[tuple[float, int]] = []
+        self.server_priorities: dict[int, float] = {}
+        self.reserved: dict[int, FrontierJob] = {}
+        self.leases: dict[int, Lease] = {}
+        # True if every pending job of the database is in memory.
+        self.complete = True
+        # Writes not yet persisted. None releases the lease of a job.
+        self.pending_leases: dict[int, Lease] = {}
+        self.pending_new_jobs: list[dict] = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake_up = threading.Event()
+        if start:
+            self.refill()
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def _push_server(self, server_id: int):
+        best_priority = self.server_jobs[server_id][0][0]
+        if self.server_priorities.get(server_id) != best_priority:
+            self.server_priorities[server_id] = best_priority
+            heapq.heappush(self.servers, (best_priority, server_id))
+
+    def _add(self, job: FrontierJob) -> bool:
+        if job.id in self.jobs or job.id in self.reserved:
+            return True
+        if len(self.jobs) >= self.capacity:
+            self.complete = False
+            return False
+        self.jobs[job.id] = job
+        heapq.heappush(self.server_jobs.setdefault(job.server_id, []), (-job.priority, job.id))
+        self._push_server(job.server_id)
+        return True
+
+    def _pop_server(self) -> int:
+        """
+        Removes the server with the best pending job from the heap of servers and returns its ID.
+        Entries of servers whose best priority changed meanwhile are skipped.
+        """
+        while self.servers:
+            priority, server_id = heapq.heappop(self.servers)
+            if self.server_priorities.get(server_id) == priority:
+                del self.server_priorities[server_id]
+                return server_id
+        return None
+
+    def get_next_jobs(self, n_jobs: int, worker_id: str = None) -> list[dotdict]:
+        """
+        Leases the jobs of highest priority to a worker, at most CRAWLER_MANAGER_MAX_JOBS_PER_SERVER per server.
+
+        Returns:
+            list[dotdict]: The reserved jobs with their IDs, URLs and server IDs.
+        """
+        lease = Lease(worker_id, lease_expiry())
+        with self.lock:
+            jobs = []
+            served_servers = []
+            while len(jobs) < n_jobs and (server_id := self._pop_server()) is not None:
+                served_servers.append(server_id)
+                heap = self.server_jobs[server_id]
+                limit = len(jobs) + min(CRAWLER_MANAGER_MAX_JOBS_PER_SERVER, n_jobs - len(jobs))
+                while len(jobs) < limit and heap:
+                    _, job_id = heapq.heappop(heap)
+                    # Entries of jobs finished while they were pending are skipped.
+                    job = self.jobs.pop(job_id, None)
+                    if job is None:
+                        continue
+                    self.reserved[job_id] = job
+                    self.leases[job_id] = lease
+                    self.pending_leases[job_id] = lease
+                    jobs.append(job.to_dotdict())
+            for server_id in served_servers:
+                if self.server_jobs[server_id]:
+                    self._push_server(server_id)
+                else:
+                    del self.server_jobs[server_id]
+            self._compact()
+        self._wake_up_if_needed()
+        LOG.info(f"Reserved {len(jobs)} jobs from the frontier, {len(self.jobs)} jobs left.")
+        return jobs
+
+    def _compact(self):
+        # Rebuild the heap of servers once it mostly consists of outdated entries.
+        if len(self.servers) > 2 * len(self.server_priorities) + 1024:
+            self.servers = [(priority, server_id) for server_id, priority in self.server_priorities.items()]
+            heapq.heapify(self.servers)
+
+    def unreserve_jobs(self, job_ids: list[int]):
+        """
+        Puts reserved jobs back into the frontier.
+        """
+        unknown_job_ids = []
+        with self.lock:
+            for job_id in job_ids:
+                job = self.reserved.pop(job_id, None)
+                if job is None:
+                    unknown_job_ids.append(job_id)
+                    continue
+                del self.leases[job_id]
+                self.pending_leases[job_id] = None
+                self._add(job)
+        # Jobs reserved before a restart are only known to the database.
+        for chunk in chunks(unknown_job_ids):
+            Job.update(being_crawled=False, worker_id=None, lease_expires_at=None).where(Job.id.in_(chunk)).execute()
+        if unknown_job_ids:
+            with self.lock:
+                self.complete = False
+        self._wake_up_if_needed()
+
+    def finish_jobs(self, job_ids: list[int]):
+        """
+        Forgets jobs which were marked as done in the database. Jobs whose lease expired
+        were put back into the frontier and are removed from it, so they are not crawled again.
+        """
+        with self.lock:
+            for job_id in job_ids:
+                self.reserved.pop(job_id, None)
+                self.jobs.pop(job_id, None)
+                self.leases.pop(job_id, None)
+                self.pending_leases.pop(job_id, None)
+
+    def renew_leases(self, job_ids: list[int], worker_id: str) -> int:
+        """
+        Extends the leases of jobs still leased to the worker.
+
+        Returns:
+            int: Number of renewed leases.
+        """
+        lease = Lease(worker_id, lease_expiry())
+        renewed, unknown_job_ids = 0, []
+        with self.lock:
+            for job_id in job_ids:
+                if job_id not in self.leases:
+                    unknown_job_ids.append(job_id)
+                elif self.leases[job_id].worker_id == worker_id:
+                    self.leases[job_id] = self.pending_leases[job_id] = lease
+                    renewed += 1
+        # Jobs reserved before a restart are only known to the database.
+        for chunk in chunks(unknown_job_ids):
+            renewed += Job.update(lease_expires_at=lease.expires_at).where(
+                Job.id.in_(chunk) & (Job.worker_id == worker_id) & (Job.being_crawled == True)  # pylint: disable=singleton-comparison
+            ).execute()
+        self._wake_up_if_needed()
+        return renewed
+
+    def release_expired_leases(self) -> int:
+        """
+        Puts the jobs whose leases expired back into the frontier.
+
+        Returns:
+            int: Number of released jobs.
+        """
+        now = datetime.datetime.now()
+        with self.lock:
+            expired_job_ids = [job_id for job_id, lease in self.leases.items() if lease.expires_at < now]
+        self.unreserve_jobs(expired_job_ids)
+        # Leases granted before a restart are only known to the database.
+        job_ids = [job.id for job in Job.select(Job.id).where(expired_leases()).limit(SQL_CHUNK_SIZE).objects()]
+        with self.lock:
+            job_ids = [job_id for job_id in job_ids if job_id not in self.reserved]
+        released = 0
+        if job_ids:
+            released = Job.update(being_crawled=False, worker_id=None, lease_expires_at=None).where(
+                Job.id.in_(job_ids) & expired_leases()).execute()
+            with self.lock:
+                self.complete = False
+            self._wake_up_if_needed()
+        return len(expired_job_ids) + released
+
+    def add_jobs(self, new_jobs: list[dict]):
+        """
+        Queues new jobs to be inserted into the database. They can be reserved once they are inserted.
+        """
+        with self.lock:
+            self.pending_new_jobs.extend(new_jobs)
+        self._wake_up_if_needed()
+
+    def _wake_up_if_needed(self):
+        with self.lock:
+            needs_refill = not self.complete and len(self.jobs) < self.capacity // 2
+            if len(self.pending_leases) + len(self.pending_new_jobs) >= self.flush_size or needs_refill:
+                self.wake_up.set()
+
+    def flush(self):
+        """
+        Persists the pending leases and inserts the new jobs.
+        Inserted jobs are added to the frontier.
+        """
+        with self.flush_lock:
+            with self.lock:
+                leases, self.pending_leases = self.pending_leases, {}
+                new_jobs, self.pending_new_jobs = self.pending_new_jobs, []
+            if not leases and not new_jobs:
+                return
+            try:
+                with Job._meta.database.atomic():  # pylint: disable=no-member,protected-access
+                    # Leases granted or renewed together share their values and are written together.
+                    job_ids_by_lease = defaultdict(list)
+                    for job_id, lease in leases.items():
+                        job_ids_by_lease[lease].append(job_id)
+                    for lease, job_ids in job_ids_by_lease.items():
+                        values = {"being_crawled": False, "worker_id": None, "lease_expires_at": None}
+                        if lease is not None:
+                            values = {"being_crawled": True, "worker_id": lease.worker_id,
+                                      "lease_expires_at": lease.expires_at}
+                        for chunk in chunks(job_ids):
+                            # Jobs finished meanwhile must not be marked as being crawled again.
+                            Job.update(**values).where(
+                                Job.id.in_(chunk) & (Job.done == False)).execute()  # pylint: disable=singleton-comparison
+                    for chunk in chunks(new_jobs):
+                        Job.insert_many(chunk).on_conflict_ignore().execute()
+            except Exception as exception:
+                LOG.error(f"Error while flushing the frontier: {exception}")
+                with self.lock:
+                    self.pending_leases = {**leases, **self.pending_leases}
+                    self.pending_new_jobs = new_jobs + self.pending_new_jobs
+                return
+            inserted_jobs = []
+            for chunk in chunks(list({job["url"] for job in new_jobs})):
+                inserted_jobs.extend(Frontier.select_pending_jobs(Job.url.in_(chunk)))
+            with self.lock:
+                for job in inserted_jobs:
+                    self._add(job)
+        LOG.info(f"Flushed {len(leases)} leases and {len(new_jobs)} new jobs.")
+
+    @staticmethod
+    def select_pending_jobs(condition=None, limit: int = None) -> list[FrontierJob]:
+        """
+        Selects pending jobs from the database, best first.
+        """
+        query = Job.select(Job.id, Job.url, Job.server_id, Job.priority).where(
+            (Job.done == False) & (Job.being_crawled == False))  # pylint: disable=singleton-comparison
+        if condition is not None:
+            query = query.where(condition)
+        if limit is not None:
+            query = query.order_by(Job.priority.desc()).limit(limit)
+        return [FrontierJob(row.id, row.url, row.server_id, row.priority) for row in query.objects()]
+
+    def refill(self):
+        """
+        Loads the pending jobs of highest priority from the database.
+        """
+        self.flush()
+        with self.flush_lock:
+            jobs = Frontier.select_pending_jobs(limit=self.capacity)
+            with self.lock:
+                self.complete = len(jobs) < self.capacity
+                for job in jobs:
+                    if not self._add(job):
+                        self.complete = False
+                        break
+        LOG.info(f"Loaded {len(self.jobs)} jobs into the frontier.")
+
+    def run(self):
+        """
+        Flushes and refills the frontier in the background.
+        """
+        while True:
+            self.wake_up.wait(self.flush_interval)
+            self.wake_up.clear()
+            try:
+                self.flush()
+                with self.lock:
+                    needs_refill = not self.complete and len(self.jobs) < self.capacity // 2
+                if needs_refill:
+                    self.refill()
+            except Exception as exception:
+                LOG.error(f"Error in the frontier thread: {exception}")
@@ -1,18 +1,23 @@
+import atexit
 import functools
 import json
 import os
+import threading
+import time
 
 from dotenv import load_dotenv
 from flask import Flask, jsonify, request
 
-from crawler.manager.server_importance import server_importance
+from crawler.manager.frontier import Frontier
 from crawler.manager.priority_queue import PriorityQueue
+from crawler.manager.server_registry import ServerRegistry
 from crawler.worker.url_relevance import URL
-from crawler.sql_models.base import connect_to_database, dotdict
+from crawler.sql_models.base import DATABASE, connect_to_database, dotdict
 from crawler.sql_models.document import Document
 from crawler.sql_models.job import Job
-from crawler.sql_models.server import Server
+from crawler.utils.io import decompress_json_lines
 from crawler.utils.log import get_logger
+from crawler.utils.token_store import TOKEN_FIELDS, TOKEN_STORE_DIRECTORY, TokenStoreWriter
 
 load_dotenv()
 connect_to_database()
@@ -22,9 +27,60 @@ CRAWLER_MANAGER_PORT = int(os.getenv("CRAWLER_MANAGER_PORT"))
 CRAWLER_MANAGER_PASSWORD = os.getenv("CRAWLER_MANAGER_PASSWORD")
 CRAWLER_MANAGER_PASSWORD_QUERY = os.getenv("CRAWLER_MANAGER_PASSWORD_QUERY")
 CRAWLER_MANAGER_MAX_JOB_REQUESTS = int(os.getenv("CRAWLER_MANAGER_MAX_JOB_REQUESTS"))
-PRIORITY_QUEUE = PriorityQueue()
+CRAWLER_MANAGER_QUEUE = os.getenv("CRAWLER_MANAGER_QUEUE", "sql")
+CRAWLER_MANAGER_WORKERS = int(os.getenv("CRAWLER_MANAGER_WORKERS", "1"))
+CRAWLER_MANAGER_REAPER_INTERVAL = float(os.getenv("CRAWLER_MANAGER_REAPER_INTERVAL", "30"))
 LOG = get_logger(__name__)
 
+# The in-memory frontier is the queue of one process: several processes would hand out the same jobs.
+if CRAWLER_MANAGER_QUEUE == "memory" and CRAWLER_MANAGER_WORKERS > 1:
+    raise ValueError(f"CRAWLER_MANAGER_QUEUE=memory requires CRAWLER_MANAGER_WORKERS=1, "
+                     f"not {CRAWLER_MANAGER_WORKERS}")
+
+
+@functools.lru_cache
+def get_priority_queue() -> Frontier | PriorityQueue:
+    """
+    Returns the queue of jobs: the in-memory frontier or the jobs table.
+    Created on first use, so that only the serving process loads the frontier and reaps leases.
+    """
+    if CRAWLER_MANAGER_QUEUE == "memory":
+        queue = Frontier()
+        atexit.register(queue.flush)
+    else:
+        queue = PriorityQueue()
+    threading.Thread(target=reap_expired_leases, args=(queue,), daemon=True).start()
+    return queue
+
+
+@functools.lru_cache
+def get_server_registry() -> ServerRegistry:
+    """
+    Returns the cache of the servers, loaded on first use like the queue.
+    """
+    return ServerRegistry()
+
+
+@functools.lru_cache
+def get_token_store() -> TokenStoreWriter | None:
+    """
+    Returns the writer of the token store, None if the tokens are kept in the JSON columns of the documents.
+    """
+    return TokenStoreWriter() if TOKEN_STORE_DIRECTORY else None
+
+
+def reap_expired_leases(queue: Frontier | PriorityQueue):
+    """
+    Puts jobs whose leases expired, e.g. because their worker was killed, back into the queue.
+    """
+    while True:
+        time.sleep(CRAWLER_MANAGER_REAPER_INTERVAL)
+        try:
+            if (released := queue.release_expired_leases()) > 0:
+                LOG.info(f"Released {released} jobs with expired leases")
+        except Exception as exception:
+            LOG.error(f"Error while releasing expired leases: {exception}")
+
 
 def check_password(func):
     """
@@ -57,8 +113,9 @@ def reserve_jobs(num_of_requests_jobs):
     """
     Get the next job from the priority queue.
     """
-    LOG.info(f"Received request for {num_of_requests_jobs} jobs")
-    jobs = PRIORITY_QUEUE.get_next_jobs(min(CRAWLER_MANAGER_MAX_JOB_REQUESTS, num_of_requests_jobs))
+    worker_id = request.args.get("worker_id")
+    LOG.info(f"Received request for {num_of_requests_jobs} jobs from worker {worker_id}")
+    jobs = get_priority_queue().get_next_jobs(min(CRAWLER_MANAGER_MAX_JOB_REQUESTS, num_of_requests_jobs), worker_id)
     LOG.info(f"Sending {len(jobs)} jobs {jobs} to worker")
     return jsonify(jobs)
 
@@ -71,17 +128,29 @@ def unreserve_jobs():
     """
     jobs_ids = request.get_json()
     LOG.info(f"Received request for to unreserve jobs")
-    Job.update(being_crawled=False).where(Job.id.in_(jobs_ids)).execute()
+    get_priority_queue().unreserve_jobs(jobs_ids)
     return "Unreserve jobs successfully."
 
 
+@app.route('/renew_leases', methods=['POST'])
+@check_password
+def renew_leases():
+    """
+    Extend the leases of the jobs a worker still holds.
+    """
+    entry = dotdict(request.get_json())
+    renewed = get_priority_queue().renew_leases(entry.job_ids, entry.worker_id)
+    LOG.info(f"Renewed {renewed} of {len(entry.job_ids)} leases of worker {entry.worker_id}")
+    return jsonify({"renewed": renewed})
+
+
 @app.route('/mark_job_as_fail/<int:job_id>', methods=['POST'])
 @check_password
 def mark_job_as_fail(job_id):
     """
     Mark a job as failed.
     """
-    Job.update(done=True, success=False, being_crawled=False).where(Job.id == job_id).execute()
+    save_results([dotdict(job_id=job_id, document=None)])
     LOG.info(f"Marked job {job_id} as failed")
     return "Data updated."
 
@@ -92,39 +161,95 @@ def save_crawling_results(parent_job_id):
     """
     Save the crawling results.
     """
-    # Load data from JSON
     entry = dotdict(request.get_json())
-    new_document = dotdict(json.loads(entry.new_document))
-    new_jobs = [dotdict(json.loads(job)) for job in entry.new_jobs]
+    save_results([dotdict(job_id=parent_job_id,
+                          document=json.loads(entry.new_document),
+                          new_jobs=[json.loads(job) for job in entry.new_jobs])])
+    return "Data saved."
+
+
+@app.route('/save_crawling_results_batch', methods=['POST'])
+@check_password
+def save_crawling_results_batch():
+    """
+    Save the crawling results of many jobs at once.
+    The body holds one result per line, see save_results, and may be gzip-compressed.
+    """
+    compressed = request.headers.get("Content-Encoding") == "gzip"
+    results = [dotdict(result) for result in decompress_json_lines(request.get_data(), compressed)]
+    save_results(results)
+    return jsonify({"saved": len(results)})
+
+
+def take_tokens(document: Document) -> dict[str, list[str]]:
+    """
+    Takes the tokens out of the JSON columns of a new document, to be written to the token store instead.
+    """
+    tokens = {field: getattr(document, f"{field}_tokens") for field in TOKEN_FIELDS}
+    for field in TOKEN_FIELDS:
+        setattr(document, f"{field}_tokens", [])
+    return tokens
+
+
+def save_results(results: list[dotdict]):
+    """
+    Saves the crawling results of jobs in one transaction.
 
-    # Create new document
-    new_document = Document(**new_document)
-    new_document.save()
-    LOG.info(f"Created document {new_document.id}")
+    Args:
+        results (list[dotdict]): Results with the ID of the crawled job, its document,
+            or None if crawling failed, and the new jobs found in the document.
+    """
+    successful_job_ids = [result.job_id for result in results if result.document is not None]
+    failed_job_ids = [result.job_id for result in results if result.document is None]
 
     # Create new servers from URLs if new servers were met while crawling.
-    new_jobs_links = list(set(URL(job.url) for job in new_jobs))
-    new_links_to_server_id = Server.create_servers_and_return_ids(new_jobs_links)
-    LOG.info(f"Created new servers to save jobs {new_links_to_server_id}")
+    # Outside the transaction, so that the cached server IDs stay valid if it is rolled back.
+    new_jobs_links = list(set(URL(job["url"]) for result in results if result.document is not None
+                              for job in result.new_jobs))
+    new_links_to_server_id = get_server_registry().create_servers_and_return_ids(new_jobs_links)
 
     # Compute the priority of new servers
     servers_ids = set(new_links_to_server_id.values())
-    servers_ids_to_priority = {server_id: server_importance(server_id=server_id) for server_id in servers_ids}
+    servers_ids_to_priority = {server_id: get_server_registry().importance(server_id) for server_id in servers_ids}
+
+    with DATABASE.atomic():
+        # Create new documents
+        new_jobs = []
+        new_document_tokens = []
+        token_store = get_token_store()
+        for result in results:
+            if result.document is None:
+                continue
+            new_document = Document(**result.document)
+            tokens = take_tokens(new_document) if token_store is not None else None
+            new_document.save()
+            LOG.info(f"Created document {new_document.id}")
+            if tokens is not None:
+                new_document_tokens.append((new_document.id, tokens))
+            for new_job in result.new_jobs:
+                new_jobs.append(dotdict(new_job, parent_id=new_document.id))
+        # Written before the commit, so that readers never see a document without its tokens.
+        # If it fails, the documents are rolled back. If the commit fails, the records of the
+        # rolled-back IDs stay in the store and are ignored by readers, see crawler/utils/token_store.py.
+        if new_document_tokens:
+            token_store.append(new_document_tokens)
+
+        if successful_job_ids:
+            Job.update(done=True, success=True, being_crawled=False).where(Job.id.in_(successful_job_ids)).execute()
+        if failed_job_ids:
+            Job.update(done=True, success=False, being_crawled=False).where(Job.id.in_(failed_job_ids)).execute()
+    get_priority_queue().finish_jobs(successful_job_ids + failed_job_ids)
+    LOG.info(f"Updated {len(successful_job_ids)} successful and {len(failed_job_ids)} failed jobs to done")
 
-    # Save new jobs
+    # Save new jobs once their parent documents are committed.
     # Meanwhile, add server's importance to each job for additional priority bonus.
     for new_job in new_jobs:
-        new_job_url = URL(new_job.url)
-        new_job_server_id = new_links_to_server_id[new_job_url]
+        new_job_server_id = new_links_to_server_id[URL(new_job.url)]
         new_job["server_id"] = new_job_server_id
-        new_job["parent_id"] = new_document.id
         new_job["priority"] = new_job.priority + servers_ids_to_priority[new_job_server_id]
-    Job.insert_many(new_jobs).on_conflict_ignore().execute()
-    LOG.info(f"Created {len(new_jobs)} new jobs for document {new_document.id}")
-
-    Job.update(done=True, success=True, being_crawled=False).where(Job.id == parent_job_id).execute()
-    LOG.info("Updated parent job to done")
-    return "Data saved."
+    if new_jobs:
+        get_priority_queue().add_jobs(new_jobs)
+    LOG.info(f"Created {len(new_jobs)} new jobs")
 
 
 def main():
@@ -1,49 +1,35 @@
 """
 This module manages the priority queue of URLs to be crawled.
 """
+import datetime
 import os
-import time
-import fcntl
-from functools import wraps
+from collections import Counter
 
 from crawler import utils
 from crawler.sql_models.base import execute_query_and_return_objects, DATABASE
 from crawler.sql_models.job import Job
 
 LOG = utils.get_logger(__file__)
-# Create a Redis connection
-LOCK_FILE_PATH = os.environ.get('LOCK_FILE_PATH')
-LOCK_RETRY = int(os.environ.get('LOCK_RETRY'))
-LOCK_TIMEOUT = int(os.environ.get('LOCK_TIMEOUT'))
-LOCK_RETRY_INTERVAL = float(os.environ.get('LOCK_RETRY_INTERVAL'))
+CRAWLER_MANAGER_MAX_JOBS_PER_SERVER = int(os.environ.get('CRAWLER_MANAGER_MAX_JOBS_PER_SERVER', '1'))
+CRAWLER_MANAGER_OVERFETCH_FACTOR = int(os.environ.get('CRAWLER_MANAGER_OVERFETCH_FACTOR', '8'))
+CRAWLER_MANAGER_LEASE_DURATION = float(os.environ.get('CRAWLER_MANAGER_LEASE_DURATION', '300'))
 
 
-def file_lock(func):
+def lease_expiry() -> datetime.datetime:
     """
-    Decorator to lock the file while the function is running.
+    Returns the expiry time of a lease starting now.
     """
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        retries = 0
+    expires_at = datetime.datetime.now() + datetime.timedelta(seconds=CRAWLER_MANAGER_LEASE_DURATION)
+    return expires_at.replace(microsecond=0)
 
-        while retries < LOCK_RETRY:
-            try:
-                lock_file = open(LOCK_FILE_PATH, 'w')
-                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                result = func(*args, **kwargs)
-                fcntl.flock(lock_file, fcntl.LOCK_UN)
-                return result
-            except IOError:
-                LOG.info("Failed to acquire lock. Another process is currently accessing the code.")
-                retries += 1
-                time.sleep(LOCK_RETRY_INTERVAL)
-            finally:
-                lock_file.close()
-
-        LOG.error("Failed to acquire lock after maximum retries.")
-        # Handle the case when the lock couldn't be acquired (retry logic or error handling)
 
-    return wrapper
+def expired_leases():
+    """
+    Returns the condition selecting the unfinished jobs whose leases expired.
+    Jobs reserved before leases existed have no expiry time and count as expired.
+    """
+    return ((Job.being_crawled == True) & (Job.done == False) &  # pylint: disable=singleton-comparison
+            (Job.lease_expires_at.is_null() | (Job.lease_expires_at < datetime.datetime.now())))
 
 
 class PriorityQueue:
@@ -60,7 +46,7 @@ class PriorityQueue:
             list[Job]: A list of Job objects representing the URLs to be crawled.
         """
         query = f"""
-SELECT j.id, j.url FROM jobs j
+SELECT j.id, j.url, j.server_id FROM jobs j
 JOIN servers s ON j.server_id = s.id
 WHERE s.is_black_list = 0
   AND j.done = 0
@@ -86,7 +72,7 @@ LIMIT {n_jobs}
             list[Job]: A list of Job objects representing the URLs to be crawled.
         """
         query = f"""
-SELECT id, url
+SELECT id, url, server_id
 FROM (
     SELECT j.*,
         ROW_NUMBER() OVER (PARTITION BY server_id ORDER BY priority DESC) AS row_num
@@ -102,20 +88,52 @@ LIMIT {n_jobs}
     def get_highest_priority_jobs(n_jobs: int) -> list[Job]:
         """
         Retrieves a list of jobs from the models to be crawled.
+        Jobs locked by concurrent reservations are skipped. The selected jobs stay locked
+        until the transaction ends, so the query must run inside a transaction.
+        The scan uses the index jobs_frontier.
 
         Returns:
             list[Job]: A list of Job objects representing the URLs to be crawled.
         """
         query = f"""
-SELECT id, url
+SELECT id, url, server_id
 FROM jobs where done = 0 and being_crawled = 0 ORDER BY priority DESC LIMIT {n_jobs}
+FOR UPDATE SKIP LOCKED
 """
         return execute_query_and_return_objects(query)
 
-    @file_lock
-    def get_next_jobs(self, n_jobs: int) -> list[Job]:
+    @staticmethod
+    def limit_jobs_per_server(jobs: list[Job], n_jobs: int) -> list[Job]:
+        """
+        Selects at most n_jobs jobs in the given order,
+        but at most CRAWLER_MANAGER_MAX_JOBS_PER_SERVER jobs of each server.
+
+        Returns:
+            list[Job]: The selected jobs.
         """
-        Retrieves a list of jobs from the models to be crawled.
+        jobs_per_server = Counter()
+        selected_jobs = []
+        for job in jobs:
+            if len(selected_jobs) == n_jobs:
+                break
+            if jobs_per_server[job.server_id] < CRAWLER_MANAGER_MAX_JOBS_PER_SERVER:
+                jobs_per_server[job.server_id] += 1
+                selected_jobs.append(job)
+        return selected_jobs
+
+    @staticmethod
+    def reserve_jobs(job_ids: list[int], worker_id: str = None):
+        """
+        Leases jobs to a worker with a single statement.
+        """
+        if job_ids:
+            Job.update(being_crawled=True, worker_id=worker_id, lease_expires_at=lease_expiry()).where(
+                Job.id.in_(job_ids)).execute()
+
+    def get_next_jobs(self, n_jobs: int, worker_id: str = None) -> list[Job]:
+        """
+        Retrieves a list of jobs from the models to be crawled and leases them to the worker.
+        Safe to call from several manager processes at once.
 
         Returns:
             list[Job]: A list of Job objects representing the URLs to be crawled.
@@ -124,12 +142,57 @@ FROM jobs where done = 0 and being_crawled = 0 ORDER BY priority DESC LIMIT {n_j
 
         with DATABASE.atomic() as transaction:
             try:
-                jobs = list(PriorityQueue.get_highest_priority_jobs(n_jobs))
+                # Fetch more jobs than needed, so that the jobs can be spread over many servers.
+                jobs = PriorityQueue.get_highest_priority_jobs(n_jobs * CRAWLER_MANAGER_OVERFETCH_FACTOR)
+                jobs = PriorityQueue.limit_jobs_per_server(jobs, n_jobs)
                 LOG.info(f"Retrieved from database: {jobs}")
-                for job in jobs:
-                    Job.update(being_crawled=True).where(Job.id == job.id).execute()
+                PriorityQueue.reserve_jobs([job.id for job in jobs], worker_id)
                 return jobs
             except Exception as exception:
                 LOG.error(f"Error while getting jobs from queue: {exception}")
                 transaction.rollback()
                 raise exception
+
+    @staticmethod
+    def unreserve_jobs(job_ids: list[int]):
+        """
+        Puts reserved jobs back into the queue.
+        """
+        Job.update(being_crawled=False, worker_id=None, lease_expires_at=None).where(Job.id.in_(job_ids)).execute()
+
+    @staticmethod
+    def renew_leases(job_ids: list[int], worker_id: str) -> int:
+        """
+        Extends the leases of jobs still leased to the worker.
+
+        Returns:
+            int: Number of renewed leases.
+        """
+        if not job_ids:
+            return 0
+        return Job.update(lease_expires_at=lease_expiry()).where(
+            Job.id.in_(job_ids) & (Job.worker_id == worker_id) & (Job.being_crawled == True)  # pylint: disable=singleton-comparison
+        ).execute()
+
+    @staticmethod
+    def release_expired_leases() -> int:
+        """
+        Puts the jobs whose leases expired back into the queue.
+
+        Returns:
+            int: Number of released jobs.
+        """
+        return Job.update(being_crawled=False, worker_id=None, lease_expires_at=None).where(expired_leases()).execute()
+
+    @staticmethod
+    def finish_jobs(job_ids: list[int]):
+        """
+        Called after jobs were marked as done. Nothing to do, the queue is the jobs table.
+        """
+
+    @staticmethod
+    def add_jobs(new_jobs: list[dict]):
+        """
+        Inserts new jobs into the queue.
+        """
+        Job.insert_many(new_jobs).on_conflict_ignore().execute()
@@ -12,8 +12,16 @@ def server_importance(server_id: int):
     """
     Get the priority of a job.
     """
-    priority = 0
     server = Server.select().where(Server.id == server_id).get()
+    return compute_server_importance(server)
+
+
+def compute_server_importance(server) -> float:
+    """
+    Get the priority of a job from the statistics of its server.
+    The server may be a Server or any object with the same statistics.
+    """
+    priority = 0
     priority += min(5, server.page_rank * 5)
     if server.total_jobs > 0:
         priority += min(1, (server.success_jobs / server.total_jobs) * 1)
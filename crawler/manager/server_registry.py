@@ -0,0 +1,128 @@
+"""
+This module caches the servers in the manager.
+
+Saving the results of a crawled page needs the ID and the importance of the
+server of every link on the page. The registry maps server names to IDs and
+keeps the statistics the importance is computed from, so that these lookups do
+not query the database. Unknown servers are inserted with one statement per
+batch of links. The statistics are updated by triggers in the database and
+reloaded every CRAWLER_MANAGER_SERVER_REFRESH_INTERVAL seconds, so the
+importance of a server may lag behind by that long.
+"""
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+from crawler import utils
+from crawler.manager.frontier import chunks
+from crawler.manager.server_importance import compute_server_importance
+from crawler.sql_models.server import Server
+
+load_dotenv()
+
+CRAWLER_MANAGER_SERVER_REFRESH_INTERVAL = float(os.getenv("CRAWLER_MANAGER_SERVER_REFRESH_INTERVAL", "60"))
+LOG = utils.get_logger(__file__)
+
+
+@dataclass(frozen=True)
+class ServerStats:
+    """
+    Statistics of a server, as used to compute its importance.
+    """
+    page_rank: float
+    total_jobs: int
+    success_jobs: int
+    relevant_documents: int
+
+
+class ServerRegistry:
+    """
+    Thread-safe cache of the servers table.
+    """
+
+    def __init__(self, refresh_interval: float = CRAWLER_MANAGER_SERVER_REFRESH_INTERVAL, start: bool = True):
+        """
+        Args:
+            refresh_interval (float): Seconds between two reloads of the statistics.
+            start (bool): Whether to load the servers and start the refreshing thread.
+        """
+        self.refresh_interval = refresh_interval
+        self.ids: dict[str, int] = {}
+        self.stats: dict[int, ServerStats] = {}
+        self.lock = threading.Lock()
+        if start:
+            self.refresh()
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.ids)
+
+    def load(self, condition=None):
+        """
+        Loads the servers matching a condition, or all servers, into the cache.
+        """
+        query = Server.select(Server.id, Server.name, Server.page_rank, Server.total_jobs,
+                              Server.success_jobs, Server.relevant_documents)
+        if condition is not None:
+            query = query.where(condition)
+        rows = list(query.tuples())
+        with self.lock:
+            for server_id, name, page_rank, total_jobs, success_jobs, relevant_documents in rows:
+                self.ids[name] = server_id
+                self.stats[server_id] = ServerStats(page_rank, total_jobs, success_jobs, relevant_documents)
+
+    def refresh(self):
+        """
+        Reloads all servers and their statistics.
+        """
+        started_at = time.perf_counter()
+        self.load()
+        LOG.info(f"Loaded {len(self)} servers in {time.perf_counter() - started_at:.2f} seconds")
+
+    def get_ids(self, server_names: list[str]) -> dict[str, int]:
+        """
+        Returns the IDs of servers, inserting the unknown ones into the database.
+        """
+        with self.lock:
+            unknown_names = sorted(set(name for name in server_names if name not in self.ids))
+        for chunk in chunks(unknown_names):
+            Server.insert_many([{"name": name} for name in chunk]).on_conflict_ignore().execute()
+            self.load(Server.name.in_(chunk))
+        if unknown_names:
+            LOG.info(f"Created {len(unknown_names)} new servers")
+        with self.lock:
+            return {name: self.ids[name] for name in server_names}
+
+    def create_servers_and_return_ids(self, links: list['URL']) -> dict['URL', int]:
+        """
+        Like Server.create_servers_and_return_ids, but only queries the database for unknown servers.
+        """
+        server_ids = self.get_ids([link.server_name for link in links])
+        return {link: server_ids[link.server_name] for link in links}
+
+    def importance(self, server_id: int) -> float:
+        """
+        Like server_importance, but computed from the cached statistics.
+        """
+        with self.lock:
+            stats = self.stats.get(server_id)
+        if stats is None:
+            self.load(Server.id == server_id)
+            with self.lock:
+                stats = self.stats[server_id]
+        return compute_server_importance(stats)
+
+    def run(self):
+        """
+        Reloads the statistics every refresh interval.
+        """
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as exception:
+                LOG.error(f"Error while refreshing the servers: {exception}")
@@ -64,6 +64,8 @@ class Job(BaseModel):
     done = peewee.BooleanField(default=False)
     success = peewee.BooleanField(default=None, null=True)
     being_crawled = peewee.BooleanField(default=False)
+    worker_id = peewee.CharField(default=None, null=True)
+    lease_expires_at = peewee.DateTimeField(default=None, null=True)
 
     class Meta:
         """
@@ -0,0 +1,154 @@
+"""Test frontier"""
+import datetime
+import unittest
+from contextlib import ExitStack
+
+import peewee
+
+from crawler.manager.frontier import Frontier, Lease
+from crawler.sql_models.job import Job
+
+
+class TestFrontier(unittest.TestCase):
+    """Test Frontier on an in-memory SQLite database"""
+
+    def setUp(self):
+        self.database = peewee.SqliteDatabase(":memory:")
+        self.stack = ExitStack()
+        self.stack.enter_context(self.database.bind_ctx([Job]))
+        self.database.create_tables([Job])
+        self.database.execute_sql("CREATE UNIQUE INDEX jobs_url ON jobs (url)")
+        Job.insert_many([  # pylint: disable=no-value-for-parameter
+            {"url": "https://a.de/1", "server_id": 1, "parent_id": 0, "priority": 5.0},
+            {"url": "https://a.de/2", "server_id": 1, "parent_id": 0, "priority": 4.0},
+            {"url": "https://b.de/1", "server_id": 2, "parent_id": 0, "priority": 3.0},
+            {"url": "https://c.de/1", "server_id": 3, "parent_id": 0, "priority": 1.0},
+            {"url": "https://c.de/2", "server_id": 3, "parent_id": 0, "priority": 9.0, "done": True, "success": True},
+        ]).execute()
+
+    def tearDown(self):
+        self.stack.close()
+        self.database.close()
+
+    def create_frontier(self, capacity: int = 100) -> Frontier:
+        """Creates a frontier without background thread, recovered from the database."""
+        frontier = Frontier(capacity=capacity, flush_size=10 ** 6, start=False)
+        frontier.refill()
+        return frontier
+
+    @staticmethod
+    def urls(jobs) -> list[str]:
+        """Returns the URLs of jobs."""
+        return [job.url for job in jobs]
+
+    def being_crawled(self) -> list[str]:
+        """Returns the URLs of the jobs being crawled according to the database."""
+        query = Job.select(Job.url).where(Job.being_crawled == True)  # pylint: disable=singleton-comparison
+        return sorted(job.url for job in query.objects())
+
+    def test_reserve_by_priority_and_server(self):
+        """
+        Test if jobs are reserved by priority, one per server and reservation, without done jobs.
+        """
+        frontier = self.create_frontier()
+        self.assertEqual(len(frontier), 4)
+        self.assertEqual(self.urls(frontier.get_next_jobs(2)), ["https://a.de/1", "https://b.de/1"])
+        self.assertEqual(self.urls(frontier.get_next_jobs(5)), ["https://a.de/2", "https://c.de/1"])
+        self.assertEqual(frontier.get_next_jobs(5), [])
+
+    def test_write_behind(self):
+        """
+        Test if reservations reach the database on flush and unreserved jobs are handed out again.
+        """
+        frontier = self.create_frontier()
+        jobs = frontier.get_next_jobs(2)
+        self.assertEqual(self.being_crawled(), [])
+        frontier.flush()
+        self.assertEqual(self.being_crawled(), ["https://a.de/1", "https://b.de/1"])
+        frontier.unreserve_jobs([jobs[1].id])
+        frontier.flush()
+        self.assertEqual(self.being_crawled(), ["https://a.de/1"])
+        self.assertEqual(self.urls(frontier.get_next_jobs(5)), ["https://a.de/2", "https://b.de/1", "https://c.de/1"])
+
+    def test_finished_jobs_are_not_marked_as_being_crawled(self):
+        """
+        Test if a job finished before the flush of its reservation stays finished.
+        """
+        frontier = self.create_frontier()
+        job = frontier.get_next_jobs(1)[0]
+        Job.update(done=True, success=True, being_crawled=False).where(Job.id == job.id).execute()
+        frontier.finish_jobs([job.id])
+        frontier.flush()
+        self.assertEqual(self.being_crawled(), [])
+
+    def test_new_jobs_are_reservable_after_flush(self):
+        """
+        Test if new jobs are inserted on flush and then reserved, ignoring known URLs.
+        """
+        frontier = self.create_frontier()
+        frontier.add_jobs([{"url": "https://d.de/1", "server_id": 4, "parent_id": 1, "priority": 10.0},
+                           {"url": "https://a.de/1", "server_id": 1, "parent_id": 1, "priority": 10.0}])
+        self.assertEqual(len(frontier), 4)
+        frontier.flush()
+        self.assertEqual(len(frontier), 5)
+        self.assertEqual(self.urls(frontier.get_next_jobs(1)), ["https://d.de/1"])
+
+    def test_refill(self):
+        """
+        Test if a full frontier is refilled from the database.
+        """
+        frontier = self.create_frontier(capacity=2)
+        self.assertFalse(frontier.complete)
+        self.assertEqual(self.urls(frontier.get_next_jobs(5)), ["https://a.de/1"])
+        frontier.refill()
+        self.assertFalse(frontier.complete)
+        self.assertEqual(self.urls(frontier.get_next_jobs(5)), ["https://a.de/2", "https://b.de/1"])
+        frontier.refill()
+        self.assertTrue(frontier.complete)
+        self.assertEqual(self.urls(frontier.get_next_jobs(5)), ["https://c.de/1"])
+
+    def test_leases(self):
+        """
+        Test if leases are persisted, renewed by their worker only, and released once expired.
+        """
+        frontier = self.create_frontier()
+        job = frontier.get_next_jobs(1, "worker-1")[0]
+        frontier.flush()
+        self.assertEqual(Job.get_by_id(job.id).worker_id, "worker-1")
+        self.assertEqual(frontier.renew_leases([job.id], "worker-2"), 0)
+        self.assertEqual(frontier.renew_leases([job.id], "worker-1"), 1)
+        self.assertEqual(frontier.release_expired_leases(), 0)
+        frontier.leases[job.id] = Lease("worker-1", datetime.datetime.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(frontier.release_expired_leases(), 1)
+        frontier.flush()
+        self.assertEqual(self.being_crawled(), [])
+        self.assertEqual(self.urls(frontier.get_next_jobs(1)), ["https://a.de/1"])
+
+    def test_late_results_of_expired_leases(self):
+        """
+        Test if a job finished after its lease expired is not reserved again.
+        """
+        frontier = self.create_frontier()
+        job = frontier.get_next_jobs(1, "worker-1")[0]
+        frontier.leases[job.id] = Lease("worker-1", datetime.datetime.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(frontier.release_expired_leases(), 1)
+        Job.update(done=True, success=True, being_crawled=False).where(Job.id == job.id).execute()
+        frontier.finish_jobs([job.id])
+        self.assertEqual(len(frontier), 3)
+        self.assertEqual(self.urls(frontier.get_next_jobs(5)), ["https://a.de/2", "https://b.de/1", "https://c.de/1"])
+        frontier.flush()
+        self.assertEqual(Job.get_by_id(job.id).being_crawled, False)
+
+    def test_leases_of_previous_manager_expire(self):
+        """
+        Test if expired leases only known to the database are released and the jobs are loaded again.
+        """
+        expired = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        Job.update(being_crawled=True, worker_id="worker-1", lease_expires_at=expired).where(
+            Job.url == "https://a.de/1").execute()
+        frontier = self.create_frontier()
+        self.assertEqual(len(frontier), 3)
+        self.assertEqual(frontier.release_expired_leases(), 1)
+        self.assertFalse(frontier.complete)
+        frontier.refill()
+        self.assertEqual(self.urls(frontier.get_next_jobs(1)), ["https://a.de/1"])
@@ -0,0 +1,47 @@
+"""Test graph"""
+import unittest
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from crawler.utils.graph import pagerank, personalization_vector
+
+
+class TestPageRank(unittest.TestCase):
+    """Test pagerank and personalization_vector"""
+
+    def setUp(self):
+        # Node 3 has no outgoing links, node 4 no links at all.
+        self.edges = [(0, 1), (0, 2), (1, 2), (2, 0), (2, 3), (1, 3)]
+        self.num_nodes = 5
+        rows, columns = zip(*self.edges)
+        self.adjacency = csr_matrix((np.ones(len(self.edges)), (rows, columns)), shape=(self.num_nodes,) * 2)
+        self.graph = nx.DiGraph(self.edges)
+        self.graph.add_node(4)
+
+    def test_uniform(self):
+        """
+        Test if the PageRank equals the one of networkx.
+        """
+        expected = nx.pagerank(self.graph, tol=1e-10)
+        ranks = pagerank(self.adjacency, tol=1e-10)
+        np.testing.assert_allclose(ranks, [expected[node] for node in range(self.num_nodes)], atol=1e-8)
+
+    def test_personalized(self):
+        """
+        Test if the personalized PageRank equals the one of networkx.
+        """
+        personalization = np.array([0.0, 0.5, 0.0, 0.25, 0.25])
+        expected = nx.pagerank(self.graph, personalization=dict(enumerate(personalization)), tol=1e-10)
+        ranks = pagerank(self.adjacency, personalization, tol=1e-10)
+        np.testing.assert_allclose(ranks, [expected[node] for node in range(self.num_nodes)], atol=1e-8)
+
+    def test_personalization_vector(self):
+        """
+        Test if keywords receive their share and the remaining share is uniform.
+        """
+        names = ["uni-tuebingen.de", "tuebingen.de", "wikipedia.org", "example.com"]
+        vector = personalization_vector(names, {"tuebingen": 0.4, "wikipedia": 0.2, "missing": 0.2})
+        np.testing.assert_allclose(vector, [0.3, 0.3, 0.3, 0.1])
+        np.testing.assert_allclose(personalization_vector(names, {}), [0.25] * 4)
@@ -0,0 +1,23 @@
+"""Test io"""
+import unittest
+
+from crawler.utils.io import compress_json_lines, decompress_json_lines
+
+
+class TestJsonLines(unittest.TestCase):
+    """Test compress_json_lines and decompress_json_lines"""
+
+    def test_round_trip(self):
+        """
+        Test if JSON objects survive compression, including newlines inside strings.
+        """
+        results = [{"job_id": 1, "document": {"body": "first\nsecond"}, "new_jobs": [{"url": "https://a.de"}]},
+                   {"job_id": 2, "document": None}]
+        self.assertEqual(decompress_json_lines(compress_json_lines(results)), results)
+
+    def test_uncompressed(self):
+        """
+        Test if uncompressed lines are parsed and blank lines are skipped.
+        """
+        self.assertEqual(decompress_json_lines(b'{"job_id": 1}\n\n{"job_id": 2}\n', compressed=False),
+                         [{"job_id": 1}, {"job_id": 2}])
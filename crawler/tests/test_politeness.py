@@ -0,0 +1,100 @@
+"""Test politeness"""
+import unittest
+
+from crawler.manager.priority_queue import PriorityQueue
+from crawler.sql_models.base import dotdict
+from crawler.worker.politeness import CRAWL_DEFAULT_DELAY, CRAWL_MAX_DELAY, PolitenessScheduler
+
+
+class FakeResponse:
+    """Response of FakeSession"""
+
+    def __init__(self, status_code: int, text: str = ""):
+        self.status_code = status_code
+        self.text = text
+
+
+class FakeSession:
+    """Serves robots.txt files from a dictionary and counts the requests"""
+
+    def __init__(self, responses: dict[str, FakeResponse]):
+        self.responses = responses
+        self.requested = []
+
+    def get(self, url, **_):
+        """Returns the response of a URL"""
+        self.requested.append(url)
+        return self.responses.get(url, FakeResponse(404))
+
+
+class TestPolitenessScheduler(unittest.TestCase):
+    """Test PolitenessScheduler"""
+
+    def setUp(self):
+        self.session = FakeSession({
+            "https://slow.de/robots.txt": FakeResponse(200, "User-agent: *\nCrawl-delay: 5\nDisallow: /private"),
+            "https://huge.de/robots.txt": FakeResponse(200, "User-agent: *\nCrawl-delay: 100000"),
+            "https://closed.de/robots.txt": FakeResponse(403),
+            "https://bots.de/robots.txt": FakeResponse(200, "User-agent: TestBot\nDisallow: /\n\n"
+                                                            "User-agent: *\nDisallow: /private"),
+        })
+        self.scheduler = PolitenessScheduler(self.session, "TestBot", 1)
+
+    def test_robots_rules(self):
+        """
+        Test if robots.txt rules are honoured and missing files allow everything.
+        """
+        self.assertTrue(self.scheduler.can_fetch("https://slow.de/public"))
+        self.assertFalse(self.scheduler.can_fetch("https://slow.de/private/page"))
+        self.assertFalse(self.scheduler.can_fetch("https://closed.de/page"))
+        self.assertTrue(self.scheduler.can_fetch("https://missing.de/page"))
+
+    def test_robots_user_agent(self):
+        """
+        Test if the rules for the product token of the crawler take precedence over the rules for all crawlers.
+        """
+        self.assertFalse(self.scheduler.can_fetch("https://bots.de/public"))
+        other = PolitenessScheduler(self.session, "OtherBot", 1)
+        self.assertTrue(other.can_fetch("https://bots.de/public"))
+        self.assertFalse(other.can_fetch("https://bots.de/private/page"))
+
+    def test_robots_cached(self):
+        """
+        Test if robots.txt is downloaded once per host.
+        """
+        self.scheduler.can_fetch("https://slow.de/a")
+        self.scheduler.can_fetch("https://slow.de/b")
+        self.scheduler.crawl_delay("https://slow.de/c")
+        self.assertEqual(self.session.requested, ["https://slow.de/robots.txt"])
+
+    def test_crawl_delay(self):
+        """
+        Test if the crawl delay is read from robots.txt and clamped.
+        """
+        self.assertEqual(self.scheduler.crawl_delay("https://slow.de/"), max(5, CRAWL_DEFAULT_DELAY))
+        self.assertEqual(self.scheduler.crawl_delay("https://huge.de/"), CRAWL_MAX_DELAY)
+        self.assertEqual(self.scheduler.crawl_delay("https://missing.de/"), CRAWL_DEFAULT_DELAY)
+
+    def test_reserve_spaces_requests_per_server(self):
+        """
+        Test if requests to the same server are spaced and other servers are not delayed.
+        """
+        job = dotdict(url="https://slow.de/a", server_id=1)
+        same_server = dotdict(url="https://www.slow.de/b", server_id=1)
+        other_server = dotdict(url="https://missing.de/c", server_id=2)
+        self.assertEqual(self.scheduler.reserve(job), 0)
+        self.assertAlmostEqual(self.scheduler.reserve(same_server), 5, delta=0.1)
+        self.assertEqual(self.scheduler.reserve(other_server), 0)
+        self.assertGreater(self.scheduler.next_allowed_time(job), self.scheduler.next_allowed_time(other_server))
+
+
+class TestLimitJobsPerServer(unittest.TestCase):
+    """Test PriorityQueue.limit_jobs_per_server"""
+
+    def test_limit_jobs_per_server(self):
+        """
+        Test if the jobs are spread over the servers in the order of their priority.
+        """
+        jobs = [dotdict(id=i, server_id=server_id) for i, server_id in enumerate([1, 1, 2, 1, 3, 4])]
+        selected_jobs = PriorityQueue.limit_jobs_per_server(jobs, 3)
+        self.assertEqual([job.id for job in selected_jobs], [0, 2, 4])
@@ -0,0 +1,56 @@
+"""Test server registry"""
+import unittest
+from contextlib import ExitStack
+
+import peewee
+
+from crawler.manager.server_importance import server_importance
+from crawler.manager.server_registry import ServerRegistry
+from crawler.sql_models.base import dotdict
+from crawler.sql_models.server import Server
+
+
+class TestServerRegistry(unittest.TestCase):
+    """Test ServerRegistry on an in-memory SQLite database"""
+
+    def setUp(self):
+        self.database = peewee.SqliteDatabase(":memory:")
+        self.stack = ExitStack()
+        self.stack.enter_context(self.database.bind_ctx([Server]))
+        self.database.create_tables([Server])
+        self.database.execute_sql("CREATE UNIQUE INDEX servers_name ON servers (name)")
+        self.known = Server.create(name="a.de", page_rank=0.5, total_jobs=10, success_jobs=5, relevant_documents=2)
+        self.registry = ServerRegistry(start=False)
+        self.registry.refresh()
+
+    def tearDown(self):
+        self.stack.close()
+        self.database.close()
+
+    @staticmethod
+    def server_names() -> list[str]:
+        """Returns the names of the servers in the database."""
+        query = Server.select(Server.name).order_by(Server.name)
+        return [server.name for server in query.objects()]
+
+    def test_create_servers_and_return_ids(self):
+        """
+        Test if known servers keep their IDs and unknown servers are created once.
+        """
+        links = [dotdict(server_name="a.de"), dotdict(server_name="b.de"), dotdict(server_name="b.de")]
+        server_ids = self.registry.get_ids([link.server_name for link in links])
+        self.assertEqual(server_ids["a.de"], self.known.id)
+        self.assertEqual(server_ids["b.de"], Server.get(Server.name == "b.de").id)
+        self.assertEqual(self.server_names(), ["a.de", "b.de"])
+        self.assertEqual(self.registry.get_ids(["b.de"]), {"b.de": server_ids["b.de"]})
+        self.assertEqual(self.server_names(), ["a.de", "b.de"])
+
+    def test_importance(self):
+        """
+        Test if the importance equals the one computed from the database, once refreshed.
+        """
+        self.assertEqual(self.registry.importance(self.known.id), server_importance(self.known.id))
+        Server.update(relevant_documents=10).where(Server.id == self.known.id).execute()
+        self.assertNotEqual(self.registry.importance(self.known.id), server_importance(self.known.id))
+        self.registry.refresh()
+        self.assertEqual(self.registry.importance(self.known.id), server_importance(self.known.id))
@@ -0,0 +1,67 @@
+"""Test text processing"""
+import unittest
+
+from crawler.utils import text
+
+# pylint: disable=protected-access
+
+
+class TestTokenizeQuery(unittest.TestCase):
+    """Test the query tokenizer"""
+
+    QUERIES = ["Hohentübingen Castle", "food and drinks in Tübingen", "The university of tubingen 2023!"]
+
+    def test_same_tokens_as_indexing(self):
+        """
+        Test if queries are tokenized like indexed documents.
+        """
+        for query in self.QUERIES:
+            self.assertEqual(text.advanced_tokenize_with_pos(query), text.tokenize_query(query))
+
+    def test_memoized(self):
+        """
+        Test if repeated queries are served from the cache, also with different case.
+        """
+        text._tokenize_query.cache_clear()
+        text.tokenize_query("Tubingen museum")
+        text.tokenize_query("tubingen Museum")
+        self.assertEqual(text._tokenize_query.cache_info().hits, 1)
+
+    def test_result_is_a_copy(self):
+        """
+        Test if modifying returned tokens does not change the cached tokens.
+        """
+        tokens = text.tokenize_query("tubingen museum")
+        tokens.append("changed")
+        self.assertNotIn("changed", text.tokenize_query("tubingen museum"))
+
+
+class TestBatchTokenization(unittest.TestCase):
+    """Test the batched tokenization"""
+
+    HTML = """<html><head><title>Hohentübingen Castle</title>
+    <meta name="description" content="The castle above the old town">
+    <meta name="keywords" content="castle, museum"></head>
+    <body><h1>Castle museum</h1><h2>Opening hours</h2><h2>Tickets</h2>
+    <p>The museum of the university is located in the castle.</p></body></html>"""
+
+    def test_same_tokens_as_single_texts(self):
+        """
+        Test if batched texts are tokenized like single texts, including repeated and empty texts.
+        """
+        texts = ["Hohentübingen Castle", "", "food and drinks in Tübingen", "Hohentübingen Castle"]
+        self.assertEqual(text.advanced_tokenize_with_pos_batch(texts, batch_size=2),
+                         [text.advanced_tokenize_with_pos(t) for t in texts])
+
+    def test_generate_text_document_from_html(self):
+        """
+        Test if every field of a document is tokenized like a single text.
+        """
+        document = text.generate_text_document_from_html(self.HTML)
+        self.assertEqual(document.title, "Hohentubingen Castle")
+        self.assertEqual(document.h2, "Opening hours Tickets")
+        self.assertEqual(document.meta_keywords, "castle, museum")
+        self.assertEqual(document.meta_author, "")
+        for field in ("body", "title", "meta_description", "meta_keywords", "meta_author", "h1", "h2", "h3"):
+            self.assertEqual(getattr(document, f"{field}_tokens"),
+                             text.advanced_tokenize_with_pos(getattr(document, field)))
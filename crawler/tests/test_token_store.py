@@ -0,0 +1,100 @@
+"""Test the token store"""
+import os
+import tempfile
+import unittest
+from contextlib import ExitStack
+
+import numpy as np
+import peewee
+
+from crawler.sql_models.document import Document
+from crawler.utils.token_store import DOCUMENTS_FILE, TOKENS_FILE, VOCABULARY_FILE, TokenStore, TokenStoreWriter, \
+    backfill
+
+
+class TestTokenStore(unittest.TestCase):
+    """Test writing and reading the tokens of documents as term IDs"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        """
+        Test if the tokens of documents are read as written, with one vocabulary for all fields.
+        """
+        writer = TokenStoreWriter(self.directory.name)
+        writer.append([(3, {"title": ["castle_NOUN"], "body": ["tubingen_PROPN", "castle_NOUN", "\"quote\"\n"]}),
+                       (1, {"body": []})])
+        store = TokenStore(self.directory.name)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.terms, ["castle_NOUN", "tubingen_PROPN", "\"quote\"\n"])
+        row = store.rows_of([3])[0]
+        np.testing.assert_array_equal(store.term_ids(row, "body"), [1, 0, 2])
+        self.assertEqual(store.tokens_of(row, "title"), ["castle_NOUN"])
+        self.assertEqual(store.tokens_of(row, "h1"), [])
+        self.assertEqual(store.tokens_of(store.rows_of([1])[0], "body"), [])
+        np.testing.assert_array_equal(store.rows_of([1, 2, 3, 4]) >= 0, [True, False, True, False])
+
+        # A second writer continues the vocabulary of the first one, a document written again is read from its last record.
+        TokenStoreWriter(self.directory.name).append([(1, {"body": ["neckar_PROPN", "castle_NOUN"]})])
+        self.assertNotIn(5, store)
+        writer.append([(5, {"h1": ["museum_NOUN"]})])
+        self.assertTrue(store.refresh())
+        self.assertFalse(store.refresh())
+        self.assertIn(5, store)
+        self.assertEqual(store.tokens_of(store.rows_of([1])[0], "body"), ["neckar_PROPN", "castle_NOUN"])
+        self.assertEqual(store.tokens_of(store.rows_of([5])[0], "h1"), ["museum_NOUN"])
+        self.assertEqual(store.terms, ["castle_NOUN", "tubingen_PROPN", "\"quote\"\n", "neckar_PROPN", "museum_NOUN"])
+
+    def test_interrupted_write(self):
+        """
+        Test if the incomplete end of an interrupted write is neither read nor kept.
+        """
+        TokenStoreWriter(self.directory.name).append([(1, {"body": ["castle_NOUN"]})])
+        for name, garbage in ((VOCABULARY_FILE, b'"neck'), (TOKENS_FILE, b"\x01\x02"), (DOCUMENTS_FILE, b"\x03")):
+            with open(os.path.join(self.directory.name, name), "ab") as file:
+                file.write(garbage)
+        store = TokenStore(self.directory.name)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.terms, ["castle_NOUN"])
+
+        TokenStoreWriter(self.directory.name).append([(2, {"title": ["neckar_PROPN"], "body": ["castle_NOUN"]})])
+        store = TokenStore(self.directory.name)
+        self.assertEqual(store.tokens_of(store.rows_of([1])[0], "body"), ["castle_NOUN"])
+        self.assertEqual(store.tokens_of(store.rows_of([2])[0], "title"), ["neckar_PROPN"])
+        self.assertEqual(store.tokens_of(store.rows_of([2])[0], "body"), ["castle_NOUN"])
+
+
+    def test_backfill(self):
+        """
+        Test if the backfill copies the tokens of old documents only, and never overwrites
+        the tokens of documents appended by the manager after the store was opened.
+        """
+        database = peewee.SqliteDatabase(":memory:")
+        with ExitStack() as stack:
+            stack.enter_context(database.bind_ctx([Document]))
+            database.create_tables([Document])
+            Document.create(id=1, job_id=1, body_tokens=["castle_NOUN"])
+            Document.create(id=2, job_id=2, title_tokens=["neckar_PROPN"])
+            writer = TokenStoreWriter(self.directory.name)
+            writer.append([(2, {"title": ["tubingen_PROPN"]})])
+            store = TokenStore(self.directory.name)
+            # Saved by the manager after the backfill opened the store, with empty JSON columns.
+            Document.create(id=3, job_id=3)
+            TokenStoreWriter(self.directory.name).append([(3, {"body": ["hello_INTJ", "world_NOUN"]})])
+
+            self.assertEqual(backfill(writer, store, chunk_size=2, clear_columns=True), 1)
+            store = TokenStore(self.directory.name)
+            self.assertEqual(store.tokens_of(store.rows_of([1])[0], "body"), ["castle_NOUN"])
+            self.assertEqual(store.tokens_of(store.rows_of([2])[0], "title"), ["tubingen_PROPN"])
+            self.assertEqual(store.tokens_of(store.rows_of([3])[0], "body"), ["hello_INTJ", "world_NOUN"])
+            self.assertEqual(Document.get_by_id(1).body_tokens, [])
+            self.assertEqual(Document.get_by_id(2).title_tokens, ["neckar_PROPN"])
+        database.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
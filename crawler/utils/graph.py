@@ -0,0 +1,80 @@
+"""
+This module contains functions for computing PageRank on sparse link graphs.
+"""
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+
+from crawler.utils.log import get_logger
+
+LOG = get_logger(__file__)
+
+
+def personalization_vector(names: list[str], weights: dict[str, float]) -> np.ndarray:
+    """
+    Creates the teleport distribution of a personalized PageRank.
+
+    Each keyword receives its weight as share of the teleport probability, split evenly
+    between the nodes whose names contain the keyword. The remaining share, if any,
+    is split evenly between all nodes.
+
+    Args:
+        names (list[str]): Names of the nodes, e.g. server names.
+        weights (dict[str, float]): Keywords mapped to their share of the teleport probability.
+
+    Returns:
+        np.ndarray: Teleport probability of each node, summing up to 1.
+    """
+    vector = np.zeros(len(names))
+    if len(names) == 0:
+        return vector
+    for keyword, weight in weights.items():
+        matches = np.array([keyword in name for name in names], dtype=bool)
+        if matches.any():
+            vector[matches] += weight / matches.sum()
+    vector += max(0.0, 1.0 - vector.sum()) / len(names)
+    return vector / vector.sum()
+
+
+def pagerank(adjacency: csr_matrix, personalization: np.ndarray = None, alpha: float = 0.85,
+             max_iter: int = 100, tol: float = 1e-6) -> np.ndarray:
+    """
+    Computes PageRank by power iteration, like networkx.pagerank but on a sparse matrix.
+
+    The random surfer follows an outgoing link with probability alpha, proportionally
+    to the weights of the links, and otherwise jumps to a node drawn from the
+    personalization. Nodes without outgoing links jump to a node drawn from the
+    personalization as well.
+
+    Args:
+        adjacency (csr_matrix): Square matrix with the weight of the link from row to column.
+        personalization (np.ndarray): Teleport probability of each node. Uniform if None.
+        alpha (float): Damping factor.
+        max_iter (int): Maximum number of iterations.
+        tol (float): Tolerance of the convergence check, per node.
+
+    Returns:
+        np.ndarray: PageRank of each node, summing up to 1.
+    """
+    num_nodes = adjacency.shape[0]
+    if num_nodes == 0:
+        return np.zeros(0)
+    if personalization is None:
+        personalization = np.full(num_nodes, 1.0 / num_nodes)
+    out_weights = np.asarray(adjacency.sum(axis=1)).ravel()
+    dangling = out_weights == 0
+    inverse_out_weights = np.divide(1.0, out_weights, out=np.zeros(num_nodes), where=~dangling)
+    # transition[j, i] is the probability of following a link from i to j.
+    transition = (diags(inverse_out_weights) @ adjacency).T.tocsr()
+
+    ranks = personalization.copy()
+    for iteration in range(max_iter):
+        previous_ranks = ranks
+        dangling_rank = previous_ranks[dangling].sum()
+        ranks = alpha * (transition @ previous_ranks + dangling_rank * personalization) \
+            + (1 - alpha) * personalization
+        error = np.abs(ranks - previous_ranks).sum()
+        if error < num_nodes * tol:
+            LOG.info(f"PageRank converged after {iteration + 1} iterations")
+            return ranks
+    LOG.warning(f"PageRank did not converge after {max_iter} iterations, error {error}")
+    return ranks
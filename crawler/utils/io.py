@@ -1,6 +1,7 @@
 """
 This module contains functions for reading and writing files.
 """
+import gzip
 import json
 import os
 import shutil
@@ -39,6 +40,36 @@ def write_json_file(json_object: json, path: str):
         return json.dump(json_object, file)
 
 
+def compress_json_lines(json_objects: list) -> bytes:
+    """
+    Serializes JSON objects as gzip-compressed newline-delimited JSON.
+
+    Args:
+        json_objects (list): JSON objects, one per line.
+
+    Returns:
+        bytes: Compressed lines.
+    """
+    lines = "".join(json.dumps(json_object) + "\n" for json_object in json_objects)
+    return gzip.compress(lines.encode("utf-8"))
+
+
+def decompress_json_lines(data: bytes, compressed: bool = True) -> list:
+    """
+    Parses newline-delimited JSON, optionally gzip-compressed.
+
+    Args:
+        data (bytes): Lines of JSON objects.
+        compressed (bool): Whether the data is gzip-compressed.
+
+    Returns:
+        list: Parsed JSON objects.
+    """
+    if compressed:
+        data = gzip.decompress(data)
+    return [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()]
+
+
 def read_pickle_file(path: str) -> json:
     """
     Reads a pickled object from a file and returns it.
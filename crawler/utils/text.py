@@ -1,9 +1,12 @@
 """
 This module contains functions to process text.
 """
+import functools
 import html
+import json
 import os
 import re
+from typing import Iterable
 
 import spacy
 from bs4 import BeautifulSoup
@@ -14,7 +17,12 @@ from unidecode import unidecode
 from spacy.tokens.token import Token
 
 load_dotenv()
-NLP = spacy.load(os.getenv("SPACY_MODEL"))
+SPACY_EXCLUDED_COMPONENTS = json.loads(os.getenv("SPACY_EXCLUDED_COMPONENTS", "[]"))
+SPACY_QUERY_DISABLED_COMPONENTS = json.loads(os.getenv("SPACY_QUERY_DISABLED_COMPONENTS", '["parser", "ner"]'))
+SPACY_QUERY_CACHE_SIZE = int(os.getenv("SPACY_QUERY_CACHE_SIZE", "10000"))
+SPACY_BATCH_SIZE = int(os.getenv("SPACY_BATCH_SIZE", "64"))
+SPACY_N_PROCESS = int(os.getenv("SPACY_N_PROCESS", "1"))
+NLP = spacy.load(os.getenv("SPACY_MODEL"), exclude=SPACY_EXCLUDED_COMPONENTS)
 NLP.add_pipe("emoji", first=True)
 REMOVE_LONG_WORD_THRESHOLD = int(os.getenv("REMOVE_LONG_WORD_THRESHOLD"))
 CRAWL_ENGLISH_CLASSIFICATION_MULTI_THRESHOLD = float(os.getenv("CRAWL_ENGLISH_CLASSIFICATION_MULTI_THRESHOLD"))
@@ -36,13 +44,13 @@ def remove_hyperlinks_from_text(text: str) -> str:
     return re.sub(pattern, '', text)
 
 
-def spacy_tokenize(text: str) -> list[Token]:
+def normalize_text_for_spacy(text: str) -> str:
     """
-    Tokenizes the given text.
+    Prepares the given text for the spaCy pipeline.
     Args:
         text: input text
 
-    Returns: list of strings
+    Returns: normalized text
 
     """
     text = text.lower()
@@ -55,9 +63,18 @@ def spacy_tokenize(text: str) -> list[Token]:
         "Ã¼", "u")
     # print(("#" * 20) + f"Remove german umlaute {tokens}", file=sys.stderr)
 
-    tokens = list(NLP(text))
-    # print(("#" * 20) + f"Tokenize and lower case {tokens}", file=sys.stderr)
+    return text
+
+
+def filter_spacy_tokens(tokens: Iterable[Token]) -> list[Token]:
+    """
+    Removes the tokens of a spaCy document which are not indexed.
+    Args:
+        tokens: tokens of a spaCy document
+
+    Returns: list of tokens
 
+    """
     tokens = [token for token in tokens if not token._.is_emoji]
     # print(("#" * 20) + f"Lower and strip {tokens}", file=sys.stderr)
 
@@ -80,6 +97,40 @@ def spacy_tokenize(text: str) -> list[Token]:
     return tokens
 
 
+def spacy_tokenize(text: str, disable: Iterable[str] = ()) -> list[Token]:
+    """
+    Tokenizes the given text.
+    Args:
+        text: input text
+        disable: names of pipeline components to skip
+
+    Returns: list of strings
+
+    """
+    return filter_spacy_tokens(NLP(normalize_text_for_spacy(text), disable=disable))
+
+
+def spacy_tokenize_batch(texts: Iterable[str],
+                         batch_size: int = SPACY_BATCH_SIZE,
+                         n_process: int = SPACY_N_PROCESS) -> list[list[Token]]:
+    """
+    Tokenizes the given texts with a single pass of the spaCy pipeline.
+    Equal texts are only tokenized once.
+    Args:
+        texts: input texts
+        batch_size: number of texts the pipeline processes at once
+        n_process: number of processes of the pipeline
+
+    Returns: list of tokens per text
+
+    """
+    texts = [normalize_text_for_spacy(text) for text in texts]
+    unique_texts = list(dict.fromkeys(texts))
+    documents = NLP.pipe(unique_texts, batch_size=batch_size, n_process=n_process)
+    tokens = {text: filter_spacy_tokens(document) for text, document in zip(unique_texts, documents)}
+    return [list(tokens[text]) for text in texts]
+
+
 def advanced_tokenize_with_pos(text: str) -> list[str]:
     """
     Tokenizes the given text.
@@ -94,6 +145,44 @@ def advanced_tokenize_with_pos(text: str) -> list[str]:
     return [f"{t.lemma_}_{t.pos_}" for t in tokens]
 
 
+@functools.lru_cache(maxsize=SPACY_QUERY_CACHE_SIZE)
+def _tokenize_query(text: str) -> tuple[str, ...]:
+    tokens = spacy_tokenize(text, disable=SPACY_QUERY_DISABLED_COMPONENTS)
+
+    return tuple(f"{t.lemma_}_{t.pos_}" for t in tokens)
+
+
+def advanced_tokenize_with_pos_batch(texts: Iterable[str],
+                                     batch_size: int = SPACY_BATCH_SIZE,
+                                     n_process: int = SPACY_N_PROCESS) -> list[list[str]]:
+    """
+    Tokenizes the given texts like advanced_tokenize_with_pos, feeding all of them through the spaCy pipeline at once.
+    Args:
+        texts: input texts
+        batch_size: number of texts the pipeline processes at once
+        n_process: number of processes of the pipeline
+
+    Returns: list of strings per text
+
+    """
+    return [[f"{t.lemma_}_{t.pos_}" for t in tokens] for tokens in spacy_tokenize_batch(texts, batch_size, n_process)]
+
+
+def tokenize_query(text: str) -> list[str]:
+    """
+    Tokenizes a search query into the same tokens as advanced_tokenize_with_pos.
+    The parser and the named entity recognizer do not influence lemmas and
+    POS tags, so they are skipped. The tokens of recent queries are memoized.
+    Args:
+        text: query text
+
+    Returns: list of strings
+
+    """
+    # spacy_tokenize lower cases first, so queries differing in case share a cache entry.
+    return list(_tokenize_query(text.lower()))
+
+
 def tokenize_get_lang(text: str) -> list[str]:
     """
     Tokenizes the given text.
@@ -161,11 +250,10 @@ def generate_text_document_from_html(html_content: str) -> 'Document':
     document = Document()
 
     document.html = html_content
-    document.body = make_text_human_readable(soup.body.get_text(separator=" ") if soup.body else "")
-    document.body_tokens = advanced_tokenize_with_pos(document.body)
-
-    document.title = make_text_human_readable(soup.title.string if soup.title else "")
-    document.title_tokens = advanced_tokenize_with_pos(document.title)
+    texts = {
+        "body": make_text_human_readable(soup.body.get_text(separator=" ") if soup.body else ""),
+        "title": make_text_human_readable(soup.title.string if soup.title else ""),
+    }
 
     # Add meta information to the document
     meta_tags = soup.find_all('meta')
@@ -173,40 +261,18 @@ def generate_text_document_from_html(html_content: str) -> 'Document':
         if 'name' in meta_tag.attrs and 'content' in meta_tag.attrs:
             name = meta_tag.attrs['name']
             content = meta_tag.attrs['content']
-            if name == 'description':
-                document.meta_description = make_text_human_readable(content)
-                document.meta_description_tokens = advanced_tokenize_with_pos(document.meta_description)
-            elif name == 'keywords':
-                document.meta_keywords = make_text_human_readable(content)
-                document.meta_keywords_tokens = advanced_tokenize_with_pos(document.meta_keywords)
-            elif name == 'author':
-                document.meta_author = make_text_human_readable(content)
-                document.meta_author_tokens = advanced_tokenize_with_pos(document.meta_author)
+            if name in ('description', 'keywords', 'author'):
+                texts[f"meta_{name}"] = make_text_human_readable(content)
 
     # Set h1, h2, h3, h4, h5, h6 fields
-    h1_tags = soup.find_all('h1')
-    document.h1 = make_text_human_readable(' '.join([h1.get_text().strip() for h1 in h1_tags]))
-    document.h1_tokens = advanced_tokenize_with_pos(document.h1)
-
-    h2_tags = soup.find_all('h2')
-    document.h2 = make_text_human_readable(' '.join([h2.get_text().strip() for h2 in h2_tags]))
-    document.h2_tokens = advanced_tokenize_with_pos(document.h2)
-
-    h3_tags = soup.find_all('h3')
-    document.h3 = make_text_human_readable(' '.join([h3.get_text().strip() for h3 in h3_tags]))
-    document.h3_tokens = advanced_tokenize_with_pos(document.h3)
-
-    h4_tags = soup.find_all('h4')
-    document.h4 = make_text_human_readable(' '.join([h4.get_text().strip() for h4 in h4_tags]))
-    document.h4_tokens = advanced_tokenize_with_pos(document.h4)
-
-    h5_tags = soup.find_all('h5')
-    document.h5 = make_text_human_readable(' '.join([h5.get_text().strip() for h5 in h5_tags]))
-    document.h5_tokens = advanced_tokenize_with_pos(document.h5)
-
-    h6_tags = soup.find_all('h6')
-    document.h6 = make_text_human_readable(' '.join([h6.get_text().strip() for h6 in h6_tags]))
-    document.h6_tokens = advanced_tokenize_with_pos(document.h6)
+    for level in range(1, 7):
+        h_tags = soup.find_all(f'h{level}')
+        texts[f"h{level}"] = make_text_human_readable(' '.join([h.get_text().strip() for h in h_tags]))
+
+    # Tokenize all fields with one pass of the spaCy pipeline
+    for (field, text), tokens in zip(texts.items(), advanced_tokenize_with_pos_batch(texts.values())):
+        setattr(document, field, text)
+        setattr(document, f"{field}_tokens", tokens)
 
     return document
 
@@ -0,0 +1,298 @@
+"""
+crawler/utils/token_store.py
+
+This module contains the columnar token store of the documents.
+
+The tokens of the fields of a document are stored as integer term IDs against one
+vocabulary shared by all fields, instead of as JSON text in the *_tokens columns of the
+documents table. The manager appends the tokens of new documents when saving them,
+the backend build scripts read them memory-mapped, without parsing any JSON:
+
+    <TOKEN_STORE_DIRECTORY>/vocabulary.jsonl    One term per line, as a JSON string. The term ID is the line number.
+    <TOKEN_STORE_DIRECTORY>/tokens.bin          The term IDs of the fields of all documents, as uint32.
+    <TOKEN_STORE_DIRECTORY>/documents.bin       One record per document: its ID and the start of each of
+                                                its fields in tokens.bin, then the end of its last field.
+
+All files are only appended to. A batch of documents is appended by writing the new
+terms first, then the term IDs and the records last, so readers only see documents
+whose tokens are complete. Writers hold an exclusive lock on the store while appending.
+The manager appends the tokens inside the transaction saving the documents, before it is
+committed, so that a committed document always has its tokens in the store. If the
+transaction is rolled back, the store keeps records of IDs without a document row: readers
+only look up the IDs of existing documents and ignore these records, and a document saved
+again later under the same ID is read from its last record.
+Documents saved before the store existed keep their tokens in the JSON columns until
+they are copied with:
+    python3 -m crawler.utils.token_store [--clear-columns]
+"""
+import argparse
+import fcntl
+import json
+import os
+import threading
+
+import numpy as np
+from dotenv import load_dotenv
+
+from crawler.utils.log import get_logger
+
+load_dotenv()
+LOG = get_logger(__file__)
+TOKEN_STORE_DIRECTORY = os.getenv("TOKEN_STORE_DIRECTORY") or None
+
+TOKEN_FIELDS = ["title", "meta_description", "meta_keywords", "meta_author", "h1", "h2", "h3", "h4", "h5", "h6",
+                "body"]
+VOCABULARY_FILE = "vocabulary.jsonl"
+TOKENS_FILE = "tokens.bin"
+DOCUMENTS_FILE = "documents.bin"
+LOCK_FILE = "lock"
+TERM_DTYPE = np.dtype(np.uint32)
+RECORD_DTYPE = np.dtype([("id", np.int64), ("offsets", np.int64, (len(TOKEN_FIELDS) + 1,))])
+
+
+def read_vocabulary(directory: str, start: int = 0) -> tuple[list[str], int]:
+    """
+    Reads the terms of the vocabulary from the byte offset start on.
+    A last line without a line break is still being written and is left out.
+
+    Returns:
+        tuple[list[str], int]: The terms and the byte offset after the last complete line.
+    """
+    path = os.path.join(directory, VOCABULARY_FILE)
+    if not os.path.exists(path):
+        return [], start
+    with open(path, "rb") as file:
+        file.seek(start)
+        data = file.read()
+    end = data.rfind(b"\n") + 1
+    return [json.loads(line) for line in data[:end].splitlines()], start + end
+
+
+class TokenStoreWriter:
+    """
+    Appends the tokens of documents to the token store. Thread-safe, and safe to use
+    from several processes: the vocabulary of other writers is read before appending.
+    """
+
+    def __init__(self, directory: str = TOKEN_STORE_DIRECTORY):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.term_ids: dict[str, int] = {}
+        self.vocabulary_end = 0
+        self.lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _truncate(self, name: str, unit: int):
+        """
+        Cuts off the incomplete end of a file left by an interrupted writer.
+        """
+        path = self._path(name)
+        if os.path.exists(path) and os.path.getsize(path) % unit != 0:
+            os.truncate(path, os.path.getsize(path) - os.path.getsize(path) % unit)
+
+    def _sync_vocabulary(self):
+        """
+        Reads the terms appended by other writers and cuts off an incompletely written term.
+        """
+        terms, self.vocabulary_end = read_vocabulary(self.directory, self.vocabulary_end)
+        for term in terms:
+            self.term_ids[term] = len(self.term_ids)
+        path = self._path(VOCABULARY_FILE)
+        if os.path.exists(path) and os.path.getsize(path) > self.vocabulary_end:
+            os.truncate(path, self.vocabulary_end)
+
+    def append(self, documents: list[tuple[int, dict[str, list[str]]]]):  # pylint: disable=too-many-locals
+        """
+        Appends the tokens of documents.
+
+        Args:
+            documents (list[tuple[int, dict[str, list[str]]]]): The ID of every document and its tokens by field.
+                Missing fields have no tokens.
+        """
+        if len(documents) == 0:
+            return
+        with self.lock, open(self._path(LOCK_FILE), "a", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._sync_vocabulary()
+            self._truncate(TOKENS_FILE, TERM_DTYPE.itemsize)
+            self._truncate(DOCUMENTS_FILE, RECORD_DTYPE.itemsize)
+            tokens_path = self._path(TOKENS_FILE)
+            offset = os.path.getsize(tokens_path) // TERM_DTYPE.itemsize if os.path.exists(tokens_path) else 0
+            new_terms, term_ids = [], []
+            records = np.zeros(len(documents), dtype=RECORD_DTYPE)
+            for record, (doc_id, fields) in zip(records, documents):
+                record["id"] = doc_id
+                record["offsets"][0] = offset
+                for number, field in enumerate(TOKEN_FIELDS):
+                    for token in fields.get(field, []):
+                        term_id = self.term_ids.get(token)
+                        if term_id is None:
+                            term_id = self.term_ids[token] = len(self.term_ids)
+                            new_terms.append(token)
+                        term_ids.append(term_id)
+                    offset += len(fields.get(field, []))
+                    record["offsets"][number + 1] = offset
+            if new_terms:
+                with open(self._path(VOCABULARY_FILE), "a", encoding="utf-8") as file:
+                    file.write("".join(json.dumps(term) + "\n" for term in new_terms))
+                self.vocabulary_end = os.path.getsize(self._path(VOCABULARY_FILE))
+            with open(tokens_path, "ab") as file:
+                file.write(np.asarray(term_ids, dtype=TERM_DTYPE).tobytes())
+            with open(self._path(DOCUMENTS_FILE), "ab") as file:
+                file.write(records.tobytes())
+
+
+class TokenStore:  # pylint: disable=too-many-instance-attributes
+    """
+    Read-only view of the token store, memory-mapped. Sees the documents appended until
+    it was opened or last refreshed.
+    """
+
+    def __init__(self, directory: str = TOKEN_STORE_DIRECTORY):
+        self.directory = directory
+        self.terms: list[str] = []
+        self.vocabulary_end = 0
+        self.num_records = -1
+        self.tokens = np.empty(0, dtype=TERM_DTYPE)
+        self.records = np.empty(0, dtype=RECORD_DTYPE)
+        self.sorted_ids = np.empty(0, dtype=np.int64)
+        self.sorted_rows = np.empty(0, dtype=np.int64)
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """
+        Opens the documents appended since the store was opened.
+
+        Returns:
+            bool: True if there are new documents.
+        """
+        path = os.path.join(self.directory, DOCUMENTS_FILE)
+        num_records = os.path.getsize(path) // RECORD_DTYPE.itemsize if os.path.exists(path) else 0
+        if num_records == self.num_records:
+            return False
+        # Records are written after their terms and tokens, so these are complete for all records read.
+        self.records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", shape=(num_records,)) \
+            if num_records > 0 else np.empty(0, dtype=RECORD_DTYPE)
+        num_tokens = int(self.records["offsets"][-1, -1]) if num_records > 0 else 0
+        self.tokens = np.memmap(os.path.join(self.directory, TOKENS_FILE), dtype=TERM_DTYPE, mode="r",
+                                shape=(num_tokens,)) if num_tokens > 0 else np.empty(0, dtype=TERM_DTYPE)
+        terms, self.vocabulary_end = read_vocabulary(self.directory, self.vocabulary_end)
+        self.terms.extend(terms)
+        # A document appended twice is read from its last record.
+        ids = np.asarray(self.records["id"])
+        rows = np.arange(len(ids) - 1, -1, -1)
+        unique_ids, first = np.unique(ids[::-1], return_index=True)
+        self.sorted_ids, self.sorted_rows = unique_ids, rows[first]
+        self.num_records = num_records
+        return True
+
+    def __len__(self) -> int:
+        return len(self.sorted_ids)
+
+    def rows_of(self, doc_ids: np.ndarray) -> np.ndarray:
+        """
+        Returns the record of every document, -1 for documents not in the store.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        rows = np.full(len(doc_ids), -1, dtype=np.int64)
+        if len(self.sorted_ids) == 0:
+            return rows
+        positions = np.minimum(np.searchsorted(self.sorted_ids, doc_ids), len(self.sorted_ids) - 1)
+        found = self.sorted_ids[positions] == doc_ids
+        rows[found] = self.sorted_rows[positions[found]]
+        return rows
+
+    def __contains__(self, doc_id: int) -> bool:
+        return bool(self.rows_of([doc_id])[0] >= 0)
+
+    def term_ids(self, row: int, field: str) -> np.ndarray:
+        """
+        Returns the term IDs of a field of the document in a record, without copying them.
+        """
+        number = TOKEN_FIELDS.index(field)
+        offsets = self.records[row]["offsets"]
+        return self.tokens[offsets[number]:offsets[number + 1]]
+
+    def tokens_of(self, row: int, field: str) -> list[str]:
+        """
+        Returns the tokens of a field of the document in a record.
+        """
+        return list(map(self.terms.__getitem__, self.term_ids(row, field).tolist()))
+
+
+def open_token_store(directory: str = TOKEN_STORE_DIRECTORY) -> TokenStore | None:
+    """
+    Opens the token store, None if it is not configured or was not written yet.
+    """
+    if directory is None or not os.path.exists(os.path.join(directory, DOCUMENTS_FILE)):
+        return None
+    return TokenStore(directory)
+
+
+SHARED_TOKEN_STORES: dict[str, TokenStore] = {}
+
+
+def shared_token_store(directory: str = TOKEN_STORE_DIRECTORY) -> TokenStore | None:
+    """
+    Returns the token store of the process, opened on first use, None if it is not configured or was not written yet.
+    The vocabulary is only read once per process, readers refresh the store for new documents.
+    """
+    if directory not in SHARED_TOKEN_STORES:
+        store = open_token_store(directory)
+        if store is None:
+            return None
+        SHARED_TOKEN_STORES[directory] = store
+    return SHARED_TOKEN_STORES[directory]
+
+
+def backfill(writer: TokenStoreWriter, store: TokenStore, chunk_size: int = 1000, clear_columns: bool = False) -> int:
+    """
+    Copies the tokens of the documents saved before the token store existed into the store.
+    Documents already in the store and documents without tokens in the JSON columns, e.g.
+    saved by the manager meanwhile, are left out, so their records are never overwritten.
+
+    Returns:
+        int: Number of copied documents.
+    """
+    from crawler.sql_models.document import Document  # pylint: disable=import-outside-toplevel
+
+    columns = [getattr(Document, f"{field}_tokens") for field in TOKEN_FIELDS]
+    last_id, copied = 0, 0
+    while True:
+        chunk = list(Document.select(Document.id, *columns).where(Document.id > last_id)
+                     .order_by(Document.id).limit(chunk_size))
+        if len(chunk) == 0:
+            break
+        last_id = chunk[-1].id
+        store.refresh()
+        missing = [document for document, row in zip(chunk, store.rows_of([document.id for document in chunk]))
+                   if row < 0 and any(getattr(document, f"{field}_tokens") for field in TOKEN_FIELDS)]
+        writer.append([(document.id, {field: getattr(document, f"{field}_tokens") for field in TOKEN_FIELDS})
+                       for document in missing])
+        if clear_columns and missing:
+            Document.update(**{f"{field}_tokens": [] for field in TOKEN_FIELDS}) \
+                .where(Document.id.in_([document.id for document in missing])).execute()
+        copied += len(missing)
+        LOG.info(f"Copied the tokens of {copied} documents up to document {last_id}")
+    return copied
+
+
+def main():
+    """
+    Copies the tokens of the documents saved before the token store existed into the store.
+    """
+    from crawler.sql_models.base import connect_to_database  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clear-columns', action='store_true',
+                        help='Empty the JSON token columns of the copied documents')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Documents copied at once')
+    args = parser.parse_args()
+    connect_to_database()
+    backfill(TokenStoreWriter(), TokenStore(TOKEN_STORE_DIRECTORY), args.chunk_size, args.clear_columns)
+
+
+if __name__ == '__main__':
+    main()
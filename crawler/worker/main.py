@@ -2,13 +2,19 @@
 This module contains the main crawling logic.
 """
 import argparse
+import asyncio
 import atexit
 import json
 import math
 import os
 import random
+import socket
+import threading
 import time
 import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 import requests
 from dotenv import load_dotenv
@@ -19,6 +25,7 @@ from requests_html import HTMLSession
 from crawler import utils
 from crawler.worker import url_relevance
 from crawler.worker.document_relevance import is_document_relevant
+from crawler.worker.politeness import CRAWL_ROBOTS_USER_AGENT, PolitenessScheduler
 from crawler.worker.url_relevance import URL
 from crawler.sql_models.base import dotdict
 from crawler.sql_models.document import Document
@@ -57,113 +64,155 @@ CRAWLER_MANAGER_PORT = int(os.getenv("CRAWLER_MANAGER_PORT"))
 CRAWLER_MANAGER_PASSWORD = os.getenv("CRAWLER_MANAGER_PASSWORD")
 CRAWLER_MANAGER_HOST = os.getenv("CRAWLER_MANAGER_HOST")
 CRAWL_WORKER_BATCH_SIZE = int(os.getenv("CRAWL_WORKER_BATCH_SIZE"))
+CRAWL_MAX_IN_FLIGHT = int(os.getenv("CRAWL_MAX_IN_FLIGHT", "32"))
+CRAWL_MAX_IN_FLIGHT_PER_HOST = int(os.getenv("CRAWL_MAX_IN_FLIGHT_PER_HOST", "2"))
+CRAWL_LEASE_RENEW_INTERVAL = float(os.getenv("CRAWL_LEASE_RENEW_INTERVAL", "60"))
+CRAWL_SUBMIT_BATCH_SIZE = int(os.getenv("CRAWL_SUBMIT_BATCH_SIZE", "16"))
+CRAWL_SUBMIT_INTERVAL = float(os.getenv("CRAWL_SUBMIT_INTERVAL", "5"))
+CRAWL_MAX_BUFFERED_RESULTS = int(os.getenv("CRAWL_MAX_BUFFERED_RESULTS", "1024"))
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
 
 
-class Crawler:
+def create_session(session: requests.Session) -> requests.Session:
+    """
+    Mounts retrying adapters with connection pools large enough for all concurrent requests.
+    """
+    adapter = HTTPAdapter(max_retries=RETRIES, pool_connections=CRAWL_MAX_IN_FLIGHT, pool_maxsize=CRAWL_MAX_IN_FLIGHT)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def create_event_loop_for_thread():
+    """
+    Gives the current thread its own event loop, which the HTMLSession needs to drive the browser.
+    """
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+class Crawler:  # pylint: disable=too-many-instance-attributes
     """
     Crawler class.
     """
 
     def __init__(self):
-        self.url: str = ""
         self.job_buffer: list[dotdict] = []
         self.current_job: dotdict = None
-        self.new_document: dotdict = None
-        self.new_relevant_urls: list = None
-        self.new_jobs: list = None
         self.crawled_count: int = 0
+        # Results not yet sent back to the manager.
+        self.results: list[dict] = []
+        self.results_lock = threading.Lock()
+        # All requests share one connection pool. The browser for dynamic websites is
+        # started once and only used by the render thread, which has its own event loop.
+        self.session: requests.Session = create_session(requests.Session())
+        self.html_session: HTMLSession = None
+        self.render_executor = ThreadPoolExecutor(max_workers=1, initializer=create_event_loop_for_thread)
+        self.politeness = PolitenessScheduler(self.session, CRAWL_ROBOTS_USER_AGENT, CRAWL_TIMEOUT)
+        self.jobs_in_flight: dict[int, dotdict] = {}
+        self.host_limits: dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(CRAWL_MAX_IN_FLIGHT_PER_HOST))
 
-    def generate_document_from_html(self, html: str) -> (Document, list[URL]):
+    @staticmethod
+    def generate_document_from_html(job: dotdict, html: str) -> (Document, list[URL]):
         """
         Generate a document from the HTML of a website.
         """
         document = utils.text.generate_text_document_from_html(html)
-        document.relevant = is_document_relevant(URL(self.url), document)
-        urls = url_relevance.URL.get_links(document, self.url)
+        document.relevant = is_document_relevant(URL(job.url), document)
+        urls = url_relevance.URL.get_links(document, job.url)
         urls = [url for url in urls if url.is_relevant]
         if document.relevant:
-            LOG.info(f"Relevant document found: {self.current_job.url}. {len(urls)} relevant URLs found.")
+            LOG.info(f"Relevant document found: {job.url}. {len(urls)} relevant URLs found.")
         else:
-            LOG.info(f"Irrelevant document found: {self.current_job.url}. {len(urls)} relevant URLs found.")
-        document.job_id = self.current_job.id
+            LOG.info(f"Irrelevant document found: {job.url}. {len(urls)} relevant URLs found.")
+        document.job_id = job.id
         return document, urls
 
-    def try_to_obtain_static_website_html(self):
+    def try_to_obtain_static_website_html(self, url: str):
         """
         Try to obtain the HTML of a static website.
         """
-        session = requests.Session()
-        session.mount('http://', HTTPAdapter(max_retries=RETRIES))
-        session.mount('https://', HTTPAdapter(max_retries=RETRIES))
-        response = session.get(self.current_job.url, timeout=CRAWL_TIMEOUT, headers=HEADERS)
+        response = self.session.get(url, timeout=CRAWL_TIMEOUT, headers=HEADERS)
         if not response.ok:
             raise Exception(
-                f"Error while rendering static website. Response not ok: {response} for URL: {self.current_job.url}")
+                f"Error while rendering static website. Response not ok: {response} for URL: {url}")
         if "html" not in (data_type := response.headers.get("Content-Type")):
             raise Exception(
-                f"Error while rendering static website. Only accept HTML. Got {data_type} for URL: {self.current_job.url}")
+                f"Error while rendering static website. Only accept HTML. Got {data_type} for URL: {url}")
         return response
 
-    def try_to_obtain_dynamic_website_html(self):
+    def render_dynamic_website(self, url: str):
         """
-        Try to obtain the HTML of a dynamic website.
+        Render a dynamic website in the browser. Must run in the render thread.
         """
-        session = HTMLSession(browser_args=["--no-sandbox"])
-        session.mount('http://', HTTPAdapter(max_retries=RETRIES))
-        session.mount('https://', HTTPAdapter(max_retries=RETRIES))
-        response = session.get(self.current_job.url, timeout=CRAWL_TIMEOUT, headers=HEADERS)
+        if self.html_session is None:
+            self.html_session = create_session(HTMLSession(browser_args=["--no-sandbox"]))
+        response = self.html_session.get(url, timeout=CRAWL_TIMEOUT, headers=HEADERS)
         response.html.render(timeout=CRAWL_RENDER_TIMEOUT)
         if not response.ok:
             raise Exception(
-                f"Error while rendering dynamic website. Response not ok: {response} for URL: {self.current_job.url}")
+                f"Error while rendering dynamic website. Response not ok: {response} for URL: {url}")
         if "html" not in (data_type := response.headers.get("Content-Type")):
             raise Exception(
-                f"Error while rendering dynamic website. Only accept HTML. Got {data_type} for URL: {self.current_job.url}")
+                f"Error while rendering dynamic website. Only accept HTML. Got {data_type} for URL: {url}")
         return response
 
-    def crawl_assume_website_is_static(self) -> (Document, list[URL]):
+    def try_to_obtain_dynamic_website_html(self, url: str):
+        """
+        Try to obtain the HTML of a dynamic website.
+        """
+        return self.render_executor.submit(self.render_dynamic_website, url).result()
+
+    def crawl_assume_website_is_static(self, job: dotdict) -> (Document, list[URL]):
         """
         Crawl the website, assuming it is static.
         """
-        response = self.try_to_obtain_static_website_html()
+        response = self.try_to_obtain_static_website_html(job.url)
         html = response.text
-        new_document = self.generate_document_from_html(html)
+        new_document = self.generate_document_from_html(job, html)
         return new_document
 
-    def crawl_assume_website_is_dynamic(self) -> (Document, list[URL]):
+    def crawl_assume_website_is_dynamic(self, job: dotdict) -> (Document, list[URL]):
         """
         Crawl the website, assuming it is dynamic.
         """
-        response = self.try_to_obtain_dynamic_website_html()
+        response = self.try_to_obtain_dynamic_website_html(job.url)
         html = response.text
-        new_document = self.generate_document_from_html(html)
+        new_document = self.generate_document_from_html(job, html)
         return new_document
 
-    def crawl(self) -> (Document, list[URL]):
+    def crawl(self, job: dotdict) -> (Document, list[URL]):
         """
         Crawl the website, first assuming it is static, then assuming it is dynamic.
+        The caller reserves the first request with the politeness scheduler.
         """
         new_document, urls = None, []
+        if not self.politeness.can_fetch(job.url):
+            LOG.info(f"Disallowed by robots.txt: {job.url}")
+            return new_document, urls
         try:  # First, try a cheaper static version.
-            new_document, urls = self.crawl_assume_website_is_static()
+            new_document, urls = self.crawl_assume_website_is_static(job)
         except Exception as exception:
-            LOG.error(f"Failed: Crawled static version of {self.current_job.url} unsucessfully: {str(exception)}")
+            LOG.error(f"Failed: Crawled static version of {job.url} unsucessfully: {str(exception)}")
             traceback.print_exc()
 
         if new_document is None or not new_document.relevant:
             try:  # If not successful, try static version with vanilla requests.
-                new_document, urls = self.crawl_assume_website_is_dynamic()
+                time.sleep(self.politeness.reserve(job))
+                new_document, urls = self.crawl_assume_website_is_dynamic(job)
             except Exception as exception:
-                LOG.error(f"Failed: Crawled dynamic version of {self.current_job.url} unsucessfully: {str(exception)}")
+                LOG.error(f"Failed: Crawled dynamic version of {job.url} unsucessfully: {str(exception)}")
         return new_document, urls
 
     def get_job(self) -> dotdict:
         """
         Get a new job from the crawler manager.
+        Jobs whose servers may be requested the earliest are returned first.
         """
         if len(self.job_buffer) == 0:
             answer = requests.get(
-                f"{CRAWLER_MANAGER_HOST}/reserve_jobs/{CRAWL_WORKER_BATCH_SIZE}?pw={CRAWLER_MANAGER_PASSWORD}",
+                f"{CRAWLER_MANAGER_HOST}/reserve_jobs/{CRAWL_WORKER_BATCH_SIZE}"
+                f"?pw={CRAWLER_MANAGER_PASSWORD}&worker_id={WORKER_ID}",
                 timeout=CRAWLER_WORKER_TIMEOUT)
             if not answer.ok:
                 raise Exception(f"Error while reserving jobs: {answer}")
@@ -171,32 +220,123 @@ class Crawler:
             for job in job_buffer:
                 self.job_buffer.append(dotdict(job))
             LOG.info(f"Reserved {job_buffer} from manager.")
-        return self.job_buffer.pop(0)
+        job = min(self.job_buffer, key=self.politeness.next_allowed_time)
+        self.job_buffer.remove(job)
+        return job
 
-    def save_crawling_results(self, json_new_document: str, json_new_jobs: str):
+    def held_job_ids(self) -> list[int]:
         """
-        Store the job in the database.
+        Returns the IDs of the reserved jobs not yet sent back to the manager.
         """
-        url = f"{CRAWLER_MANAGER_HOST}/save_crawling_results/{self.current_job.id}?pw={CRAWLER_MANAGER_PASSWORD}"
-        response = requests.post(url,
-                                 json={"new_document": json_new_document, "new_jobs": json_new_jobs},
-                                 timeout=CRAWLER_WORKER_TIMEOUT)
-        if response.ok:
-            LOG.info(f"Manager answered to save_crawling_results of {self.current_job.url}: {response.text}")
-        else:
-            raise Exception(f"Error while saving crawling results: {response.text}")
+        jobs = list(self.job_buffer) + list(self.jobs_in_flight.values())
+        if (current_job := self.current_job) is not None:
+            jobs.append(current_job)
+        with self.results_lock:
+            return [job.id for job in jobs] + [result["job_id"] for result in self.results]
+
+    def renew_leases(self):
+        """
+        Renew the leases of the held jobs every CRAWL_LEASE_RENEW_INTERVAL seconds,
+        so that the manager does not hand them out to other workers.
+        """
+        while True:
+            time.sleep(CRAWL_LEASE_RENEW_INTERVAL)
+            try:
+                job_ids = self.held_job_ids()
+                if len(job_ids) == 0:
+                    continue
+                response = requests.post(f"{CRAWLER_MANAGER_HOST}/renew_leases?pw={CRAWLER_MANAGER_PASSWORD}",
+                                         json={"worker_id": WORKER_ID, "job_ids": job_ids},
+                                         timeout=CRAWLER_WORKER_TIMEOUT)
+                if not response.ok:
+                    raise Exception(response.text)
+                if (renewed := response.json()["renewed"]) < len(job_ids):
+                    LOG.warning(f"Only {renewed} of {len(job_ids)} leases were renewed")
+            except Exception as exception:
+                LOG.error(f"Error while renewing leases: {exception}")
+
+    def add_result(self, job: dotdict, new_document: Document, new_relevant_urls: list[URL]):
+        """
+        Buffer the crawling result of a job, or its failure if the document is None,
+        and send the buffered results back once there are CRAWL_SUBMIT_BATCH_SIZE of them.
+        """
+        result = {"job_id": job.id, "document": None}
+        if new_document is not None:
+            result["document"] = model_to_dict(new_document)
+            result["new_jobs"] = Crawler.create_jobs_from_worker_to_master(relevant_links=new_relevant_urls)
+        with self.results_lock:
+            # Counted under the lock, since several threads add results at once.
+            if new_document is not None:
+                self.crawled_count += 1
+            self.results.append(result)
+            batch_is_full = len(self.results) >= CRAWL_SUBMIT_BATCH_SIZE
+        if batch_is_full:
+            self.send_results()
 
-    def mark_job_as_failed(self):
+    def send_results(self):
         """
-        Mark the job as failed in the database.
+        Send the buffered results back to the crawler manager in compressed requests.
+        Results not sent because the manager could not be reached are kept and sent again later,
+        at most CRAWL_MAX_BUFFERED_RESULTS of them. The jobs of dropped results are crawled again
+        once their leases expired.
         """
-        response = requests.post(
-            f"{CRAWLER_MANAGER_HOST}/mark_job_as_fail/{self.current_job.id}?pw={CRAWLER_MANAGER_PASSWORD}",
-            timeout=CRAWLER_WORKER_TIMEOUT)
+        with self.results_lock:
+            results, self.results = self.results, []
+        if len(results) == 0:
+            return
+        unsent = self.submit_results(results)
+        if len(unsent) == 0:
+            return
+        LOG.error(f"Could not send {len(unsent)} results back to master. Try again later")
+        with self.results_lock:
+            self.results = unsent + self.results
+            if (dropped := len(self.results) - CRAWL_MAX_BUFFERED_RESULTS) > 0:
+                LOG.error(f"Dropped the {dropped} oldest results, more than {CRAWL_MAX_BUFFERED_RESULTS} were buffered")
+                self.results = self.results[dropped:]
+
+    def submit_results(self, results: list[dict]) -> list[dict]:
+        """
+        Send results to the crawler manager in one request. The manager saves them in one transaction,
+        so a batch it rejects is split in halves until the rejected results are found. A rejected
+        result is dropped, and its job marked as failed.
+
+        Returns:
+            list[dict]: The results not sent because the manager could not be reached.
+        """
+        try:
+            response = requests.post(
+                f"{CRAWLER_MANAGER_HOST}/save_crawling_results_batch?pw={CRAWLER_MANAGER_PASSWORD}",
+                data=utils.io.compress_json_lines(results),
+                headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"},
+                timeout=CRAWLER_WORKER_TIMEOUT)
+        except requests.RequestException as exception:
+            LOG.error(f"Error while sending back to master: {exception}")
+            return results
         if response.ok:
-            LOG.info(f"Manager answered to mark_job_as_fail of {self.current_job.url}: {response.text}")
-        else:
-            raise Exception(f"Error while marking job as failed: {response.text}")
+            LOG.info(f"Manager answered to save_crawling_results_batch of {len(results)} jobs: {response.text}")
+            return []
+        if len(results) > 1:
+            middle = len(results) // 2
+            if unsent := self.submit_results(results[:middle]):
+                return unsent + results[middle:]
+            return self.submit_results(results[middle:])
+        job_id = results[0]["job_id"]
+        LOG.error(f"Manager rejected the result of job {job_id}: {response.text}")
+        try:
+            requests.post(f"{CRAWLER_MANAGER_HOST}/mark_job_as_fail/{job_id}?pw={CRAWLER_MANAGER_PASSWORD}",
+                          timeout=CRAWLER_WORKER_TIMEOUT)
+        except requests.RequestException as exception:
+            LOG.error(f"Error while marking job {job_id} as failed: {exception}")
+        return []
+
+    def send_results_periodically(self):
+        """
+        Send the buffered results every CRAWL_SUBMIT_INTERVAL seconds, so that slow crawls
+        do not delay the results of finished jobs.
+        """
+        while True:
+            time.sleep(CRAWL_SUBMIT_INTERVAL)
+            self.send_results()
 
     @staticmethod
     def create_jobs_from_worker_to_master(relevant_links: list[str]):
@@ -213,7 +353,7 @@ class Crawler:
                       surrounding_text_tokens=link.surrounding_text_tokens,
                       title_text=link.title_text,
                       title_text_tokens=link.title_text_tokens)
-            jobs_batch.append(json.dumps(model_to_dict(job)))
+            jobs_batch.append(model_to_dict(job))
         return jobs_batch
 
     def loop(self, number_of_documents_to_be_crawled: int):
@@ -225,32 +365,51 @@ class Crawler:
             try:
                 if self.current_job is None:
                     self.current_job = self.get_job()
-                if self.new_document is None or self.new_jobs is None:
-                    time.sleep(1)
-                    self.new_document, self.new_relevant_urls = self.crawl()
-                    if self.new_document is not None:
-                        self.new_jobs = Crawler.create_jobs_from_worker_to_master(relevant_links=self.new_relevant_urls)
-                        self.new_document = json.dumps(model_to_dict(self.new_document))
-                if self.new_document is not None:
-                    try:
-                        self.save_crawling_results(self.new_document, self.new_jobs)
-                        self.crawled_count += 1
-                    except Exception as exception:
-                        LOG.error(f"Error while sending back to master: {exception} Try again")
-                        continue
-                else:
-                    try:
-                        self.mark_job_as_failed()
-                    except Exception as e:
-                        LOG.error(f"Error while marking job as failed: {e}")
-                        continue
-                self.new_jobs = None
-                self.new_document = None
-                self.new_relevant_urls = None
+                time.sleep(self.politeness.reserve(self.current_job))
+                new_document, new_relevant_urls = self.crawl(self.current_job)
+                self.add_result(self.current_job, new_document, new_relevant_urls)
                 self.current_job = None
             except Exception as exception:
                 LOG.error(f"Unexpected error: {str(exception)}")
                 time.sleep(1)
+        self.send_results()
+
+    async def crawl_job(self, job: dotdict):
+        """
+        Crawl a job and send the results back to the crawler manager.
+        Other jobs are crawled while the job waits for the crawl delay of its server. At most CRAWL_MAX_IN_FLIGHT_PER_HOST jobs of the same host are crawled at once.
+        """
+        self.jobs_in_flight[job.id] = job
+        try:
+            await asyncio.sleep(await asyncio.to_thread(self.politeness.reserve, job))
+            async with self.host_limits[urlparse(job.url).netloc]:
+                new_document, new_relevant_urls = await asyncio.to_thread(self.crawl, job)
+            await asyncio.to_thread(self.add_result, job, new_document, new_relevant_urls)
+        except Exception as exception:
+            LOG.error(f"Unexpected error while crawling {job.url}: {str(exception)}")
+        finally:
+            del self.jobs_in_flight[job.id]
+
+    async def loop_asynchronously(self, number_of_documents_to_be_crawled: int):
+        """
+        Loop over the crawler like loop, but crawl up to CRAWL_MAX_IN_FLIGHT jobs concurrently.
+        """
+        # One thread per job in flight, plus one to reserve jobs.
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=CRAWL_MAX_IN_FLIGHT + 1))
+        tasks = set()
+        while self.crawled_count < number_of_documents_to_be_crawled:
+            if len(tasks) >= CRAWL_MAX_IN_FLIGHT or self.crawled_count + len(tasks) >= number_of_documents_to_be_crawled:
+                _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                job = await asyncio.to_thread(self.get_job)
+            except Exception as exception:
+                LOG.error(f"Unexpected error: {str(exception)}")
+                await asyncio.sleep(1)
+                continue
+            tasks.add(asyncio.create_task(self.crawl_job(job)))
+        await asyncio.gather(*tasks)
+        await asyncio.to_thread(self.send_results)
 
     def exit_handler(self):
         """
@@ -258,9 +417,13 @@ class Crawler:
         """
         LOG.info("Crawler exiting")
         try:
-            job_ids = []
-            for job in self.job_buffer:
-                job_ids.append(job.id)
+            if self.html_session is not None:
+                self.render_executor.submit(self.html_session.close).result()
+        except Exception as exception:
+            LOG.error(f"Error while closing the browser: {exception}")
+        self.send_results()
+        try:
+            job_ids = self.held_job_ids()
             url = f"{CRAWLER_MANAGER_HOST}/unreserve_jobs?pw={CRAWLER_MANAGER_PASSWORD}"
             answer = requests.post(url, json=job_ids, timeout=CRAWLER_WORKER_TIMEOUT)
             LOG.info("Manager answered to unreserve_jobs: " + answer.text)
@@ -275,10 +438,17 @@ def main():
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('-n', type=int, help='Number of rounds for the loop', default=math.inf)
+    parser.add_argument('--asynchronous', action='store_true',
+                        help='Crawl up to CRAWL_MAX_IN_FLIGHT jobs concurrently')
     args = parser.parse_args()
     crawler = Crawler()
     atexit.register(crawler.exit_handler)
-    crawler.loop(args.n)
+    threading.Thread(target=crawler.renew_leases, daemon=True).start()
+    threading.Thread(target=crawler.send_results_periodically, daemon=True).start()
+    if args.asynchronous:
+        asyncio.run(crawler.loop_asynchronously(args.n))
+    else:
+        crawler.loop(args.n)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+"""
+This module schedules the requests of a worker politely.
+
+Requests to the same server are spaced by its crawl delay: the Crawl-delay or
+Request-rate of its robots.txt, but at least CRAWL_DEFAULT_DELAY and at most
+CRAWL_MAX_DELAY seconds. Servers are identified by their server ID, so all hosts
+of a server share one delay. URLs disallowed by robots.txt are not crawled.
+The robots.txt of each host is cached for CRAWL_ROBOTS_TTL seconds. Its rules are
+matched against the product token CRAWL_ROBOTS_USER_AGENT of the crawler, not against
+the browser user agent sent with the requests of pages.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+import requests
+from dotenv import load_dotenv
+
+from crawler import utils
+from crawler.sql_models.base import dotdict
+
+load_dotenv()
+
+CRAWL_DEFAULT_DELAY = float(os.getenv("CRAWL_DEFAULT_DELAY", "1"))
+CRAWL_MAX_DELAY = float(os.getenv("CRAWL_MAX_DELAY", "30"))
+CRAWL_ROBOTS_TTL = float(os.getenv("CRAWL_ROBOTS_TTL", "86400"))
+CRAWL_ROBOTS_CACHE_SIZE = int(os.getenv("CRAWL_ROBOTS_CACHE_SIZE", "10000"))
+CRAWL_ROBOTS_USER_AGENT = os.getenv("CRAWL_ROBOTS_USER_AGENT", "TueSearchBot")
+LOG = utils.get_logger(__file__)
+
+
+class CachedRobots:
+    """
+    Parsed robots.txt of a host.
+    """
+
+    def __init__(self, parser: RobotFileParser, expires_at: float):
+        self.parser = parser
+        self.expires_at = expires_at
+
+
+class PolitenessScheduler:
+    """
+    Thread-safe scheduler of the requests to each server.
+    """
+
+    def __init__(self, session: requests.Session, user_agent: str, timeout: float):
+        """
+        Args:
+            session (requests.Session): Session used to download robots.txt files.
+            user_agent (str): User agent matched against the rules of robots.txt files.
+            timeout (float): Timeout in seconds of downloading a robots.txt file.
+        """
+        self.session = session
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.robots: OrderedDict[str, CachedRobots] = OrderedDict()
+        self.robots_locks: dict[str, threading.Lock] = {}
+        self.next_allowed_times: dict = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def server_key(job: dotdict):
+        """
+        Returns the key of the server of a job: its server ID, or its host if the ID is unknown.
+        """
+        return job.server_id if job.server_id is not None else urlparse(job.url).netloc
+
+    def download_robots(self, host_url: str) -> RobotFileParser:
+        """
+        Downloads and parses the robots.txt of a host.
+        Like urllib, everything is disallowed on 401 and 403 and everything is allowed
+        on other errors or if the file does not exist.
+        """
+        parser = RobotFileParser(f"{host_url}/robots.txt")
+        try:
+            response = self.session.get(parser.url, timeout=self.timeout, headers={"User-Agent": self.user_agent})
+            if response.status_code in (401, 403):
+                parser.disallow_all = True
+            elif response.status_code >= 400:
+                parser.allow_all = True
+            else:
+                parser.parse(response.text.splitlines())
+        except Exception as exception:
+            LOG.info(f"Could not download {parser.url}: {exception}")
+            parser.allow_all = True
+        parser.modified()
+        return parser
+
+    def get_robots(self, url: str) -> RobotFileParser:
+        """
+        Returns the parsed robots.txt of the host of a URL, downloading it if it is not cached.
+        """
+        parsed_url = urlparse(url)
+        host_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+        with self.lock:
+            host_lock = self.robots_locks.setdefault(host_url, threading.Lock())
+        # Only one thread downloads the robots.txt of a host, the others wait for it.
+        with host_lock:
+            with self.lock:
+                entry = self.robots.get(host_url)
+                if entry is not None and entry.expires_at > time.monotonic():
+                    self.robots.move_to_end(host_url)
+                    return entry.parser
+            parser = self.download_robots(host_url)
+            with self.lock:
+                self.robots[host_url] = CachedRobots(parser, time.monotonic() + CRAWL_ROBOTS_TTL)
+                self.robots.move_to_end(host_url)
+                while len(self.robots) > CRAWL_ROBOTS_CACHE_SIZE:
+                    evicted_host_url, _ = self.robots.popitem(last=False)
+                    self.robots_locks.pop(evicted_host_url, None)
+            return parser
+
+    def can_fetch(self, url: str) -> bool:
+        """
+        Returns true if robots.txt allows crawling the URL.
+        """
+        return self.get_robots(url).can_fetch(self.user_agent, url)
+
+    def crawl_delay(self, url: str) -> float:
+        """
+        Returns the seconds to wait between two requests to the server of the URL.
+        """
+        parser = self.get_robots(url)
+        delay = parser.crawl_delay(self.user_agent)
+        if delay is None and (rate := parser.request_rate(self.user_agent)) is not None and rate.requests > 0:
+            delay = rate.seconds / rate.requests
+        if delay is None:
+            return CRAWL_DEFAULT_DELAY
+        return min(max(float(delay), CRAWL_DEFAULT_DELAY), CRAWL_MAX_DELAY)
+
+    def next_allowed_time(self, job: dotdict) -> float:
+        """
+        Returns the monotonic time from which the server of a job may be requested again.
+        """
+        with self.lock:
+            return self.next_allowed_times.get(self.server_key(job), 0.0)
+
+    def reserve(self, job: dotdict) -> float:
+        """
+        Reserves the next request to the server of a job.
+
+        Returns:
+            float: Seconds to wait before sending the request.
+        """
+        delay = self.crawl_delay(job.url)
+        key = self.server_key(job)
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_allowed_times.get(key, 0.0))
+            self.next_allowed_times[key] = request_time + delay
+            if len(self.next_allowed_times) > CRAWL_ROBOTS_CACHE_SIZE:
+                self.next_allowed_times = {server: allowed_time
+                                           for server, allowed_time in self.next_allowed_times.items()
+                                           if allowed_time > now}
+            return request_time - now
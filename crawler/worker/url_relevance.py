@@ -114,8 +114,25 @@ class URL:
                         surrounding_text=get_surrounding_text(anchor_text),
                         title_text=link.get('title', ''),
                         parent=parent_document))
+        URL.tokenize_texts(links)
         return links
 
+    @staticmethod
+    def tokenize_texts(urls: list['URL']):
+        """
+        Tokenizes the anchor, surrounding and title texts of many URLs with one pass of the spaCy pipeline.
+
+        Args:
+            urls (list[URL]): URLs whose text tokens are computed.
+        """
+        texts = [url_text for url in urls for url_text in (url.anchor_text, url.surrounding_text, url.title_text)]
+        tokens = iter(text.advanced_tokenize_with_pos_batch(texts))
+        for url in urls:
+            # Fill the cached properties, so they are not computed one by one.
+            url.anchor_text_tokens = next(tokens)
+            url.surrounding_text_tokens = next(tokens)
+            url.title_text_tokens = next(tokens)
+
     @functools.cached_property
     def server_name(self):
         """
@@ -0,0 +1,3 @@
+-- Index of the frontier: the pending jobs ordered by priority.
+-- Together with the primary key, it covers the reservation queries except for the URL.
+CREATE INDEX jobs_frontier ON jobs (done, being_crawled, priority, server_id);
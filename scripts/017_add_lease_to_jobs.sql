@@ -0,0 +1,6 @@
+-- Reservations are leases: a job being crawled belongs to a worker until its lease expires.
+-- The index serves the search for expired leases.
+ALTER TABLE jobs
+ADD COLUMN worker_id VARCHAR(255) DEFAULT NULL,
+ADD COLUMN lease_expires_at TIMESTAMP NULL DEFAULT NULL,
+ADD INDEX jobs_lease (being_crawled, lease_expires_at);
@@ -0,0 +1,70 @@
+"""
+Benchmark the latency of the exhaustive ranking against top-k retrieval with MaxScore.
+
+Usage:
+    python3 -m scripts.benchmark_ranking -k 10 -r 20 "tubingen" "hohentubingen castle" "university of tubingen"
+    python3 -m scripts.benchmark_ranking --ranker bm25f
+"""
+import argparse
+import functools
+import time
+
+import numpy as np
+
+from backend.fused_ranker import RANKING_RANKER, FusedRanker
+
+DEFAULT_QUERIES = ["tubingen", "tubingen university", "hohentubingen castle", "food and drinks in tubingen",
+                   "tubingen neckar punting", "museum"]
+
+
+def measure(func, repetitions: int) -> np.ndarray:
+    """
+    Returns the latencies of repeated calls in milliseconds.
+    """
+    latencies = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def ranking(scores: dict[int, float]) -> list[int]:
+    """
+    Returns the IDs of the documents by decreasing score, ties broken by ID.
+    """
+    return sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+
+
+def main():
+    """
+    Run every query with both ranking modes and print the latency percentiles.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('queries', nargs='*', default=DEFAULT_QUERIES)
+    parser.add_argument('-k', type=int, default=10, help='Number of results of the top-k mode')
+    parser.add_argument('-r', type=int, default=20, help='Repetitions per query')
+    parser.add_argument('--ranker', choices=['tfidf', 'bm25f'], default=RANKING_RANKER, help='Text ranker')
+    args = parser.parse_args()
+
+    ranker = FusedRanker(ranker=args.ranker)
+    exhaustive, top_k = [], []
+    print(f"{'query':40} {'matches':>8} {'exhaustive p50':>15} {'top-k p50':>10} {'same top-k':>10}")
+    for query in args.queries:
+        _, all_scores = ranker.scores(query)
+        _, top_scores = ranker.scores(query, args.k)
+        expected = ranking(all_scores)[:args.k]
+        actual = ranking(top_scores)
+        exhaustive_latencies = measure(functools.partial(ranker.scores, query), args.r)
+        top_k_latencies = measure(functools.partial(ranker.scores, query, args.k), args.r)
+        exhaustive.append(exhaustive_latencies)
+        top_k.append(top_k_latencies)
+        print(f"{query[:40]:40} {len(all_scores):>8} {np.percentile(exhaustive_latencies, 50):>13.2f}ms "
+              f"{np.percentile(top_k_latencies, 50):>8.2f}ms {str(expected == actual):>10}")
+    exhaustive, top_k = np.concatenate(exhaustive), np.concatenate(top_k)
+    for name, latencies in (("exhaustive", exhaustive), (f"top-{args.k}", top_k)):
+        print(f"{name}: p50={np.percentile(latencies, 50):.2f}ms p99={np.percentile(latencies, 99):.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
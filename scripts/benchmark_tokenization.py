@@ -0,0 +1,57 @@
+"""
+Benchmark the loading time of the spaCy model and the latency of query tokenization.
+
+Compares the full pipeline used for indexing with the query tokenizer, which skips
+the components listed in SPACY_QUERY_DISABLED_COMPONENTS and memoizes recent queries.
+
+Usage:
+    python3 -m scripts.benchmark_tokenization -r 50 "tubingen" "hohentubingen castle" "university of tubingen"
+"""
+import argparse
+import functools
+import os
+import time
+
+import numpy as np
+import spacy
+
+from crawler import utils
+from scripts.benchmark_ranking import DEFAULT_QUERIES, measure
+
+
+def measure_model_loading(exclude: list[str]) -> float:
+    """
+    Returns the time to load the spaCy model in milliseconds.
+    """
+    start = time.perf_counter()
+    spacy.load(os.getenv("SPACY_MODEL"), exclude=exclude)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    """
+    Tokenize every query with the indexing pipeline and the query tokenizer and print the latency percentiles.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('queries', nargs='*', default=DEFAULT_QUERIES)
+    parser.add_argument('-r', type=int, default=50, help='Repetitions per query')
+    args = parser.parse_args()
+
+    for name, exclude in (("full model", []), ("query model", utils.text.SPACY_QUERY_DISABLED_COMPONENTS)):
+        print(f"load {name}: {measure_model_loading(exclude):.0f}ms")
+
+    full, uncached, cached = [], [], []
+    for query in args.queries:
+        if utils.text.advanced_tokenize_with_pos(query) != utils.text.tokenize_query(query):
+            print(f"different tokens for {query!r}")
+        full.append(measure(functools.partial(utils.text.advanced_tokenize_with_pos, query), args.r))
+        uncached.append(measure(functools.partial(utils.text._tokenize_query.__wrapped__, query.lower()),  # pylint: disable=protected-access
+                                args.r))
+        cached.append(measure(functools.partial(utils.text.tokenize_query, query), args.r))
+    for name, latencies in (("full pipeline", full), ("query pipeline", uncached), ("query pipeline, memoized", cached)):
+        latencies = np.concatenate(latencies)
+        print(f"{name}: p50={np.percentile(latencies, 50):.3f}ms p99={np.percentile(latencies, 99):.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
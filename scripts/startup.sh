@@ -29,6 +29,7 @@ elif [ "$1" == "prod.docker-compose.yml" ]; then
   docker-compose -f "$1" up -d --build prod_manager
   docker-compose -f "$1" up --build --exit-code-from prod_build_index prod_build_index
   docker-compose -f "$1" up --build --exit-code-from prod_build_metrics prod_build_metrics
+  docker-compose -f "$1" up --build -d prod_update_index
   docker-compose -f "$1" up --build -d prod_backend_server
   docker-compose -f "$1" up --build -d prod_frontend_server
   docker-compose -f "$1" up --build -d prod_nginx